@@ -0,0 +1,91 @@
+'''Compares whole-file and chunked storage when a large file changes slightly.
+
+Each mode is run on binary data (a mix of random and repeating data, as in a
+save database) and on text (as in JSON or XML saves), with changes either
+overwriting bytes in place or inserting bytes, which moves everything after
+them.
+
+Usage:
+  chunking_bench.py [--size=<mb>] [--change=<kb>] [--versions=<num>]
+
+Options:
+  --size=<mb>       Size of the save file in MB [default: 200]
+  --change=<kb>     Amount of data changed between versions in KB [default: 4]
+  --versions=<num>  Number of versions to save [default: 5]
+'''
+import os
+import time
+import random
+import tempfile
+import logging
+from docopt import docopt
+from savman.vbackup import Backup, STORE_FILES, STORE_CHUNKS
+
+WORDS = [ w.encode() for w in ('"level": ', '"player", ', '"inventory": [', '], ', 'true',
+    'false', '{', '}', '\n', '  ', '0', '12', '255') ]
+
+
+def makefile(path, size, text):
+    rand = random.Random(0)
+    with open(path, 'wb') as f:
+        for i in range(size // (1024*1024)):
+            if text: f.write(b''.join(rand.choice(WORDS) for _ in range(160000))[:1024*1024])
+            # Mix of compressible and random data, as in a typical save database
+            elif i % 2: f.write(bytes(rand.getrandbits(8) for _ in range(1024)) * 1024)
+            else: f.write(os.urandom(1024*1024))
+
+def change(path, amount, seed, insert):
+    rand = random.Random(seed)
+    with open(path, 'rb') as f: data = bytearray(f.read())
+    for i in range(max(1, amount // 1024)):
+        pos = rand.randrange(len(data) - 1024)
+        new = b''.join(rand.choice(WORDS) for _ in range(300))[:1024]
+        if insert: data[pos:pos] = new
+        else: data[pos:pos + len(new)] = new
+    with open(path, 'wb') as f: f.write(data)
+    mod = os.stat(path).st_mtime + seed
+    os.utime(path, (mod, mod))
+
+def run(storage, size, amount, versions, text, insert):
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = os.path.join(tmpdir, 'src')
+        os.mkdir(src)
+        path = os.path.join(src, 'save.db')
+        bakfile = os.path.join(tmpdir, 'bench.vbak')
+        makefile(path, size, text)
+        for num in range(versions):
+            if num: change(path, amount, num, insert)
+            bak = Backup(bakfile)
+            bak.storage = storage
+            bak.build(src)
+            before = os.path.getsize(bakfile) if os.path.isfile(bakfile) else 0
+            start = time.perf_counter()
+            bak.save(bakfile, verbose=False)
+            elapsed = time.perf_counter() - start
+            results.append((elapsed, os.path.getsize(bakfile) - before))
+    return results
+
+def main():
+    args = docopt(__doc__)
+    size = int(args['--size'])*1024*1024
+    amount = int(args['--change'])*1024
+    versions = int(args['--versions'])
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print('{:<8} {:<18} {:>7} {:>12} {:>10}'.format('Mode', 'Data', 'Version', 'Bytes', 
+        'Seconds'))
+    for text in (False, True):
+        for insert in (False, True):
+            case = '{}, {}'.format('text' if text else 'binary', 
+                'insert' if insert else 'overwrite')
+            for storage in (STORE_FILES, STORE_CHUNKS):
+                results = run(storage, size, amount, versions, text, insert)
+                for num, (elapsed, written) in enumerate(results):
+                    print('{:<8} {:<18} {:>7} {:>12} {:>10.3f}'.format(storage, case, num+1, 
+                        written, elapsed))
+                print('{:<8} {:<18} {:>7} {:>12} {:>10.3f}'.format(storage, case, 'total', 
+                    sum(r[1] for r in results), sum(r[0] for r in results)))
+
+if __name__ == '__main__':
+    main()
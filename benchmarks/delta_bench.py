@@ -0,0 +1,67 @@
+'''Compares whole-file and reverse-delta storage of a large, slightly changing file,
+by archive size (as saved, and once pruned of copies replaced by deltas) and the
+time taken to restore the newest and oldest versions.
+
+Usage:
+  delta_bench.py [--size=<mb>] [--change=<kb>] [--versions=<num>] [--max-chain=<num>]
+
+Options:
+  --size=<mb>        Size of the save file in MB [default: 200]
+  --change=<kb>      Amount of data changed between versions in KB [default: 4]
+  --versions=<num>   Number of versions to save [default: 5]
+  --max-chain=<num>  Most deltas applied to rebuild a file [default: 8]
+'''
+import os
+import time
+import tempfile
+import logging
+from docopt import docopt
+from savman.vbackup import Backup, STORE_FILES, STORE_DELTAS
+from chunking_bench import makefile, change
+
+
+def timed_restore(bak, num, tmpdir):
+    dst = tempfile.mkdtemp(dir=tmpdir)
+    start = time.perf_counter()
+    bak.restorenum(num, dst)
+    return time.perf_counter() - start
+
+def run(storage, size, amount, versions, maxchain):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = os.path.join(tmpdir, 'src')
+        os.mkdir(src)
+        path = os.path.join(src, 'save.db')
+        bakfile = os.path.join(tmpdir, 'bench.vbak')
+        makefile(path, size, text=False)
+        for num in range(versions):
+            if num: change(path, amount, num, insert=False)
+            bak = Backup(bakfile)
+            bak.storage = storage
+            bak.maxchain = maxchain
+            bak.build(src)
+            bak.save(bakfile, verbose=False)
+
+        bak = Backup(bakfile)
+        newest = timed_restore(bak, versions, tmpdir)
+        oldest = timed_restore(bak, 1, tmpdir)
+        saved = os.path.getsize(bakfile)
+        bak.prune(list(bak.versions))
+        return saved, os.path.getsize(bakfile), newest, oldest
+
+def main():
+    args = docopt(__doc__)
+    size = int(args['--size'])*1024*1024
+    amount = int(args['--change'])*1024
+    versions = int(args['--versions'])
+    maxchain = int(args['--max-chain'])
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print('{:<8} {:>12} {:>12} {:>15} {:>15}'.format('Mode', 'Bytes', 'Pruned', 'Newest (s)', 
+        'Oldest (s)'))
+    for storage in (STORE_FILES, STORE_DELTAS):
+        archive, pruned, newest, oldest = run(storage, size, amount, versions, maxchain)
+        print('{:<8} {:>12} {:>12} {:>15.3f} {:>15.3f}'.format(storage, archive, pruned, newest, 
+            oldest))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+'''Measures time and peak memory taken to load all version manifests of a large
+archive. The archive is generated with manifests only (no file data), with
+a small number of files changing in each version. With --changes-only, each
+version.json lists only changes from the version before, with a full list
+every MANIFEST_CHECKPOINT versions.
+
+Usage:
+  manifest_bench.py [--versions=<num>] [--files=<num>] [--changes=<num>] [--changes-only]
+
+Options:
+  --versions=<num>  Number of versions in the archive [default: 500]
+  --files=<num>     Number of files in each version [default: 20000]
+  --changes=<num>   Number of files changed in each version [default: 20]
+  --changes-only    Write version manifests as changes from the previous one
+'''
+import os
+import json
+import time
+import tarfile
+import tempfile
+import tracemalloc
+import logging
+from docopt import docopt
+from savman.vbackup import (Backup, BackupVersion, taraddstr, taraddindex,
+    MANIFEST_CHECKPOINT, INDEX_FORMAT)
+
+
+def makearchive(path, versions, files, changes, changesonly=False):
+    entries = {}
+    summaries = []
+    members = {}
+    bakinfo = { 'id': 'bench', 'src': '/bench', 'include': None, 'exclude': None }
+    with tarfile.open(path, 'w') as t:
+        taraddstr(t, 'info.json', json.dumps(bakinfo), members)
+        for num in range(versions):
+            version = BackupVersion(time=1000000000 + num)
+            version.set_id(time.strftime("%Y-%m-%d-%H%M%S", time.gmtime(version.time)))
+            changed = range(files) if not num else [ (num*changes + i) % files
+                for i in range(changes) ]
+            for i in changed:
+                entries['saves/slot{}/file{}.sav'.format(i % 10, i)] = { 'mod': version.time,
+                    'size': 1000 + i, 'location': version.id }
+            verinfo = { 'id': version.id, 'time': version.time, 'size': 0, 'sizedelta': 0 }
+            depth = num % MANIFEST_CHECKPOINT
+            if changesonly and depth:
+                verinfo.update(parent=summaries[-1]['id'], depth=depth, count=files,
+                    removed=[], changes={ n: entries[n] for n in
+                    ('saves/slot{}/file{}.sav'.format(i % 10, i) for i in changed) })
+            else: verinfo['files'] = entries
+            taraddstr(t, version.info, json.dumps(verinfo, sort_keys=True, indent=4), members)
+            version.filecount = files
+            summaries.append(version.summary())
+        index = { 'format': INDEX_FORMAT, 'info': bakinfo, 'members': members, 'versions': summaries }
+        taraddindex(t, index)
+
+def main():
+    args = docopt(__doc__)
+    versions, files, changes = int(args['--versions']), int(args['--files']), int(args['--changes'])
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'bench.vbak')
+        makearchive(path, versions, files, changes, args['--changes-only'])
+        tracemalloc.start()
+        start = time.perf_counter()
+        bak = Backup(path)
+        for version in bak.versions.values(): version.files
+        elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        count = len(bak.lastver.files)
+        size = os.path.getsize(path)
+
+    print('Versions: {}, files: {}, entries: {}'.format(len(bak.versions), count, versions*files))
+    print('Archive size: {:.1f} MB'.format(size/1e6))
+    print('Load time: {:.2f} s'.format(elapsed))
+    print('Memory held: {:.1f} MB, peak: {:.1f} MB'.format(current/1e6, peak/1e6))
+
+if __name__ == '__main__':
+    main()
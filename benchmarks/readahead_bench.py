@@ -0,0 +1,85 @@
+'''Compares saving with and without reading files ahead, from a source folder
+made to read as slowly as a spinning disk or network share.
+
+Reads of source files are slowed to the given throughput, with a delay for
+each read, as when seeking. Without read-ahead the time taken is about the
+sum of reading, compressing and writing. With it, it should come close to
+the slowest of them.
+
+Usage:
+  readahead_bench.py [--files=<num>] [--size=<kb>] [--speed=<mb>] [--latency=<ms>]
+
+Options:
+  --files=<num>    Number of files saved [default: 50]
+  --size=<kb>      Size of each file in KB [default: 2048]
+  --speed=<mb>     Simulated read throughput in MB/s [default: 100]
+  --latency=<ms>   Simulated delay for each read in ms [default: 5]
+'''
+import os
+import time
+import random
+import builtins
+import tempfile
+import logging
+from docopt import docopt
+from savman import compression, ziptools
+from savman.vbackup import Backup
+from vbackup_bench import filedata
+
+
+class SlowFile:
+    """File opened for reading, taking as long as a slower disk would"""
+    def __init__(self, fileobj, speed, latency):
+        self.fileobj = fileobj
+        self.speed = speed
+        self.latency = latency
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        time.sleep(self.latency + len(data)/self.speed)
+        return data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.fileobj.close()
+
+def slowopen(speed, latency):
+    def opener(path, mode='r', *args, **kwargs):
+        fileobj = builtins.open(path, mode, *args, **kwargs)
+        return SlowFile(fileobj, speed, latency) if mode == 'rb' else fileobj
+    return opener
+
+def run(src, tmpdir, readahead):
+    bakfile = os.path.join(tmpdir, 'bench{}.vbak'.format(readahead))
+    bak = Backup(bakfile)
+    bak.readahead = readahead
+    bak.build(src)
+    start = time.perf_counter()
+    bak.save(bakfile, verbose=False)
+    return time.perf_counter() - start
+
+def main():
+    args = docopt(__doc__)
+    files, size = int(args['--files']), int(args['--size'])*1024
+    speed, latency = float(args['--speed'])*1e6, float(args['--latency'])/1000
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = os.path.join(tmpdir, 'src')
+        os.mkdir(src)
+        rand = random.Random(0)
+        for num in range(files):
+            with open(os.path.join(src, 'file{}.sav'.format(num)), 'wb') as f:
+                f.write(filedata(rand, size, True))
+
+        # Only reads of source files are slowed, not of the archive
+        ziptools.open = compression.open = slowopen(speed, latency)
+        reading = files*size/speed + files*(size//ziptools.BLOCK_SIZE + 2)*latency
+        print('Reading alone: {:.2f} s'.format(reading))
+        for label, readahead in (('None', 0), ('64 MB', ziptools.READAHEAD)):
+            print('Read-ahead {:<6}: {:.2f} s'.format(label, run(src, tmpdir, readahead)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+'''Compares scanning a source tree with os.walk and per-file fnmatch calls (as
+Backup.build used to) against the scandir scanner with compiled patterns.
+
+Usage:
+  scan_bench.py [--files=<num>] [--depth=<num>] [--repeat=<num>]
+
+Options:
+  --files=<num>    Number of files in the generated tree [default: 100000]
+  --depth=<num>    Depth of directories in the tree [default: 4]
+  --repeat=<num>   Number of times each scan is timed [default: 3]
+'''
+import os
+import time
+import fnmatch
+import tempfile
+import logging
+from docopt import docopt
+from savman import pathmatch
+from savman.vbackup import Backup
+
+INCLUDE = ['*.sav', '*.dat', '*.cfg', '*.ini', os.path.join('profiles', '*'),
+    os.path.join('slot?', '*.bin')]
+EXCLUDE = ['*.log', '*.tmp', os.path.join('*', 'cache'), os.path.join('*', 'shaders'),
+    'thumbs.db', '*.bak']
+EXTENSIONS = ['.sav', '.dat', '.cfg', '.ini', '.bin', '.log', '.tmp', '.png', '.bak']
+NAMES = ['profiles', 'slot1', 'slot2', 'cache', 'shaders', 'world', 'data']
+
+
+def maketree(root, files, depth):
+    dirs = level = ['']
+    for _ in range(depth):
+        # Three subdirectories in each directory of the last level
+        level = [ os.path.join(d, NAMES[(i + j) % len(NAMES)]) 
+            for i, d in enumerate(level) for j in range(3) ]
+        dirs = dirs + level
+    for d in dirs: os.makedirs(os.path.join(root, d), exist_ok=True)
+    for num in range(files):
+        name = 'file{}{}'.format(num, EXTENSIONS[num % len(EXTENSIONS)])
+        open(os.path.join(root, dirs[num % len(dirs)], name), 'wb').close()
+
+def walk_scan(src, include, exclude):
+    """Scanner used by Backup.build before pathmatch"""
+    found = []
+    for root, dirs, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        for d in reversed(dirs):
+            drel = os.path.normpath(os.path.join(rel, d))
+            if include and not ([i for i in include if i.startswith(drel) or
+                    fnmatch.fnmatch(drel, os.path.join(os.path.dirname(i), '*')) or
+                    not os.sep in i]):
+                dirs.remove(d)
+            if exclude and [e for e in exclude if fnmatch.fnmatch(drel, e)]:
+                dirs.remove(d)
+        for file in files:
+            fpath = os.path.realpath(os.path.join(root, file))
+            frel = os.path.normpath(os.path.join(rel, file))
+            stat = os.stat(fpath)
+            if include:
+                if not [m for m in include if fnmatch.fnmatch(frel, m)]: continue
+            if exclude:
+                if [m for m in exclude if fnmatch.fnmatch(frel, m)]: continue
+            found.append((frel, stat))
+    return found
+
+def scandir_scan(src, include, exclude):
+    matcher = pathmatch.PathMatcher(include, exclude)
+    return [ (frel, entry.stat()) for frel, entry in pathmatch.scan(src, matcher) ]
+
+def timed(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    args = docopt(__doc__)
+    files, depth, repeat = int(args['--files']), int(args['--depth']), int(args['--repeat'])
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        maketree(tmpdir, files, depth)
+        print('{:<10} {:>10} {:>10}'.format('Scanner', 'Files', 'Seconds'))
+        for name, scanner in (('os.walk', walk_scan), ('scandir', scandir_scan)):
+            elapsed, found = timed(lambda: scanner(tmpdir, INCLUDE, EXCLUDE), repeat)
+            print('{:<10} {:>10} {:>10.3f}'.format(name, len(found), elapsed))
+
+        elapsed, _ = timed(lambda: Backup().build(tmpdir, INCLUDE, EXCLUDE), repeat)
+        print('{:<10} {:>10} {:>10.3f}'.format('build', '', elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+'''Times the vbackup pipeline (build, save, load, restore, trim, vertrim and thin)
+on generated save trees, as versions are added to the archive.
+
+Each tree is changed a little between versions. Once the archive has each of
+the given numbers of versions, it is loaded, restored and trimmed (trims are
+written to a separate file, so the archive keeps growing). Results can be
+saved as JSON and compared against a baseline saved earlier, so regressions
+show up as a non-zero exit status.
+
+Usage:
+  vbackup_bench.py [--tree=<name>...] [--versions=<list>] [--scale=<num>]
+                   [--output=<file>] [--baseline=<file>] [--threshold=<pct>]
+
+Options:
+  --tree=<name>      Tree to run: 'small' (many small files), 'huge' (a few
+                     huge files), 'random' (incompressible files) or 'deep'
+                     (deeply nested directories) [default: all]
+  --versions=<list>  Version counts at which the archive is measured [default: 1,5,20]
+  --scale=<num>      Multiplies number and size of generated files [default: 1]
+  --output=<file>    Save results as JSON
+  --baseline=<file>  Compare results to JSON saved earlier with --output
+  --threshold=<pct>  Slowdown from baseline reported as regression [default: 10]
+'''
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import logging
+from docopt import docopt
+from savman.vbackup import Backup
+
+# Keys: tree name, values: (number of files, size of each file, directory depth,
+# whether data compresses) at scale 1
+TREES = { 'small': (5000, 4*1024, 2, True),
+          'huge': (3, 64*1024*1024, 1, True),
+          'random': (200, 256*1024, 2, False),
+          'deep': (2000, 8*1024, 12, True) }
+WORDS = [ w.encode() for w in ('level', 'player', 'inventory', 'quest', 'flag', 'position',
+    'health', 'true', 'false', '0', '1', '255', '{', '}', '=', '\n') ]
+CHANGED = 0.02      # Fraction of files changed between versions
+TIMESTAMP = 1000000000
+MIN_CHANGE = 0.01   # Smallest change in seconds reported as regression, below this is noise
+
+
+def filedata(rand, size, compressible):
+    if not compressible: return os.urandom(size)
+    # Text as in a typical save or config file
+    data = bytearray()
+    while len(data) < size:
+        data += b' '.join(rand.choice(WORDS) for _ in range(4096))
+    return bytes(data[:size])
+
+def maketree(root, tree, scale):
+    """Writes files of TREE under ROOT, returning their paths"""
+    count, size, depth, compressible = TREES[tree]
+    count, size = max(1, int(count*scale)), max(1, int(size*scale))
+    rand = random.Random(tree)
+    paths = []
+    for num in range(count):
+        parts = [ 'dir{}'.format((num >> level) % 4) for level in range(depth - 1) ]
+        path = os.path.join(root, *parts, 'file{}.sav'.format(num))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            # Huge files are written in pieces, the same piece repeated wouldn't compress fairly
+            for offset in range(0, size, 1024*1024):
+                f.write(filedata(rand, min(1024*1024, size - offset), compressible))
+        os.utime(path, (TIMESTAMP, TIMESTAMP))
+        paths.append(path)
+    return paths
+
+def changetree(paths, tree, version):
+    """Changes some files in tree for VERSION, returning bytes written"""
+    compressible = TREES[tree][3]
+    rand = random.Random(version)
+    written = 0
+    for path in rand.sample(paths, max(1, int(len(paths)*CHANGED))):
+        size = os.path.getsize(path)
+        amount = min(size, 64*1024)
+        with open(path, 'r+b') as f:
+            f.seek(rand.randrange(size - amount + 1))
+            f.write(filedata(rand, amount, compressible))
+        written += amount
+        os.utime(path, (TIMESTAMP + version, TIMESTAMP + version))
+    return written
+
+def treesize(root):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(root) for f in files)
+
+def peak_rss():
+    """Returns peak resident memory of process in bytes, or None if not known"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'): return int(line.split()[1])*1024
+    except OSError: pass
+    try: import resource
+    except ImportError: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak*1024
+
+def reset_peak():
+    """Resets peak resident memory, so the next operation's peak is measured"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f: f.write('5')
+    except OSError: pass
+
+def timed(results, key, func, size=None):
+    """Runs FUNC and adds its time and peak memory to RESULTS under KEY"""
+    reset_peak()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    result = { 'seconds': elapsed, 'peak_rss': peak_rss() }
+    if size is not None: result['mbps'] = size/1e6/max(elapsed, 1e-9)
+    results[key] = result
+    return result
+
+def run(tree, counts, scale, tmpdir):
+    results = {}
+    src = os.path.join(tmpdir, tree)
+    bakfile = os.path.join(tmpdir, '{}.vbak'.format(tree))
+    paths = maketree(src, tree, scale)
+    size = treesize(src)
+    for version in range(1, max(counts) + 1):
+        written = changetree(paths, tree, version) if version > 1 else size
+        bak = Backup(bakfile)
+        key = '{}/{}/'.format(tree, version)
+        timed(results, key + 'build', lambda: bak.build(src))
+        timed(results, key + 'save', lambda: bak.save(bakfile, verbose=False), written)
+        if not version in counts:
+            del results[key + 'build'], results[key + 'save']
+            continue
+
+        results[key + 'save']['archive_size'] = os.path.getsize(bakfile)
+        loaded = []
+        timed(results, key + 'load', lambda: loaded.append(Backup(bakfile)))
+        bak = loaded[0]
+        dst = tempfile.mkdtemp(dir=tmpdir)
+        timed(results, key + 'restore', lambda: bak.restore(dst), size)
+        trimfile = os.path.join(tmpdir, 'trimmed.vbak')
+        middle = sorted(bak.versions.values(), key=lambda v: v.time)[(version - 1) // 2]
+        timed(results, key + 'trim', lambda: bak.trim(middle.id, trimfile), size)
+        if version > 1: timed(results, key + 'vertrim', lambda: bak.vertrim(1, trimfile), size)
+        if version > 2:
+            # Every other version removed from the middle of the history
+            versions = sorted(bak.versions.values(), key=lambda v: v.time)
+            keep = [ v.id for v in versions[::2] ] + [versions[-1].id]
+            timed(results, key + 'thin', lambda: bak.prune(keep, trimfile), size)
+        os.remove(trimfile)
+    return results
+
+def compare(results, baseline, threshold):
+    """Prints changes in time from BASELINE, returning number of regressions"""
+    regressions = 0
+    print('\n{:<24} {:>12} {:>12} {:>9}'.format('Compared', 'Baseline (s)', 'Now (s)', 'Change'))
+    for key, result in results.items():
+        if not key in baseline: continue
+        before, now = baseline[key]['seconds'], result['seconds']
+        change = (now - before)/max(before, 1e-9)*100
+        slower = change > threshold and now - before > MIN_CHANGE
+        regressions += slower
+        print('{:<24} {:>12.3f} {:>12.3f} {:>+8.1f}%{}'.format(key, before, now, change,
+            '  REGRESSION' if slower else ''))
+    return regressions
+
+def main():
+    args = docopt(__doc__)
+    trees = list(TREES) if args['--tree'] in ([], ['all']) else args['--tree']
+    for tree in trees:
+        if not tree in TREES: sys.exit("Unknown tree '{}'".format(tree))
+    counts = sorted(int(n) for n in args['--versions'].split(','))
+    scale = float(args['--scale'])
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = {}
+    for tree in trees:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            results.update(run(tree, counts, scale, tmpdir))
+
+    print('{:<24} {:>10} {:>10} {:>10} {:>12}'.format('Operation', 'Seconds', 'MB/s',
+        'Peak MB', 'Archive MB'))
+    for key, result in results.items():
+        mbps, rss = result.get('mbps'), result['peak_rss']
+        archive = result.get('archive_size')
+        print('{:<24} {:>10.3f} {:>10} {:>10} {:>12}'.format(key, result['seconds'],
+            '' if mbps is None else '{:.1f}'.format(mbps),
+            '' if rss is None else '{:.1f}'.format(rss/1e6),
+            '' if archive is None else '{:.1f}'.format(archive/1e6)))
+
+    if args['--output']:
+        with open(args['--output'], 'w') as f:
+            json.dump({ 'scale': scale, 'results': results }, f, indent=4)
+    if args['--baseline']:
+        with open(args['--baseline']) as f: baseline = json.load(f)
+        if baseline['scale'] != scale: print('\nBaseline was run at scale {}'.format(baseline['scale']))
+        if compare(results, baseline['results'], float(args['--threshold'])): sys.exit(1)
+
+if __name__ == '__main__':
+    main()
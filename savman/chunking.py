@@ -0,0 +1,88 @@
+'''Content-defined chunking of files.
+
+Chunk boundaries depend only on the bytes around them, so inserting or
+changing data in one part of a file leaves the chunks in other parts intact.
+
+Every position gets a one byte hash of the WINDOW bytes ending there, and
+a boundary is placed where that hash is zero and the CRC of the window
+matches a mask. The hashes are worked out for a block of data at once: each
+byte is replaced with bytes.translate (by one of two random tables, taking
+turns by position) and the block, as one big integer, is XORed with itself
+shifted, doubling the number of bytes hashed each time. That keeps the
+per-byte work in C rather than rolling a hash through every byte in Python,
+and any data that isn't repetitive, text included, has boundaries.
+'''
+import zlib
+import hashlib
+
+MIN_SIZE = 16*1024          # Smallest chunk (except for the end of a file)
+MAX_SIZE = 256*1024         # Largest chunk, cut here if no boundary is found
+WINDOW = 32                 # Number of bytes hashed to decide a boundary
+MASK = 0xff                 # Window CRC must have these bits clear, avg. ~80KB chunks
+MAX_CHECKS = 4096           # Give up on repetitive data after this many candidates
+SEARCH_MIN = 4*1024         # Fewest bytes hashed at once when looking for a boundary
+READ_SIZE = 4*1024*1024
+
+# Random orders of byte values, derived from SHA-1 so boundaries don't change
+# between Python versions
+TABLES = [ bytes(sorted(range(256), key=lambda b: hashlib.sha1(bytes([lane, b])).digest()))
+    for lane in range(2) ]
+
+
+def window_hashes(data):
+    """Returns a byte for each position in DATA, hashing the WINDOW bytes ending
+       there (fewer for the first WINDOW-1 positions)
+    """
+    value = 0
+    for lane, table in enumerate(TABLES):
+        value ^= int.from_bytes(data.translate(table), 'little') << 8*lane
+    width = len(TABLES)
+    while width < WINDOW:
+        value ^= value << 8*width
+        width *= 2
+    return value.to_bytes(len(data) + WINDOW, 'little')[:len(data)]
+
+def find_boundary(data, start, end, min_size=MIN_SIZE, mask=MASK):
+    """Returns position of the first chunk boundary in DATA between START and END"""
+    view = memoryview(data)
+    step = max(SEARCH_MIN, 64*(mask + 1))       # A quarter of the distance to a boundary
+    pos = start + min_size
+    checks = 0
+    while pos < end:
+        stop = min(pos + step, end)
+        base = max(pos - WINDOW, 0)
+        hashes = window_hashes(data[base:stop])
+        idx = hashes.find(0, pos - base - 1)
+        while idx >= 0:
+            cut = base + idx + 1
+            if not zlib.crc32(view[max(cut - WINDOW, 0):cut]) & mask: return cut
+            checks += 1
+            if checks >= MAX_CHECKS: return end
+            idx = hashes.find(0, idx + 1)
+        pos = stop
+    return end
+
+def chunks(fileobj, min_size=MIN_SIZE, max_size=MAX_SIZE, mask=MASK):
+    """Yields content-defined chunks of file object as bytes. Chunks average
+       around 256*(MASK+1) bytes plus MIN_SIZE.
+    """
+    buf = b''
+    start = 0
+    eof = False
+    while True:
+        # Keep at least one maximum sized chunk in the buffer
+        if not eof and len(buf) - start < max_size:
+            data = fileobj.read(READ_SIZE)
+            if not data: eof = True
+            buf = buf[start:] + data
+            start = 0
+            continue
+        if start >= len(buf): return
+        if len(buf) - start <= min_size: cut = len(buf)
+        else: cut = find_boundary(buf, start, min(start + max_size, len(buf)), min_size, mask)
+        yield buf[start:cut]
+        start = cut
+
+def chunk_id(chunk):
+    """Returns ID for chunk based on its contents"""
+    return hashlib.sha1(chunk).hexdigest()
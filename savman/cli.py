@@ -1,12 +1,12 @@
 '''A utility for backing up and restoring saved games.
 
 Usage:
-  savman list [--backups]
-  savman scan [--nocache]
-  savman update
-  savman load <directory>
+  savman list [--backups] [options]
+  savman scan [--nocache] [options]
+  savman update [options]
+  savman load <directory> [options]
   savman backup <directory> [<game>] [options]  
-  savman restore <game> [<directory>] [options]
+  savman restore <game> [<directory>] [--include=<path>...] [--exclude=<path>...] [options]
   savman -h | --help
   
 Commands:
@@ -25,10 +25,33 @@ Options:
   --update          Check for database update
   --max <count>     Maximum number of versions to keep (default: 10)
   --min <count>     Number of versions to trim to when max is exceeded (default: 5)
+  --keep <policy>   Versions kept as they age, in place of '--min' and '--max', 
+                    as <interval>:<age> rules such as 'all:1d,daily:7d,weekly:30d'
+                    (all versions from the last day, the last of each day for a
+                    week and of each week for a month)
+  --threads <num>   Number of threads used to compress or restore files 
+                    (default: one per CPU)
+  --jobs <num>      Number of game locations backed up at once (default: one
+                    per CPU)
+  --force           Back up every location, including those unchanged since 
+                    their last backup
+  --policy <name>   How backups are compressed: 'fast', 'balanced' (default)
+                    or 'smallest'
   --source <num>    Game location to restore or backup from
   --target <num>    Game location to restore to
+  --incremental     Only restore files that differ from those already there
+  --hashcheck       Compare contents of files when restoring incrementally,
+                    not only modification time and size
+  --delete          Remove files from the save location that the backup 
+                    doesn't have when restoring
+  --include <path>  Only restore files matching path or pattern
+  --exclude <path>  Don't restore files matching path or pattern
+  --stats           Show time taken by each phase and totals such as files 
+                    scanned and bytes compressed when finished
+  --stats-file <file>  Save the statistics shown by '--stats' to file as JSON
 '''
-from savman import databaseman, gameman, datapath, __version__
+from savman import (databaseman, gameman, datapath, compression, metrics, retention, vbackup, 
+    __version__)
 import sys
 import os
 import logging
@@ -80,16 +103,43 @@ def run():
         gman.load_backups(args['<directory>'])
 
     if args['restore']:
+        threads = None
         try:
+            if args['--threads']: threads = int(args['--threads'])
+        except ValueError:
+            logging.error("Argument for '--threads' must be a number")
+            sys.exit(1)
+        try:
+            incremental = None
+            if args['--incremental']: 
+                incremental = vbackup.CHECK_HASH if args['--hashcheck'] else vbackup.CHECK_STAT
             gman.restore_game(args['<game>'], args['<directory>'], args['--source'],
-                args['--target'])
+                args['--target'], args['--include'], args['--exclude'], threads, incremental,
+                args['--delete'])
         except gameman.InvalidIdError as e:
             logging.error("Could not restore '{}': {}".format(args['<game>'], e))
             sys.exit(1)
     
     gman.save_cache()
     
-    if args['list'] and gman.games:
+    if args['list'] and args['--backups']:
+        rows = []
+        for game, paths in sorted(gman.backups.items()):
+            for path in paths:
+                entry = gman.catalog_entry(path)
+                latest = time.strftime('%Y/%m/%d %H:%M', time.localtime(entry['latest'])) \
+                    if entry['latest'] else ''
+                rows.append((game, str(entry['versions']), latest, 
+                    '{:.1f}'.format(entry['size']/1e6), entry['src'] or ''))
+        header = ('ID', 'Versions', 'Latest', 'Size (MB)', 'Source')
+        width = [ max(len(r[i]) for r in rows + [header]) for i in range(len(header)) ]
+        print()
+        for row in [header, tuple('-'*w for w in width)] + rows:
+            print('  '.join(item.ljust(w) for item, w in zip(row, width)).rstrip())
+        print('\n{} backups in total.\n'.format(len(rows)))
+        gman.save_cache()       # Keep catalog entries read for the list
+
+    elif args['list'] and gman.games:
         maxname = max([len(game.name) for game in gman.games.values()])
         maxid = max([len(game.id) for game in gman.games.values()])
         print('\nName', ' '*(maxname-4), 'ID', ' '*(maxid-2), 'Locations')
@@ -115,22 +165,49 @@ def run():
                 #print('*', location.path, sizet)
         print('\n{} games in total.\n'.format(len(gman.games)))
     
+    failed = {}     # Keys: (game id, location path), values: error backing up location
     if args['backup'] and args['<directory>']: 
         if args['<game>']: game = [args['<game>']]
         else: game = None
         minver = 5
         maxver = 10
+        threads = None
+        jobs = None
         try:
             if args['--min']: minver = int(args['--min'])
             if args['--max']: maxver = int(args['--max'])
+            if args['--threads']: threads = int(args['--threads'])
+            if args['--jobs']: jobs = int(args['--jobs'])
         except ValueError:
-            logging.error("Argument for '--max' and '--min' must be a number")
+            logging.error("Argument for '--max', '--min', '--threads' and '--jobs' must be a "
+                "number")
             sys.exit(1)
         if minver >= maxver: 
             logging.error("Value for '--min' must be under '--max' (min: {}, max: {})".format(
                 minver, maxver
             ))
             sys.exit(1)
-        gman.backup_games(args['<directory>'], games=game, trim_min=minver, trim_max=maxver)
+        keep = None
+        if args['--keep']:
+            if args['--min'] or args['--max']:
+                logging.error("'--keep' can't be used with '--min' or '--max'")
+                sys.exit(1)
+            try: keep = retention.parse(args['--keep'])
+            except ValueError as e:
+                logging.error(e)
+                sys.exit(1)
+        if args['--policy'] and not args['--policy'] in compression.POLICIES:
+            logging.error("Invalid compression policy '{}'".format(args['--policy']))
+            sys.exit(1)
+        failed = gman.backup_games(args['<directory>'], games=game, trim_min=minver, 
+            trim_max=maxver, threads=threads, policy=args['--policy'], keep=keep, jobs=jobs,
+            force=args['--force'])
+        gman.save_cache()       # Keep fingerprints of the locations backed up
+
+    if args['--stats']: 
+        print()
+        for line in metrics.collector.report(): print(line)
+    if args['--stats-file']: metrics.collector.save(args['--stats-file'])
         
+    if failed: sys.exit(1)
     logging.info('Finished!')
\ No newline at end of file
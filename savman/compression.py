@@ -0,0 +1,65 @@
+'''Choosing how each file in a backup is compressed.
+
+A policy picks the codec for each file from an estimate of the entropy of
+its first few kilobytes, found by deflating them at the fastest level. Data
+that won't get any smaller (images, archives and the many save formats that
+are already compressed) is stored, so no time is spent compressing it again.
+'''
+import zlib
+import zipfile
+from collections import namedtuple
+
+try: import bz2
+except ImportError: bz2 = None
+try: import lzma
+except ImportError: lzma = None
+
+SAMPLE_SIZE = 64*1024       # Bytes read from the start of a file to estimate its entropy
+SAMPLE_MIN = 1024           # Smaller samples aren't a useful estimate, so are always compressed
+
+Codec = namedtuple('Codec', 'name compress_type level')
+Policy = namedtuple('Policy', 'codec max_entropy')     # Files at or above MAX_ENTROPY are stored
+
+STORED = Codec('stored', zipfile.ZIP_STORED, None)
+CODECS = { 'stored': STORED,
+           'deflate': Codec('deflate', zipfile.ZIP_DEFLATED, 6),
+           'bzip2': Codec('bzip2', zipfile.ZIP_BZIP2, 9),
+           'lzma': Codec('lzma', zipfile.ZIP_LZMA, None) }
+
+def available(codec):
+    """Checks whether the modules needed by codec can be imported"""
+    if codec.compress_type == zipfile.ZIP_BZIP2: return bz2 is not None
+    if codec.compress_type == zipfile.ZIP_LZMA: return lzma is not None
+    return True
+
+def strongest():
+    """Returns codec that compresses the most of those available"""
+    for name in ('lzma', 'bzip2'):
+        if available(CODECS[name]): return CODECS[name]
+    return CODECS['deflate']._replace(level=9)
+
+POLICY_DEFAULT = 'balanced'
+POLICIES = { 'fast': Policy(CODECS['deflate']._replace(level=1), 7.0),
+             'balanced': Policy(CODECS['deflate'], 7.5),
+             'smallest': Policy(strongest(), 7.8) }
+
+def entropy(data):
+    """Estimates entropy of DATA in bits per byte"""
+    return 8 * len(zlib.compress(data, 1)) / len(data)
+
+def choose(sample, policy=POLICY_DEFAULT):
+    """Returns codec used under POLICY for data starting with SAMPLE"""
+    codec, max_entropy = POLICIES[policy]
+    sample = sample[:SAMPLE_SIZE]
+    if len(sample) >= SAMPLE_MIN and entropy(sample) >= max_entropy: return STORED
+    return codec
+
+def choose_file(path, policy=POLICY_DEFAULT):
+    """Returns codec used under POLICY for file at PATH"""
+    with open(path, 'rb') as f: return choose(f.read(SAMPLE_SIZE), policy)
+
+def check(name):
+    """Raises RuntimeError if files compressed with codec NAME can't be read"""
+    if not name in CODECS: raise RuntimeError("Unknown codec '{}'".format(name))
+    if not available(CODECS[name]):
+        raise RuntimeError("Codec '{}' requires a module missing from this Python".format(name))
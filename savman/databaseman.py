@@ -4,6 +4,7 @@ import hashlib
 import logging
 import requests
 from requests.exceptions import ConnectionError
+from savman import metrics
 
 logger = logging.getLogger('database')
 
@@ -17,6 +18,7 @@ class Manager:
         self.latesturl = ''
         self.update = False
 
+    @metrics.timed('database.load')
     def load(self, filename): 
         logger.info("Loading database")
         try:
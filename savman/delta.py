@@ -0,0 +1,75 @@
+'''Binary deltas between two versions of a file.
+
+A delta rebuilds a target file from a base file. The base is split into
+content-defined chunks (see chunking), then each chunk of the target is
+either copied from where the same chunk occurs in the base or included as
+literal data. As chunk boundaries follow the content, data that has moved
+or had bytes inserted before it is still found in the base.
+
+Format: MAGIC, then a list of operations, each one of
+  COPY  <offset: u64> <length: u64>     Copy LENGTH bytes from OFFSET in base
+  DATA  <length: u64> <bytes>           Append LENGTH literal bytes
+'''
+import struct
+from savman import chunking
+
+MAGIC = b'VBDELTA1'
+COPY = b'C'
+DATA = b'D'
+CHUNKING = { 'min_size': 2*1024, 'max_size': 64*1024, 'mask': 0x1f }   # ~10KB chunks
+BLOCK_SIZE = 1024*1024      # Size of pieces delta is yielded in
+
+
+def diff(base, target):
+    """Yields delta that rebuilds file object TARGET from file object BASE as
+       blocks of bytes.
+    """
+    index = {}          # Keys: chunk ids, Values: offset of chunk in base
+    pos = 0
+    for chunk in chunking.chunks(base, **CHUNKING):
+        index.setdefault(chunking.chunk_id(chunk), pos)
+        pos += len(chunk)
+
+    out = bytearray(MAGIC)
+    copy = None         # Pending [offset, length] to copy, extended while chunks follow on
+    for chunk in chunking.chunks(target, **CHUNKING):
+        offset = index.get(chunking.chunk_id(chunk))
+        if offset is not None and copy and sum(copy) == offset:
+            copy[1] += len(chunk)
+            continue
+        if copy: out += COPY + struct.pack('<QQ', *copy)
+        if offset is None:
+            out += DATA + struct.pack('<Q', len(chunk)) + chunk
+            copy = None
+        else: copy = [offset, len(chunk)]
+        if len(out) >= BLOCK_SIZE:
+            yield bytes(out)
+            out = bytearray()
+    if copy: out += COPY + struct.pack('<QQ', *copy)
+    if out: yield bytes(out)
+
+def readexact(fileobj, size):
+    data = fileobj.read(size)
+    if len(data) < size: raise ValueError('Unexpected end of data')
+    return data
+
+def copylength(src, dst, length):
+    while length:
+        data = readexact(src, min(length, BLOCK_SIZE))
+        dst.write(data)
+        length -= len(data)
+
+def patch(base, delta, out):
+    """Writes file rebuilt from file object BASE and DELTA to OUT"""
+    if delta.read(len(MAGIC)) != MAGIC: raise ValueError('Not a delta')
+    while True:
+        op = delta.read(1)
+        if not op: return
+        if op == COPY:
+            offset, length = struct.unpack('<QQ', readexact(delta, 16))
+            base.seek(offset)
+            copylength(base, out, length)
+        elif op == DATA:
+            length, = struct.unpack('<Q', readexact(delta, 8))
+            copylength(delta, out, length)
+        else: raise ValueError('Unknown delta operation {!r}'.format(op))
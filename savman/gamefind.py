@@ -1,6 +1,7 @@
 import os
 import logging
 import fnmatch
+from savman import metrics
 import win32api
 import win32file
 from win32com.shell import shell, shellcon
@@ -154,6 +155,7 @@ class Finder:
         return self.found
 
 
+    @metrics.timed('finder.search')
     def search(self):
         rootnum = 0
         for directory, data in self.dircache.items():
@@ -162,12 +164,14 @@ class Finder:
             path = os.path.normpath(path)
             for root, dirs, files in os.walk(path):  
                 rootnum += 1          
+                metrics.count('finder.dirs_visited')
                 rel = os.path.relpath(root, path)
                 if rel.count(os.sep) >= 3: del dirs[:]     # Only 3 folders deep  
                    
                 for item in self.excl:
                     if item in dirs: del dirs[dirs.index(item)]
                     
+                metrics.count('finder.cache.hits' if root in self.dircache else 'finder.cache.misses')
                 if (self.dircache and root in self.dircache and not     # If we've searched before
                         self.dircache[root]['hasgames']):               # and not found any games
                     for d in reversed(dirs):
@@ -1,4 +1,4 @@
-from savman import gamefind
+from savman import gamefind, metrics, pathmatch
 import os
 import gzip
 import string
@@ -9,6 +9,8 @@ import fnmatch
 import logging
 import hashlib
 from savman.vbackup import Backup
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 class InvalidIdError(Exception): pass
 
@@ -23,11 +25,29 @@ class GameLocation:
         self.path = path
         self.include = include
         self.exclude = exclude
+
+    def fingerprint(self):
+        """Returns digest of the names, sizes and modification times of the files
+           a backup of the location includes, found with stat calls only
+        """
+        include = [ os.path.normpath(i) for i in self.include ] if self.include else None
+        exclude = [ os.path.normpath(e) for e in self.exclude ] if self.exclude else None
+        matcher = pathmatch.PathMatcher(include, exclude)
+        entries = []
+        for rel, entry in pathmatch.scan(os.path.realpath(self.path), matcher):
+            stat = entry.stat()
+            entries.append('{}\0{}\0{}\n'.format(rel, stat.st_size, stat.st_mtime_ns))
+        digest = hashlib.sha1()
+        for entry in sorted(entries): digest.update(entry.encode())
+        return digest.hexdigest()
         
 class GameMan:
     def __init__(self, database):
         self.games = {}
         self.backups = {}                   #Keys: game id, Values: backup path
+        self.fingerprints = {}              #Keys: backup path, Values: [location fingerprint,
+                                            #archive size, archive modification time]
+        self.catalog = {}                   #Keys: backup path, Values: dict of backup details
         self.db = database
         self.finder = gamefind.Finder()
         self.cachefile = ''
@@ -47,7 +67,8 @@ class GameMan:
         with gzip.open(file, 'wt') as cfile:
             self.finder.trim_cache()
             json.dump({'games': games_json, 'dirs': self.finder.export_cache(),
-                'backups': self.backups}, cfile)
+                'backups': self.backups, 'fingerprints': self.fingerprints, 
+                'catalog': self.catalog}, cfile)
 
     def load_cache(self, file=None, dircache=True, cleargames=False):
         if not file: 
@@ -72,6 +93,10 @@ class GameMan:
                     if not os.path.isfile(backup): backups.remove(backup)
                 if not backups: del cache['backups'][game]
             self.backups = cache['backups']
+            self.fingerprints = { path: fp for path, fp in cache.get('fingerprints', {}).items() 
+                if os.path.isfile(path) }
+            self.catalog = { path: entry for path, entry in cache.get('catalog', {}).items()
+                if os.path.isfile(path) }
 
             if not cleargames:
                 for item, data in cgames.items():
@@ -154,32 +179,81 @@ class GameMan:
         logging.info("{} games found".format(len(found)))
             
 
-    def backup_games(self, dst, games=[], trim_min=None, trim_max=None):
+    @metrics.timed('gameman.backup_games')
+    def backup_games(self, dst, games=[], trim_min=None, trim_max=None, threads=None, 
+            policy=None, keep=None, jobs=None, force=False):
+        """Backs up GAMES to DST, JOBS locations at a time (default: one per CPU).
+           Afterwards versions not kept under retention rules KEEP are removed, or 
+           trimmed to TRIM_MIN versions once there are over TRIM_MAX. Locations 
+           unchanged since their last backup are skipped, unless FORCE. Returns 
+           errors of locations that failed, keyed by (game id, location path).
+        """
         if not os.path.isdir(dst):
-            raise FileNotFoundError("Destination does not exist: '{}'".format(location))
+            raise FileNotFoundError("Destination does not exist: '{}'".format(dst))
         if not games: games = [ g for g in self.games ]
         logging.info('Starting game backup...')
         if not games:
             logging.info('No games to backup')
-            return
-        #pool = multiprocessing.Pool(threads)
+            return {}
+        tasks = []
         for game in sorted(games):
             if not game in self.games: 
                 logging.error("Could not backup '{}' - game ID not in database".format(game))
                 continue
-            for loc in self.games[game].locations:    
-                # Append count if more than one directory found
-                dirhash = hashlib.sha1(loc.path.encode()).hexdigest()
-                name = '{}_{}.savman.vbak'.format(game, dirhash.upper()[:6]) 
-                path = os.path.join(dst, name)
-                backup = Backup(file=path, id=game)
-                backup.build(src=loc.path, include=loc.include,
-                    exclude=loc.exclude)
-                backup.save()
-                if trim_min and trim_max: backup.autotrim(trim_min, trim_max)
-
-        #pool.close()
-        #pool.join()
+            tasks.extend((game, loc) for loc in self.games[game].locations)
+
+        jobs = max(1, min(jobs or os.cpu_count() or 1, len(tasks)))
+        # Threads compressing files are shared between the jobs
+        if not threads: threads = max(1, (os.cpu_count() or 1) // jobs)
+        errors = {}
+        skipped = 0
+        with ThreadPoolExecutor(jobs) as pool, \
+                tqdm(total=len(tasks), ncols=100, unit='loc') as progress:
+            running = { pool.submit(self.backup_location, dst, game, loc, threads, policy, 
+                trim_min, trim_max, keep, force): (game, loc) for game, loc in tasks }
+            for job in as_completed(running):
+                game, loc = running[job]
+                try: skipped += not job.result()
+                except Exception as e:
+                    errors[game, loc.path] = e
+                    logging.error("Could not backup '{}' from '{}': {}".format(game, 
+                        loc.path, e))
+                progress.set_postfix_str(game)
+                progress.update()
+        if skipped: logging.info('Skipped {} unchanged locations'.format(skipped))
+        if errors: 
+            logging.error('{} of {} locations could not be backed up'.format(len(errors), 
+                len(tasks)))
+        return errors
+
+    def backup_location(self, dst, game, loc, threads=None, policy=None, trim_min=None, 
+            trim_max=None, keep=None, force=False):
+        """Backs up location LOC of GAME to DST, returning False if skipped as 
+           nothing changed since the last backup
+        """
+        # Append count if more than one directory found
+        dirhash = hashlib.sha1(loc.path.encode()).hexdigest()
+        name = '{}_{}.savman.vbak'.format(game, dirhash.upper()[:6]) 
+        path = os.path.realpath(os.path.join(dst, name))     # As load_backups finds it
+        # Archive is only opened if the location or archive changed since last time 
+        fingerprint = loc.fingerprint()
+        if not force and self.fingerprints.get(path) == [fingerprint] + archivestat(path):
+            metrics.count('gameman.locations_skipped')
+            return False
+
+        with metrics.span('gameman.backup_game/{}'.format(game)):
+            backup = Backup(file=path, id=game)
+            backup.progress = False         # Progress is shown for all locations instead
+            if policy: backup.policy = policy
+            backup.build(src=loc.path, include=loc.include,
+                exclude=loc.exclude)
+            backup.save(threads=threads)
+            if keep: backup.retain(keep)
+            elif trim_min and trim_max: backup.autotrim(trim_min, trim_max)
+        self.fingerprints[path] = [fingerprint] + archivestat(path)
+        if os.path.isfile(path): self.catalog_entry(path)
+        metrics.count('gameman.locations_backed_up')
+        return True
 
     def load_backups(self, location):
         self.backups = {}
@@ -187,13 +261,29 @@ class GameMan:
             path = os.path.realpath(os.path.join(location, item))
             if os.path.isfile(path):
                 if fnmatch.fnmatch(item, '*.savman.vbak'):
-                    backup = Backup(path)
-                    if backup.id in self.db['games']:
-                        if not backup in self.backups: self.backups[backup.id] = [path]
-                        else:  self.backups[backup.id].append(path)
+                    entry = self.catalog_entry(path)
+                    if entry['id'] in self.db['games']:
+                        self.backups.setdefault(entry['id'], []).append(path)
         logging.info("Loaded {} backups from '{}'".format(len(self.backups), location))
 
-    def restore_backup(self, game_id, dst, source=None):
+    def catalog_entry(self, path):
+        """Returns details of backup at PATH from the catalog, only reading the 
+           archive's index when its size or modification time changed
+        """
+        size, mtime = archivestat(path)
+        entry = self.catalog.get(path)
+        if entry and [entry['size'], entry['mtime']] == [size, mtime]:
+            metrics.count('gameman.catalog.hits')
+            return entry
+        metrics.count('gameman.catalog.misses')
+        backup = Backup(path)
+        entry = self.catalog[path] = { 'size': size, 'mtime': mtime, 'id': backup.id, 
+            'src': backup.src, 'versions': len(backup.versions), 
+            'latest': backup.lastver.time if backup.versions else None }
+        return entry
+
+    def restore_backup(self, game_id, dst, source=None, include=None, exclude=None, 
+            threads=None, incremental=None, delete=False):
         try: backups = self.backups[game_id]
         except KeyError:
              raise InvalidIdError("No backup found for game")
@@ -202,9 +292,11 @@ class GameMan:
                 raise TypeError('Source location required as backup has multiple locations')
         else: 
             backup = Backup(backups[0])
-            backup.restore(dst)
+            backup.restore(dst, include=include, exclude=exclude, threads=threads,
+                incremental=incremental, delete=delete)
 
-    def restore_game(self, game_id, dst=None, source=None, target=None):
+    def restore_game(self, game_id, dst=None, source=None, target=None, include=None, 
+            exclude=None, threads=None, incremental=None, delete=False):
         gid = next((g for g in self.games if g.lower() == game_id.lower()), game_id)
         try: game = self.games[gid]
         except KeyError: 
@@ -213,9 +305,16 @@ class GameMan:
             if not target: 
                 raise TypeError('Target location required as game has multiple locations')
         else: 
-            if dst: self.restore_backup(gid, dst, source)
-            else: self.restore_backup(gid, game.locations[0].path, source)       
+            if not dst: dst = game.locations[0].path
+            self.restore_backup(gid, dst, source, include, exclude, threads, incremental, 
+                delete)
+
 
+def archivestat(path):
+    """Returns [size, modification time] of archive at PATH, or [] if missing"""
+    try: stat = os.stat(path)
+    except OSError: return []
+    return [stat.st_size, stat.st_mtime_ns]
 
 def autoid(name):
     wlist = []
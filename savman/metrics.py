@@ -0,0 +1,99 @@
+'''Timed spans and counters collected while savman runs.
+
+Spans time a named phase each time it runs, counters add up amounts such as
+files or bytes. Both are kept in one collector for the whole process and can
+be updated from any thread. Counters named '<name>.hits' and '<name>.misses'
+are also reported as a hit rate.
+'''
+import json
+import functools
+import time
+import threading
+from contextlib import contextmanager
+
+
+class Metrics:
+    def __init__(self):
+        self.spans = {}         # Keys: span name, values: [times run, total seconds]
+        self.counters = {}      # Keys: counter name, values: total
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name):
+        """Times code run in context as span NAME"""
+        start = time.perf_counter()
+        try: yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                span = self.spans.setdefault(name, [0, 0.0])
+                span[0] += 1
+                span[1] += elapsed
+
+    def timed(self, name):
+        """Decorator timing each call of function as span NAME"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name): return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, amount = 1):
+        """Adds AMOUNT to counter NAME"""
+        with self.lock: self.counters[name] = self.counters.get(name, 0) + amount
+
+    def reset(self):
+        with self.lock:
+            self.spans.clear()
+            self.counters.clear()
+
+    def rates(self, counters):
+        """Returns hit rate of each pair of hits and misses in COUNTERS"""
+        rates = {}
+        for name, hits in counters.items():
+            if not name.endswith('.hits'): continue
+            base = name[:-len('.hits')]
+            total = hits + counters.get(base + '.misses', 0)
+            if total: rates[base] = hits/total
+        return rates
+
+    def summary(self):
+        """Returns spans, counters and hit rates as a dict that can be saved as JSON"""
+        with self.lock:
+            spans = { name: {'count': count, 'seconds': round(seconds, 6)}
+                for name, (count, seconds) in self.spans.items() }
+            counters = dict(self.counters)
+        return { 'spans': spans, 'counters': counters, 'rates': self.rates(counters) }
+
+    def report(self):
+        """Returns summary as lines of text"""
+        summary = self.summary()
+        names = list(summary['spans']) + list(summary['counters']) + \
+            [ n + ' hit rate' for n in summary['rates'] ]
+        width = max([ len(n) for n in names ] + [4])
+        lines = []
+        if summary['spans']:
+            lines.append('{}  {:>6}  {:>10}'.format('Span'.ljust(width), 'Runs', 'Seconds'))
+            for name, span in sorted(summary['spans'].items()):
+                lines.append('{}  {:>6}  {:>10.3f}'.format(name.ljust(width), span['count'],
+                    span['seconds']))
+        if summary['counters']:
+            if lines: lines.append('')
+            lines.append('{}  {:>18}'.format('Counter'.ljust(width), 'Total'))
+            for name, total in sorted(summary['counters'].items()):
+                lines.append('{}  {:>18}'.format(name.ljust(width), total))
+            for name, rate in sorted(summary['rates'].items()):
+                lines.append('{}  {:>17.1f}%'.format((name + ' hit rate').ljust(width), rate*100))
+        return lines
+
+    def save(self, file):
+        """Writes summary to FILE as JSON"""
+        with open(file, 'w') as f:
+            json.dump(self.summary(), f, indent=4, sort_keys=True)
+
+
+collector = Metrics()       # Collector used throughout savman
+span = collector.span
+timed = collector.timed
+count = collector.count
@@ -0,0 +1,127 @@
+'''Scanning a directory tree for files matching include and exclude patterns.
+
+Patterns use fnmatch syntax against paths relative to the scanned directory.
+Each list is compiled once into a single regular expression for matching
+files. Include patterns are also compiled into token lists, which are run
+as an NFA over the path of each directory as it is entered. When no pattern
+can still match anything under a directory, the scanner skips it, so the
+decision to prune a directory is exact rather than a guess.
+'''
+import os
+import re
+import fnmatch
+
+STAR = '*'          # Tokens of compiled patterns, other than literal
+ANY = '?'           # characters and compiled regexes for sets
+
+
+def compile_patterns(patterns):
+    """Returns single regex matching any of PATTERNS, or None if there are none"""
+    if not patterns: return None
+    return re.compile('|'.join(fnmatch.translate(os.path.normcase(p)) for p in patterns))
+
+def tokenize(pattern):
+    """Splits fnmatch pattern into tokens, as fnmatch.translate reads it"""
+    tokens = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            if not tokens or tokens[-1] is not STAR: tokens.append(STAR)
+        elif c == '?': tokens.append(ANY)
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] == '!': j += 1
+            if j < n and pattern[j] == ']': j += 1
+            while j < n and pattern[j] != ']': j += 1
+            if j >= n: tokens.append(c)
+            else:
+                tokens.append(re.compile(fnmatch.translate(pattern[i-1:j+1])))
+                i = j + 1
+        else: tokens.append(c)
+    return tokens
+
+def closure(tokens, states):
+    """Adds states reached by stars matching nothing"""
+    found = set()
+    for i in states:
+        found.add(i)
+        while i < len(tokens) and tokens[i] is STAR:
+            i += 1
+            found.add(i)
+    return found
+
+def advance(tokens, states, text):
+    """Returns states of pattern TOKENS after reading TEXT"""
+    for char in text:
+        if not states: break
+        nextstates = []
+        for i in states:
+            if i == len(tokens): continue
+            token = tokens[i]
+            if token is STAR: nextstates.append(i)
+            elif token is ANY: nextstates.append(i + 1)
+            elif isinstance(token, str):
+                if token == char: nextstates.append(i + 1)
+            elif token.match(char): nextstates.append(i + 1)
+        states = closure(tokens, nextstates)
+    return states
+
+
+class PathMatcher:
+    """Decides which files and directories are scanned, given lists of
+       INCLUDE and EXCLUDE patterns. Excluding a directory excludes
+       everything in it.
+    """
+    def __init__(self, include=None, exclude=None):
+        self.include = compile_patterns(include)
+        self.exclude = compile_patterns(exclude)
+        self.tokens = None
+        if include: self.tokens = [ tokenize(os.path.normcase(p)) for p in include ]
+
+    def match(self, path):
+        """Checks whether file at relative PATH is included and not excluded"""
+        path = os.path.normcase(path)
+        if self.include and not self.include.match(path): return False
+        return not (self.exclude and self.exclude.match(path))
+
+    def root(self):
+        """Returns state of the scanned directory itself"""
+        if self.tokens is None: return ()
+        return tuple(closure(tokens, [0]) for tokens in self.tokens)
+
+    def enter(self, state, path):
+        """Returns state of directory at relative PATH from STATE of the directory
+           containing it, or None if nothing in it can be matched
+        """
+        if self.exclude and self.exclude.match(os.path.normcase(path)): return None
+        if self.tokens is None: return state
+        name = os.path.normcase(os.path.basename(path)) + os.sep
+        state = tuple(advance(t, s, name) for t, s in zip(self.tokens, state))
+        # Some pattern must still need more characters than the path so far
+        if not any(i < len(t) for t, s in zip(self.tokens, state) for i in s): return None
+        return state
+
+
+def scan(root, matcher):
+    """Yields (relative path, DirEntry) for each file under ROOT matched by
+       MATCHER. Files in a directory come before the directories inside it,
+       and symbolic links to directories aren't followed, as with os.walk.
+    """
+    stack = [(root, '', matcher.root())]
+    while stack:
+        path, rel, state = stack.pop()
+        dirs = []
+        try: entries = list(os.scandir(path))
+        except OSError: continue
+        for entry in entries:
+            erel = os.path.join(rel, entry.name) if rel else entry.name
+            try: isdir = entry.is_dir()
+            except OSError: isdir = False
+            if isdir:
+                if entry.is_symlink(): continue
+                dstate = matcher.enter(state, erel)
+                if dstate is not None: dirs.append((entry.path, erel, dstate))
+            elif matcher.match(erel): yield erel, entry
+        stack.extend(reversed(dirs))
@@ -0,0 +1,71 @@
+'''Choosing which versions of a backup to keep as it ages.
+
+A policy is a list of rules, each keeping versions at some spacing up to some
+age, for example all versions from the last day, one a day for a week and one
+a week for a month ('all:1d,daily:7d,weekly:30d'). Ages are measured back from
+the newest version, so a backup that stops changing keeps its history.
+
+Versions are grouped by calendar period in local time (hours, days, weeks
+starting on a Monday and so on), and the newest version of each period is
+kept. The versions a rule keeps are the same each time it is applied, so the
+history only thins out as it ages.
+'''
+import re
+import time
+from collections import namedtuple
+
+UNITS = { 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7*86400 }
+INTERVALS = { 'all': 0, 'hourly': 3600, 'daily': 86400, 'weekly': 7*86400,
+    'monthly': 30*86400 }
+DURATION_RE = re.compile(r'(\d+)([smhdw])$')
+PERIOD_SHIFT = 3*86400      # 1970-01-01 was a Thursday, so weeks start on Monday
+
+Rule = namedtuple('Rule', 'interval age')   # Keep a version every INTERVAL seconds (0 for
+                                            # every version), while up to AGE seconds old
+
+def duration(text):
+    """Returns seconds in duration TEXT, such as '90m', '12h', '7d' or '4w'"""
+    match = DURATION_RE.match(text.strip().lower())
+    if not match: raise ValueError("Invalid duration '{}'".format(text))
+    return int(match.group(1))*UNITS[match.group(2)]
+
+def parse(text):
+    """Returns rules of policy TEXT, a comma separated list of <interval>:<age>.
+       Intervals are 'all', 'hourly', 'daily', 'weekly', 'monthly' or a duration.
+       Raises ValueError if TEXT isn't a valid policy.
+    """
+    rules = []
+    for part in text.split(','):
+        interval, sep, age = part.partition(':')
+        interval = interval.strip().lower()
+        if not sep or not interval:
+            raise ValueError("Invalid retention rule '{}', expected <interval>:<age>".format(part))
+        interval = INTERVALS[interval] if interval in INTERVALS else duration(interval)
+        if interval < 0: raise ValueError("Invalid interval in rule '{}'".format(part))
+        rules.append(Rule(interval, duration(age)))
+    return sorted(rules, key=lambda r: r.age)
+
+def period(t, interval):
+    """Returns number of the calendar period of length INTERVAL that time T is in"""
+    return int((t + time.localtime(t).tm_gmtoff + PERIOD_SHIFT) // interval)
+
+def select(versions, rules):
+    """Returns VERSIONS (anything with a time attribute) kept under RULES, oldest
+       first. The newest version is always kept.
+    """
+    versions = sorted(versions, key=lambda v: v.time)
+    if not versions: return []
+    intervals = { r.interval for r in rules if r.interval }
+    newest = versions[-1].time
+    kept = []
+    periods = set()     # (interval, period) of each version kept, for each spaced rule
+    for version in reversed(versions):
+        age = newest - version.time
+        rule = next((r for r in rules if age <= r.age), None)
+        if rule is None and kept: break     # Older than every rule covers
+        # Newer versions are seen first, so only the newest of each period is kept
+        if rule and rule.interval and (rule.interval, 
+                period(version.time, rule.interval)) in periods: continue
+        periods.update((i, period(version.time, i)) for i in intervals)
+        kept.append(version)
+    return kept[::-1]
@@ -2,25 +2,55 @@
 
 Usage:
   vbackup info <file>
-  vbackup build <directory> <file>
-  vbackup restore [--ver=<id>|--num=<num>] <directory> <file>
+  vbackup build [--chunked|--deltas] [--max-chain=<num>] [--check=<mode>] 
+                [--policy=<name>] [--threads=<num>] [--read-ahead=<mb>] <directory> <file>
+  vbackup restore [--ver=<id>|--num=<num>] [--include=<path>...] [--exclude=<path>...]
+                  [--threads=<num>] [--incremental [--check=<mode>]] [--delete] 
+                  <directory> <file>
   vbackup trim [--output=<file>] <num> <file>
+  vbackup trim [--output=<file>] --keep=<policy> <file>
+  vbackup verify [--threads=<num>] <file>
   vbackup -h | --help
   
 Commands:
   info              Show information about backup
   build             Build backup from directory
   restore           Restore backup to directory
-  trim              Trim backup to <num> versions
+  trim              Trim backup to <num> versions, or to those kept by a policy
+  verify            Check backup can be restored, without writing any files
 
 Options:
   -h --help         Display this screen 
   --ver=<id>        Version ID to restore
   --num=<num>       Version number to restore
   --output=<file>   Save trimmed backup to separate file
+  --keep=<policy>   Versions kept as they age, as <interval>:<age> rules, such
+                    as 'all:1d,daily:7d,weekly:30d' (all versions from the last
+                    day, the last of each day for a week and of each week for 
+                    a month)
+  --include=<path>  Only restore files matching path or pattern
+  --exclude=<path>  Don't restore files matching path or pattern
+  --chunked         Store files as chunks, saving only the parts that changed
+  --deltas          Keep older copies of large files as deltas against the next
+                    version, so only the newest copy is stored whole. Space
+                    taken by replaced copies is freed when the backup is trimmed
+  --max-chain=<num> Most deltas applied to rebuild a file (default: 8)
+  --check=<mode>    How changed files are found: 'stat' (modification time and
+                    size), 'hash' (confirm with digest of contents) or 'sampled'
+                    (as hash, but check sampled blocks of large files first)
+  --incremental     Only write files that differ from those already in <directory>
+  --delete          Remove files from <directory> that aren't in the version
+  --policy=<name>   How files are compressed: 'fast', 'balanced' or 'smallest'.
+                    Files that look already compressed are stored as they are
+  --threads=<num>   Number of threads used to compress, restore or verify files 
+                    (default: one per CPU)
+  --read-ahead=<mb> Most data read from files ahead of being compressed, 0 to 
+                    read each file only when it is compressed (default: 64)
 '''
 import os
+import re
 import sys
+import shutil
 import tarfile
 import fnmatch
 import json
@@ -28,21 +58,365 @@ import logging
 import time
 import tempfile
 import zipfile
+import gzip
+import hashlib
+import zlib
+import io
+import itertools
 from tqdm import tqdm
 from collections import OrderedDict
+from collections.abc import MutableMapping
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
 from docopt import docopt
+from savman import chunking, compression, delta, metrics, pathmatch, retention, ziptools
+try: import mmap
+except ImportError: mmap = None
 
 logger = logging.getLogger('backup')
 
-def taraddstr(tarobj, arcname, string):
+STORE_FILES = 'files'               # Store each new or changed file whole
+STORE_CHUNKS = 'chunks'             # Store content-defined chunks, each only once per archive
+STORE_DELTAS = 'deltas'             # Store files whole, replacing older copies of large files
+                                    # with deltas against the following version
+
+DELTA_MIN = 1024*1024               # Smallest file kept as a delta
+DELTA_MAXCHAIN = 8                  # Most deltas applied to rebuild a file (by default)
+DELTA_MAXRATIO = 0.5                # Largest delta kept, as a fraction of the file's size
+DELTA_NAME = 'deltas:/{}'           # Data zip name of delta for file, colon can't be in 
+                                    # the name of a file backed up from Windows
+
+VERSION_INFO = 'versions/{}/version.json'   # Archive name of version info, by version id
+VERSION_DATA = 'versions/{}/data.zip'       # Archive name of version data, by version id
+REWRITE_NAME = '{}.{}'              # Archive name of member rewritten by a later save, by
+                                    # its usual name and the id of that save's version
+
+CHECK_STAT = 'stat'                 # File changed if modification time or size differs
+CHECK_HASH = 'hash'                 # Confirm changes by comparing digest of file contents
+CHECK_SAMPLED = 'sampled'           # As above, but rule out large files by sampled blocks first
+
+SAMPLE_MIN = 64*1024*1024           # Files this size and above get a sampled digest
+SAMPLE_BLOCKS = 16                  # Number of blocks read for sampled digest
+SAMPLE_BLOCKSIZE = 64*1024
+HASH_BLOCKSIZE = 1024*1024
+
+FILETABLE_DEPTH = 16                # Most file tables looked through to find an entry
+
+RESTORE_JOBSIZE = 32*1024*1024     # Compressed bytes restored from a version by each job
+COPY_BLOCKSIZE = 4*1024*1024        # Buffer size when members can't be copied by the kernel
+VERIFY_BLOCKSIZE = 1024*1024        # Size of reads when checking members
+
+INDEX_NAME = 'index.json'           # Archive name of the consolidated index
+INDEX_FORMAT = 2                    # Highest index format this module understands
+                                    # (2: version.json may list changes from parent)
+MANIFEST_CHECKPOINT = 16            # Versions between full file lists in version.json
+INDEX_FOOTER = '\n#vbak-index {:016x} {:016x}\n'   # Ends index data, holds length of index
+                                                    # JSON and offset of index member header
+INDEX_FOOTER_RE = re.compile(rb'\n#vbak-index ([0-9a-f]{16}) ([0-9a-f]{16})\n$')
+INDEX_FOOTER_LEN = len(INDEX_FOOTER.format(0, 0))
+
+def taraddstr(tarobj, arcname, string, members=None):
     """Saves a string as a file in specified tar archive"""
     with tempfile.TemporaryFile() as temp:
         temp.write(string.encode())
         temp.seek(0)
         tinfo = tarobj.gettarinfo(arcname=arcname, fileobj=temp)
-        tarobj.addfile(tinfo, temp)
+        taraddfile(tarobj, tinfo, temp, members)
+
+def taraddfile(tarobj, tinfo, fileobj=None, members=None):
+    """Adds a member to tar archive, recording its location in MEMBERS if given"""
+    offset = tarobj.offset
+    tarobj.addfile(tinfo, fileobj)
+    if members is not None:
+        blocks = -(-tinfo.size // tarfile.BLOCKSIZE)
+        members[tinfo.name] = [offset, tarobj.offset - blocks*tarfile.BLOCKSIZE, tinfo.size]
+
+def copyrange(src, dst, offset, size):
+    """Copies SIZE bytes from OFFSET in file SRC to the current position of file
+       DST. The kernel copies the data where it can, so it never passes through 
+       Python, otherwise it is read into a reused buffer.
+    """
+    dst.flush()
+    start = dst.tell()
+    srcfd, dstfd = src.fileno(), dst.fileno()
+    def copy_file_range(pos, count):
+        return os.copy_file_range(srcfd, dstfd, count, offset + pos, start + pos)
+    def sendfile(pos, count):
+        os.lseek(dstfd, start + pos, os.SEEK_SET)
+        return os.sendfile(dstfd, srcfd, offset + pos, count)
+
+    copied = 0
+    copiers = [ c for c, name in ((copy_file_range, 'copy_file_range'), (sendfile, 'sendfile')) 
+        if hasattr(os, name) ]
+    for copier in copiers:
+        try:
+            while copied < size:
+                count = copier(copied, size - copied)
+                if not count: break
+                copied += count
+            break
+        except OSError: continue     # Not supported for these files, try the next way
+
+    dst.seek(start + copied)
+    if copied < size:
+        src.seek(offset + copied)
+        buf = bytearray(min(COPY_BLOCKSIZE, size - copied))
+        view = memoryview(buf)
+        while copied < size:
+            count = src.readinto(view[:min(len(buf), size - copied)])
+            if not count: break
+            dst.write(view[:count])
+            copied += count
+    if copied < size: raise OSError('unexpected end of data')
+
+def taraddrange(tarobj, tinfo, fileobj, members=None):
+    """Adds member to tar archive by copying its data as raw bytes from 
+       FILEOBJ, the archive TINFO was read from.
+    """
+    offset = tarobj.offset
+    tarobj.fileobj.write(tinfo.tobuf(tarobj.format, tarobj.encoding, tarobj.errors))
+    start = tarobj.fileobj.tell()
+    copyrange(fileobj, tarobj.fileobj, tinfo.offset_data, tinfo.size)
+    blocks, remainder = divmod(tinfo.size, tarfile.BLOCKSIZE)
+    if remainder:
+        tarobj.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        blocks += 1
+    tarobj.offset = start + blocks*tarfile.BLOCKSIZE
+    tarobj.members.append(tinfo)
+    if members is not None: members[tinfo.name] = [offset, start, tinfo.size]
+
+class TarMemberWriter:
+    """File object for writing the data of a tar member in place. Offsets
+       are relative to the start of the member data.
+    """
+    def __init__(self, fileobj, start):
+        self.fileobj = fileobj
+        self.start = start
+        self.size = 0           # Furthest position written to
+
+    def write(self, data):
+        written = self.fileobj.write(data)
+        self.size = max(self.size, self.tell())
+        return written
+
+    def tell(self):
+        return self.fileobj.tell() - self.start
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET: self.fileobj.seek(self.start + offset)
+        elif whence == os.SEEK_CUR: self.fileobj.seek(offset, os.SEEK_CUR)
+        else: self.fileobj.seek(self.start + self.size + offset)
+        return self.tell()
+
+    def seekable(self):
+        return True
+
+    def flush(self):
+        self.fileobj.flush()
+
+@contextmanager
+def taraddstream(tarobj, arcname, members=None):
+    """Adds member to tar archive, yielding a file object to write its data to.
+       Data goes straight into the archive and the header is filled in with 
+       its size afterwards, so nothing is held in memory or a temp file.
+    """
+    tinfo = tarfile.TarInfo(arcname)
+    tinfo.mtime = int(time.time())
+    tinfo.mode = 0o644
+    # GNU headers stay the same length whatever the size, so can be replaced 
+    header = tinfo.tobuf(tarfile.GNU_FORMAT, tarobj.encoding, tarobj.errors)
+    offset = tarobj.offset
+    fileobj = tarobj.fileobj
+    fileobj.write(header)
+    stream = TarMemberWriter(fileobj, offset + len(header))
+    yield stream
+
+    tinfo.size = stream.size
+    fileobj.seek(offset)
+    fileobj.write(tinfo.tobuf(tarfile.GNU_FORMAT, tarobj.encoding, tarobj.errors))
+    blocks, remainder = divmod(stream.size, tarfile.BLOCKSIZE)
+    fileobj.seek(stream.start + stream.size)
+    if remainder: 
+        fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        blocks += 1
+    tarobj.offset = stream.start + blocks*tarfile.BLOCKSIZE
+    tarobj.members.append(tinfo)
+    if members is not None: members[arcname] = [offset, stream.start, stream.size]
+
+def taraddindex(tarobj, index):
+    """Appends index as the final member of the tar archive. The footer at the
+       end of the index data lets readers find it by seeking from the end of file.
+    """
+    body = json.dumps(index, sort_keys=True)
+    offset = tarobj.offset
+    taraddstr(tarobj, INDEX_NAME, body + INDEX_FOOTER.format(len(body.encode()), offset))
+
+def readindex(fileobj):
+    """Returns (index, append offset) of archive, or None if it has no index"""
+    fileobj.seek(0, os.SEEK_END)
+    filesize = fileobj.tell()
+    # End of archive is at most two zero blocks plus a record of padding
+    taillen = min(filesize, tarfile.RECORDSIZE + 4*tarfile.BLOCKSIZE)
+    fileobj.seek(filesize - taillen)
+    tail = fileobj.read(taillen).rstrip(tarfile.NUL)
+    match = INDEX_FOOTER_RE.search(tail[-INDEX_FOOTER_LEN:])
+    if not match: return None
+
+    length, offset = int(match.group(1), 16), int(match.group(2), 16)
+    dataend = filesize - taillen + len(tail)
+    start = dataend - INDEX_FOOTER_LEN - length
+    if not tarfile.BLOCKSIZE <= start - offset <= 4*tarfile.BLOCKSIZE: return None
+    fileobj.seek(start)
+    try: index = json.loads(fileobj.read(length).decode())
+    except ValueError: return None
+    if index.get('format', 0) > INDEX_FORMAT: return None
+
+    # New members are written over the old index, as the next save replaces it
+    return index, offset
+
+def matchpath(name, include=None, exclude=None):
+    """Checks whether archive name matches any INCLUDE pattern and no EXCLUDE 
+       pattern. A pattern also matches everything in the directory it names.
+    """
+    def matches(patterns):
+        for pattern in patterns:
+            pattern = pattern.replace('\\', '/').rstrip('/')
+            if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(name, pattern + '/*'): return True
+        return False
+    if include and not matches(include): return False
+    return not (exclude and matches(exclude))
+
+def restore_jobs(zips, extractlist, order):
+    """Splits members to extract into jobs of (version id, member names), each 
+       reading a run of neighbouring members from one version.
+    """
+    jobs = []
+    for ver in order:
+        zipobj = zips[ver]
+        infos = sorted((zipobj.getinfo(n) for n in extractlist[ver]), key=lambda i: i.header_offset)
+        names, size = [], 0
+        for info in infos:
+            names.append(info.filename)
+            size += info.compress_size
+            if size >= RESTORE_JOBSIZE:
+                jobs.append((ver, names))
+                names, size = [], 0
+        if names: jobs.append((ver, names))
+    return jobs
+
+def scanmembers(tarobj):
+    """Returns locations of all members by walking every header in tar archive"""
+    return { m.name: [m.offset, m.offset_data, m.size] for m in tarobj.getmembers() }
+
+def scanversions(tarobj, members):
+    """Returns versions (without file lists) by reading every version.json in archive"""
+    versions = []
+    pos = tarobj.fileobj.tell()
+    for path in fnmatch.filter(members, "versions/*/version.json"):
+        offset, offset_data, size = members[path]
+        tarobj.fileobj.seek(offset_data)
+        verinfo = json.loads(tarobj.fileobj.read(size).decode())
+        count = len(verinfo['files']) if 'files' in verinfo else verinfo['count']
+        summary = dict(verinfo, info=path, files=count,
+            data='{}/{}'.format(os.path.split(path)[0], 'data.zip'))
+        versions.append(BackupVersion.from_summary(summary))
+    tarobj.fileobj.seek(pos)
+    return versions
+
+@contextmanager
+def openappend(file):
+    """Opens tar archive for appending, yielding (tar object, index). Indexed 
+       archives are appended to directly, otherwise the archive is scanned
+       for its end and index is None.
+    """
+    index = None
+    if os.path.isfile(file):
+        with open(file, 'rb') as f: index = readindex(f)
+    if not index:
+        with tarfile.open(file, 'a') as t: yield t, None
+        return
+
+    index, end = index
+    with open(file, 'r+b') as f:
+        f.seek(end)
+        try:
+            with tarfile.open(fileobj=f, mode='w') as t: yield t, index
+        except BaseException:
+            # Put back the index that new members were being written over
+            f.seek(end)
+            f.truncate()
+            with tarfile.open(fileobj=f, mode='w') as t: taraddindex(t, index)
+            raise
+        f.truncate()
+
+def filedigest(path):
+    """Returns digest of file contents"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCKSIZE), b''): digest.update(block)
+    return digest.hexdigest()
+
+def filecrc(path):
+    """Returns CRC-32 of file contents, as stored in zip archives"""
+    crc = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCKSIZE), b''): crc = zlib.crc32(block, crc)
+    return crc
+
+def sampledigest(path, size):
+    """Returns digest of blocks spread evenly through file"""
+    digest = hashlib.sha1(str(size).encode())
+    step = max(size - SAMPLE_BLOCKSIZE, 0) // (SAMPLE_BLOCKS - 1)
+    with open(path, 'rb') as f:
+        for i in range(SAMPLE_BLOCKS):
+            f.seek(i*step)
+            digest.update(f.read(SAMPLE_BLOCKSIZE))
+    return digest.hexdigest()
+
+class DigestCache:
+    """Persistent cache of file digests, keyed by path, size, modification time 
+       and inode so that unchanged files don't need to be read again.
+    """
+    def __init__(self, file=None):
+        self.file = file
+        self.digests = {}           # Keys: file paths, Values: [size, mod, inode, digest]
+        self.seen = set()           # Paths looked up or added since loading
+        self.modified = False
+        if file and os.path.isfile(file): self.load()
+
+    def load(self):
+        try:
+            with gzip.open(self.file, 'rt') as cfile: self.digests = json.load(cfile)
+        except (OSError, ValueError):
+            logging.warning("Could not load digest cache '{}'".format(self.file))
+
+    def save(self):
+        """Saves cache, dropping files that weren't seen since it was loaded"""
+        digests = { p: d for p, d in self.digests.items() if p in self.seen }
+        if not self.file or (not self.modified and len(digests) == len(self.digests)): return
+        with gzip.open(self.file, 'wt') as cfile: json.dump(digests, cfile)
+        self.digests = digests
+        self.modified = False
 
-def _copyfileobj(src, dst, length=None, exception=OSError):
+    def get(self, path, stat):
+        self.seen.add(path)
+        entry = self.digests.get(path)
+        if entry and entry[:3] == [stat.st_size, stat.st_mtime, stat.st_ino]: return entry[3]
+
+    def add(self, path, stat, digest):
+        self.seen.add(path)
+        self.digests[path] = [stat.st_size, stat.st_mtime, stat.st_ino, digest]
+        self.modified = True
+
+    def digest(self, path, stat):
+        """Returns digest of file, reading it only if not in cache"""
+        digest = self.get(path, stat)
+        if not digest:
+            digest = filedigest(path)
+            self.add(path, stat, digest)
+        return digest
+
+def _copyfileobj(src, dst, length=None, exception=OSError, bufsize=None):
     """Copy length bytes from fileobj src to fileobj dst.
        If length is None, copy the entire content.
     """
@@ -70,6 +444,120 @@ def _copyfileobj(src, dst, length=None, exception=OSError):
 
 tarfile.copyfileobj = _copyfileobj      # Increased copy buffer size
 
+class MemoryFile(io.RawIOBase):
+    """Read-only file object over memoryview VIEW, such as a slice of a memory 
+       mapped archive. Only the bytes asked for are copied out of it.
+    """
+    def __init__(self, view):
+        self.view = view
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR: offset += self.pos
+        elif whence == os.SEEK_END: offset += len(self.view)
+        if offset < 0: raise OSError('Negative seek position {}'.format(offset))
+        self.pos = offset
+        return offset
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        end = len(self.view) if size is None or size < 0 else self.pos + size
+        data = self.view[self.pos:end].tobytes()
+        self.pos += len(data)
+        return data
+
+    def readinto(self, buf):
+        data = self.view[self.pos:self.pos + len(buf)]
+        buf[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def close(self):
+        self.view.release()
+        super().close()
+
+
+class FileTable(MutableMapping):
+    """Mapping of file names to BackupFile objects that only holds entries which
+       differ from those of its BASE table, so versions loaded one after another
+       share the entries that didn't change. Tables more than FILETABLE_DEPTH 
+       deep copy their base's entries instead, to keep lookups short.
+    """
+    __slots__ = ('base', 'changes', 'removed', 'depth', 'size')
+
+    def __init__(self, base = None):
+        self.changes = {}           # Entries added or changed since base
+        self.removed = set()        # Names of base entries not in this table
+        if base is not None and base.depth >= FILETABLE_DEPTH: 
+            self.changes = dict(base.items())
+            base = None
+        self.base = base
+        self.depth = base.depth + 1 if base is not None else 0
+        self.size = len(base) if base is not None else len(self.changes)
+
+    def __getitem__(self, name):
+        table = self
+        while table is not None:
+            if name in table.changes: return table.changes[name]
+            if name in table.removed: break
+            table = table.base
+        raise KeyError(name)
+
+    def __setitem__(self, name, file):
+        if not name in self: self.size += 1
+        self.changes[name] = file
+        self.removed.discard(name)
+
+    def __delitem__(self, name):
+        if not name in self: raise KeyError(name)
+        self.changes.pop(name, None)
+        if self.base is not None and name in self.base: self.removed.add(name)
+        self.size -= 1
+
+    def __iter__(self):
+        for name, file in self.items(): yield name
+
+    def __len__(self):
+        return self.size
+
+    def items(self):
+        if self.base is not None:
+            for name, file in self.base.items():
+                if not (name in self.changes or name in self.removed): yield name, file
+        yield from self.changes.items()
+
+    def values(self):
+        for name, file in self.items(): yield file
+
+def changedfiles(parent, files):
+    """Returns changes and removed entries of version.json for file list FILES, 
+       compared to file list PARENT (both as in version.json)
+    """
+    changes = { n: info for n, info in files.items() if parent.get(n) != info }
+    return changes, [ n for n in parent if not n in files ]
+
+def filetable(files, base = None):
+    """Returns FileTable holding FILES from version.json, sharing entries that 
+       are the same as in BASE
+    """
+    if not isinstance(base, FileTable): base = None
+    table = FileTable(base)
+    if base is not None:
+        for name in [ n for n in base if not n in files ]: del table[name]
+    for name, info in files.items():
+        existing = base.get(name) if base is not None else None
+        if existing is None or existing.build_info() != info:
+            table[name] = BackupFile.from_info(name, info)
+    return table
+
 class BackupVersion():
     def __init__(self, id = None, time = 0, size = 0, sizedelta = 0):
         self.id = id
@@ -78,35 +566,115 @@ class BackupVersion():
         self.size = size
         self.sizedelta = sizedelta      # Difference between version and last version
         self.files = {}                 # Keys are file names, values are BackupFile objects
+        self.loader = None              # Function returning file list, if not loaded yet
+        self.parent = None              # Version file list is stored as changes from
+        self.depth = 0                  # Number of versions since a full file list
         self.info = ''                  # Archive name of version info JSON
         self.data = ''                  # Archive name of version data ZIP
         self.newfiles = 0               # Number of files changed since last version
+        self.filecount = 0              # Number of files (if file list not loaded)
+
+    @property
+    def files(self):
+        if self._files is None: self._files = self.loader(self) if self.loader else {}
+        return self._files
 
-    def build_info(self):
+    @files.setter
+    def files(self, files):
+        self._files = files
+
+    @property
+    def loaded(self):
+        """Whether file list has been loaded"""
+        return self._files is not None
+
+    @classmethod
+    def from_summary(cls, summary, loader = None):
+        """Creates version from archive index summary. File list is left empty, 
+           or loaded by calling LOADER with the version when first used.
+        """
+        version = cls(sys.intern(summary['id']), summary['time'], summary['size'], 
+            summary['sizedelta'])
+        version.filecount = summary['files']
+        version.info = summary['info']
+        version.data = summary['data']
+        if loader:
+            version.files = None
+            version.loader = loader
+        return version
+
+    def summary(self):
+        return { 'id': self.id, 'time': self.time, 'size': self.size,
+            'sizedelta': self.sizedelta, 'files': self.count(), 'info': self.info, 
+            'data': self.data }
+
+    def count(self):
+        """Returns number of files, without loading file list"""
+        return len(self._files) if self._files else self.filecount
+
+    def build_info(self, parent = None):
+        """Returns contents of version.json. With PARENT version, only files 
+           added, changed or removed since then are listed.
+        """
         verinfo = { 'id': self.id, 
                     'time': self.time,
                     'size': self.size,
-                    'sizedelta': self.sizedelta,
-                    'files': {} }
+                    'sizedelta': self.sizedelta }
 
-        for f in self.files.values(): 
-            verinfo['files'][f.name] = { 'mod': f.mod, 'size': f.size,
-                'location': f.location }
+        if parent is None:
+            verinfo['files'] = { f.name: f.build_info() for f in self.files.values() }
+            return verinfo
 
+        changes = {}
+        for name, f in self.files.items():
+            pf = parent.files.get(name)
+            if pf is not f:
+                info = f.build_info()
+                if pf is None or pf.build_info() != info: changes[name] = info
+        verinfo.update(parent=parent.id, depth=self.depth, count=len(self.files), 
+            changes=changes, removed=[ n for n in parent.files if not n in self.files ])
         return verinfo
 
     def set_id(self, id):
         self.id = id
-        self.info = 'versions/{}/version.json'.format(self.id)
-        self.data = 'versions/{}/data.zip'.format(self.id)
+        self.info = VERSION_INFO.format(self.id)
+        self.data = VERSION_DATA.format(self.id)
         
 class BackupFile:
-    def __init__(self, name = '', size = 0, mod = 0, location = None, path = None):
+    __slots__ = ('name', 'size', 'mod', 'location', 'path', 'chunks', 'digest', 'sample', 
+        'codec', 'delta')
+
+    def __init__(self, name = '', size = 0, mod = 0, location = None, path = None, chunks = None,
+            digest = None, sample = None, codec = None, delta = None):
         self.name = name            # Name of file in archive
         self.size = size
         self.mod = mod              # Modification time
         self.location = location    # Version the file is located in
         self.path = path            # Path to file (backup build only)
+        self.chunks = chunks        # List of [chunk id, version located in] if stored as chunks
+        self.digest = digest        # Digest of file contents (if hash checking is used)
+        self.sample = sample        # Digest of sampled blocks (large files only)
+        self.codec = codec          # Name of codec file is compressed with (whole files only)
+        self.delta = delta          # Version file is rebuilt from, if stored as a delta
+
+    @classmethod
+    def from_info(cls, name, info):
+        """Creates file from its entry in version.json"""
+        delta = info.get('delta')
+        return cls(sys.intern(name), info['size'], info['mod'], sys.intern(info['location']), 
+            chunks=info.get('chunks'), digest=info.get('digest'), sample=info.get('sample'), 
+            codec=info.get('codec'), delta=delta and sys.intern(delta))
+
+    def build_info(self, location = None):
+        """Returns entry for version.json, moving it to version LOCATION if given"""
+        info = { 'mod': self.mod, 'size': self.size, 'location': location or self.location }
+        if self.chunks is not None: 
+            info['chunks'] = [[c, location or loc] for c, loc in self.chunks]
+        if self.digest: info['digest'] = self.digest
+        if self.sample: info['sample'] = self.sample
+        if self.codec: info['codec'] = self.codec
+        if self.delta and not location: info['delta'] = self.delta     # Moved files are whole
+        return info
 
 class Backup:
     def __init__(self, file='', id = None):
@@ -114,7 +682,17 @@ class Backup:
         self.src = None                             # Source directory
         self.include = None
         self.exclude = None
+        self.storage = STORE_FILES                  # How new and changed files are saved
+        self.check = CHECK_STAT                     # How changed files are detected
+        self.policy = compression.POLICY_DEFAULT    # How files are compressed
+        self.maxchain = DELTA_MAXCHAIN              # Longest chain of deltas (delta storage only)
+        self.readahead = ziptools.READAHEAD         # Most bytes of files read ahead while 
+                                                    # saving, 0 to read each file when written
+        self.progress = True                        # Show progress bar while saving
+        self.digests = None                         # DigestCache used by hash checking
         self.versions = {}                          # Keys are version IDs, values BackupVersion objects 
+        self.members = {}                           # Keys are archive names, values are
+                                                    # [header offset, data offset, size]
         self.file = os.path.normpath(file)
         self.filename = os.path.basename(file)
         self.curver = BackupVersion()               # Current (working) version
@@ -123,35 +701,137 @@ class Backup:
         if os.path.isfile(file): self.load()
 
     def load(self):
-        with tarfile.open(self.file) as t:
-            verpaths = fnmatch.filter(t.getnames(),"versions/*/version.json")
-
-            for path in verpaths:
-                folder = os.path.split(path)[0]                 # Get version folder
-                verfile = t.extractfile(path)                   # Extract version info.json...
-                verinfo = json.loads(verfile.read().decode())   
-                version = BackupVersion(verinfo['id'], verinfo['time'], 
-                    verinfo['size'], verinfo['sizedelta'])
-                version.info = path                             # Save archive name of version info 
-                version.data = '{}/{}'.format(folder, 'data.zip')   # Save archive name of version data
-
-                for item, data in verinfo['files'].items():
-                    file = BackupFile(item, data['size'], data['mod'], data['location'])
-                    version.files[item] = file
-
+        with open(self.file, 'rb') as f:
+            found = readindex(f)
+        if found: 
+            index = found[0]
+            self.members = index['members']
+            self.load_info(index['info'])
+            # File lists are loaded when first used
+            for summary in index['versions']:
+                version = BackupVersion.from_summary(summary, self.load_files)
                 self.versions[version.id] = version
-
-            info = json.loads( t.extractfile('info.json').read().decode() )     # Get backup info
-            self.id = info['id']
-            self.include = info['include']
-            self.exclude = info['exclude']
-            self.src = info['src']
+        else:
+            # Archive has no index, so scan through every member instead
+            logging.debug("No index found in '{}', scanning archive".format(self.filename))
+            with tarfile.open(self.file) as t:
+                self.members = scanmembers(t)
+                verpaths = fnmatch.filter(self.members, "versions/*/version.json")
+                base = None
+                for path in sorted(verpaths):                       # Version IDs sort by time
+                    folder = os.path.split(path)[0]                 # Get version folder
+                    verinfo = json.loads(self.readmember(t, path).decode())
+                    base = self.load_version(verinfo, path, '{}/{}'.format(folder, 'data.zip'), 
+                        base).files
+                self.load_info(json.loads(self.readmember(t, 'info.json').decode()))
 
         timesort = sorted(self.versions.values(), key=lambda v: v.time)
         for idx, version in enumerate(timesort): version.num = idx+1
         latest = timesort[-1]      # Get most recent version
         self.lastver = latest
 
+    def load_info(self, info):
+        """Sets backup info from contents of info.json"""
+        self.id = info['id']
+        self.include = info['include']
+        self.exclude = info['exclude']
+        self.src = info['src']
+        self.storage = info.get('storage', STORE_FILES)
+        self.check = info.get('check', CHECK_STAT)
+        self.policy = info.get('policy', compression.POLICY_DEFAULT)
+        self.maxchain = info.get('maxchain', DELTA_MAXCHAIN)
+
+    def load_version(self, verinfo, info, data, base = None):
+        """Adds version from contents of version.json, sharing entries that are 
+           the same in file table BASE
+        """
+        version = BackupVersion(sys.intern(verinfo['id']), verinfo['time'], 
+            verinfo['size'], verinfo['sizedelta'])
+        version.info = info                             # Save archive name of version info 
+        version.data = data                             # Save archive name of version data
+
+        self.versions[version.id] = version
+        version.files = self.read_files(version, verinfo, base)
+        return version
+
+    def load_files(self, version):
+        """Reads file list of VERSION, sharing entries with the nearest loaded version"""
+        with tarfile.open(self.file) as t:
+            verinfo = json.loads(self.readmember(t, version.info).decode())
+        loaded = [ v for v in self.versions.values() if v.loaded and v is not version ]
+        base = None
+        if loaded: base = min(loaded, key=lambda v: abs(v.time - version.time)).files
+        return self.read_files(version, verinfo, base)
+
+    def read_files(self, version, verinfo, base = None):
+        """Returns file table of VERSION from its version.json. Full file lists 
+           share entries with BASE, lists of changes are applied to the parent's.
+        """
+        version.parent = verinfo.get('parent')
+        version.depth = verinfo.get('depth', 0)
+        if 'files' in verinfo: return filetable(verinfo['files'], base)
+
+        table = FileTable(self.versions[version.parent].files)
+        for name in verinfo['removed']: del table[name]
+        for name, info in verinfo['changes'].items(): table[name] = BackupFile.from_info(name, info)
+        return table
+
+    def build_verinfo(self, version):
+        """Returns contents of version.json for VERSION, as changes from its parent
+           if it has one
+        """
+        return version.build_info(self.versions[version.parent] if version.parent else None)
+
+    def getmember(self, tarobj, name):
+        """Returns TarInfo for archive member, seeking straight to it if indexed"""
+        if name not in self.members: return tarobj.getmember(name)
+        tarobj.fileobj.seek(self.members[name][0])
+        return tarobj.tarinfo.fromtarfile(tarobj)
+
+    def extractmember(self, tarobj, name):
+        """Returns file object for reading archive member"""
+        return tarobj.extractfile(self.getmember(tarobj, name))
+
+    def readmember(self, tarobj, name):
+        """Returns contents of archive member as bytes"""
+        return self.extractmember(tarobj, name).read()
+
+    @contextmanager
+    def openarchive(self):
+        """Opens archive for reading, yielding (tar object, memory map of archive).
+           The map is None if the archive can't be mapped.
+        """
+        with open(self.file, 'rb') as f, tarfile.open(fileobj=f) as t:
+            mapped = None
+            if mmap and self.members:
+                try: mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError): pass      # Can't be mapped, read through tar
+            try: yield t, mapped
+            finally:
+                if mapped is not None:
+                    try: mapped.close()
+                    except BufferError: pass    # Views still open, map is closed with them
+
+    def opendata(self, tarobj, ver, mapped = None):
+        """Returns data zip of version VER, reading straight from memory map MAPPED
+           of the archive if given
+        """
+        data = self.versions[ver].data
+        if mapped is None or not data in self.members: 
+            return zipfile.ZipFile(self.extractmember(tarobj, data))
+        offset, size = self.members[data][1:]
+        with memoryview(mapped) as view:
+            zipobj = zipfile.ZipFile(MemoryFile(view[offset:offset + size]))
+        zipobj._filePassed = False      # Closing zip releases the view
+        return zipobj
+
+    def build_index(self, bakinfo, members, versions):
+        """Returns index of archive containing MEMBERS and VERSIONS"""
+        summaries = [v.summary() for v in sorted(versions, key=lambda v: v.time)]
+        return { 'format': INDEX_FORMAT, 'info': bakinfo,
+            'members': members, 'versions': summaries }
+
+    @metrics.timed('vbackup.build')
     def build(self, src=None, include=[], exclude=[]):  
         self.curver = BackupVersion()  
         curver = self.curver        # Shorter
@@ -167,58 +847,70 @@ class Backup:
         self.exclude = exclude
 
         lfiles = self.lastver.files  # File list from preceding backup version
+        hashcheck = self.check in (CHECK_HASH, CHECK_SAMPLED)
+        if hashcheck and self.digests is None:
+            self.digests = DigestCache('{}.digests'.format(self.file) if self.filename else None)
 
         if not src: src = self.src
         else: self.src = os.path.realpath(src)
 
         logging.debug('Scanning for files in source directory ''{}'''.format(src))
         
-        for root, dirs, files in os.walk(src):
-            rel = os.path.relpath(root, src)
-            # Remove unnecessary directories if includes/excludes are specified
-            for d in reversed(dirs):
-                drel = os.path.normpath(os.path.join(rel, d))
-                if include and not ([i for i in include if i.startswith(drel) or
-                        fnmatch.fnmatch(drel, os.path.join(os.path.dirname(i), '*')) or 
-                        not os.sep in i]):
-                    dirs.remove(d)
-                if exclude and [e for e in exclude if fnmatch.fnmatch(drel, e)]: 
-                    dirs.remove(d)
-
-            for file in files:   
-                fpath = os.path.realpath(os.path.join(root, file))     # Path to file
-                frel = os.path.normpath(os.path.join(rel, file))
-                frel_arc = frel.replace('\\','/')  # Archive name - uses forward slashes
-                stat = os.stat(fpath)
-                mod = stat.st_mtime          # Modification time
-
-                if include:
-                    if not [m for m in include if fnmatch.fnmatch(frel, m)]: continue  
-                if exclude:
-                    if [m for m in exclude if fnmatch.fnmatch(frel, m)]: continue  
-                
-                if frel_arc in lfiles:
-                    existing = lfiles[frel_arc]
-                    if mod == existing.mod and stat.st_size == existing.size:  
-                        curver.files[frel_arc] = existing
-                        curver.size += stat.st_size
-                        continue                        # Skip file if same as previous version
-
-                curver.size += stat.st_size
-                curver.sizedelta += stat.st_size
-                curfile = BackupFile(frel_arc, stat.st_size, mod, curver.id, fpath)
-                curver.newfiles += 1
-                curver.files[frel_arc] = curfile     # Add file to version file dict    
+        matcher = pathmatch.PathMatcher(include, exclude)
+        stated = 0
+        for frel, entry in pathmatch.scan(self.src, matcher):
+            # Path to file, which only needs resolving if it is a link
+            fpath = os.path.realpath(entry.path) if entry.is_symlink() else entry.path
+            frel_arc = frel.replace('\\','/')  # Archive name - uses forward slashes
+            stat = entry.stat()
+            stated += 1
+            mod = stat.st_mtime          # Modification time
+
+            if frel_arc in lfiles:
+                existing = lfiles[frel_arc]
+                if mod == existing.mod and stat.st_size == existing.size:  
+                    curver.files[frel_arc] = existing
+                    curver.size += stat.st_size
+                    continue                        # Skip file if same as previous version
+                if hashcheck and self.samecontent(fpath, stat, existing):
+                    # Keep previous copy of file, but with new modification time
+                    curver.files[frel_arc] = BackupFile(frel_arc, stat.st_size, mod, 
+                        existing.location, chunks=existing.chunks, digest=existing.digest,
+                        sample=existing.sample, codec=existing.codec, delta=existing.delta)
+                    curver.size += stat.st_size
+                    continue
+
+            curver.size += stat.st_size
+            curver.sizedelta += stat.st_size
+            curfile = BackupFile(frel_arc, stat.st_size, mod, curver.id, fpath)
+            if hashcheck:
+                curfile.digest = self.digests.get(fpath, stat)  # Otherwise found during save
+                if self.check == CHECK_SAMPLED and stat.st_size >= SAMPLE_MIN:
+                    curfile.sample = sampledigest(fpath, stat.st_size)
+            curver.newfiles += 1
+            curver.files[frel_arc] = curfile     # Add file to version file dict    
 
         logging.debug('{} changed files found'.format(curver.newfiles))
+        metrics.count('vbackup.files_stated', stated)
+        metrics.count('vbackup.files_changed', curver.newfiles)
+        if hashcheck: self.digests.save()
 
+    def samecontent(self, path, stat, existing):
+        """Checks whether file at PATH has same contents as EXISTING backup file"""
+        if stat.st_size != existing.size or not existing.digest: return False
+        if self.check == CHECK_SAMPLED and existing.sample:
+            # Rule out most changes to large files without reading all of them
+            if sampledigest(path, stat.st_size) != existing.sample: return False
+        return self.digests.digest(path, stat) == existing.digest
 
-    def save(self, file=None, verbose=True):
-        if not file: file = self.file
+
+    @metrics.timed('vbackup.save')
+    def save(self, file=None, verbose=True, threads=None):
+        file = os.path.normpath(file) if file else self.file     # Compared with self.file
         curver = self.curver
 
-        verinfo = curver.build_info()       # Convert version info to JSON
-        bakinfo = { 'id': self.id, 'src': self.src, 
+        bakinfo = { 'id': self.id, 'src': self.src, 'storage': self.storage,
+            'check': self.check, 'policy': self.policy, 'maxchain': self.maxchain,
             'include': self.include, 'exclude': self.exclude}
 
         # Add files not in previous versions
@@ -226,108 +918,650 @@ class Backup:
 
         if savelist:
             if verbose: logging.info("Backing up '{}' > '{}'".format(self.src, os.path.basename(file)))
-            with tarfile.open(file, 'a') as t:           
-                with tempfile.SpooledTemporaryFile(256000000) as temp:   # Write data zip to temp file
-                    with zipfile.ZipFile(temp, 'w', compression=zipfile.ZIP_DEFLATED) as z:
-                        for f in tqdm(savelist, ncols=100): 
-                            compression = None
-                            name, ext = os.path.splitext(f.name)
-                            if ext in {'.png','.jpg','.zip'}: compression = zipfile.ZIP_STORED
-                            z.write(f.path, f.name, compression)    
+            before = os.path.getsize(file) if os.path.isfile(file) else 0
+            deltas = []
+            if file == self.file and self.storage == STORE_DELTAS and \
+                    self.lastver.data in self.members:
+                deltas = self.find_deltas(savelist)
+            with self.make_deltas(deltas) as deltas, openappend(file) as (t, index):
+                if index:
+                    members = dict(index['members'])
+                    versions = [BackupVersion.from_summary(v) for v in index['versions']]
+                else:
+                    # No index yet, so find existing members and versions by scanning
+                    members = scanmembers(t)
+                    versions = [] if not members else scanversions(t, members)
 
-                    temp.seek(0)
-                    tinfo = t.gettarinfo(arcname=curver.data, fileobj=temp)
-                    t.addfile(tinfo, temp)     # Add zip created in temp to tarball
+                with self.save_deltas(t, members, versions, deltas, threads):
+                    # Write data zip straight into tarball
+                    with taraddstream(t, curver.data, members) as stream, \
+                            zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as z, \
+                            ziptools.ParallelZipWriter(z, threads) as writer:
+                        if self.storage == STORE_CHUNKS: self.save_chunks(writer, savelist)
+                        else: self.save_files(writer, savelist)
+                    metrics.count('vbackup.bytes_read', sum(f.size for f in savelist))
+                    metrics.count('vbackup.bytes_compressed', 
+                        sum(i.compress_size for i in z.infolist()))
                 
-                if not 'info.json' in t.getnames(): taraddstr(t, 'info.json', json.dumps(bakinfo)) # Backup info
-                taraddstr(t, curver.info, json.dumps(verinfo,sort_keys=True,indent=4)) # Version info
+                    if not 'info.json' in members: 
+                        taraddstr(t, 'info.json', json.dumps(bakinfo), members)     # Backup info
+                    lastver = self.lastver
+                    if file == self.file and lastver.id in self.versions and \
+                            lastver.loaded and lastver.depth + 1 < MANIFEST_CHECKPOINT:
+                        # Only list changes since last version
+                        curver.parent, curver.depth = lastver.id, lastver.depth + 1
+                    verinfo = self.build_verinfo(curver)   # Convert version info to JSON
+                    taraddstr(t, curver.info, json.dumps(verinfo,sort_keys=True,indent=4), 
+                        members)                                                    # Version info
+                    taraddindex(t, self.build_index(bakinfo, members, versions + [curver]))
+
+            if file == self.file:
+                # Saved version is now the last one, for restoring or building the next
+                self.members = members
+                curver.num = len(self.versions) + 1
+                self.versions[curver.id] = curver
+                self.lastver = curver
+            metrics.count('vbackup.archive_bytes', os.path.getsize(file) - before)
                       
         else: logging.info("Skipped backup '{}' (no files to backup)".format(self.src))
+        if self.digests: self.digests.save()
+
+    def newdigest(self, file):
+        """Returns (hash object, stat) for finding digest of FILE while it is saved, 
+           or (None, None) if its digest isn't needed or already known.
+        """
+        if file.digest or not self.check in (CHECK_HASH, CHECK_SAMPLED): return None, None
+        return hashlib.sha1(), os.stat(file.path)
+
+    def adddigest(self, file, digest, stat):
+        """Sets digest of FILE from hash object, adding it to digest cache"""
+        file.digest = digest.hexdigest()
+        if self.digests: self.digests.add(file.path, stat, file.digest)
+
+
+    def chain(self, file):
+        """Returns entries followed to rebuild FILE, from FILE itself to the entry 
+           stored whole
+        """
+        entries = [file]
+        while entries[-1].delta: 
+            entries.append(self.versions[entries[-1].delta].files[file.name])
+        return entries
 
+    def find_deltas(self, savelist):
+        """Returns files in SAVELIST whose copy in the last version can be replaced 
+           by a delta against their new copy
+        """
+        prev = self.lastver
+        found = []
+        for f in savelist:
+            old = prev.files.get(f.name)
+            if not old or old.location != prev.id or old.chunks is not None: continue
+            if old.size < DELTA_MIN: continue
+            # Every chain that ends at the old copy gets one delta longer
+            chains = [ self.chain(v.files[f.name]) for v in self.versions.values() 
+                if f.name in v.files and v.time < prev.time ]
+            longest = max([1] + [ len(c) for c in chains if c[-1] is old ])
+            if longest <= self.maxchain: found.append(f)
+        return found
 
-    def restore(self, dst, ver = None, to_zip = False):
+    @contextmanager
+    def make_deltas(self, files):
+        """Finds deltas of the last version's copies of FILES against their new 
+           copies, yielding (file, temp file holding delta) for each. Copies whose 
+           delta is over DELTA_MAXRATIO of their size are left out, as they are 
+           kept whole.
+        """
+        made = []
+        with ExitStack() as stack:
+            if files:
+                prev = self.lastver
+                tarobj, mapped = stack.enter_context(self.openarchive())
+                oldzip = stack.enter_context(self.opendata(tarobj, prev.id, mapped))
+                for f in files:
+                    limit = prev.files[f.name].size * DELTA_MAXRATIO
+                    temp = stack.enter_context(tempfile.TemporaryFile())
+                    with open(f.path, 'rb') as base, oldzip.open(f.name) as target:
+                        for block in delta.diff(base, target):
+                            temp.write(block)
+                            if temp.tell() > limit: break   # Saves too little to be worth it
+                    if temp.tell() > limit: continue
+                    temp.seek(0)
+                    made.append((f, temp))
+                logging.debug('{} of {} older copies kept as deltas'.format(len(made), len(files)))
+            yield made
+
+    @contextmanager
+    def save_deltas(self, tarobj, members, versions, deltas, threads=None):
+        """Replaces copies of files in the last version with DELTAS against their 
+           new copies, (file, delta file) pairs from make_deltas. The version's data
+           and info are written again after the end of the archive under new names, 
+           with the index moving to them once saving is done, so the old members 
+           are left whole if saving fails or is interrupted. Space they take up is
+           freed when the archive is next pruned. VERSIONS are those in the index.
+        """
+        if not deltas:
+            yield
+            return
+        prev = self.lastver
+        olddata, oldinfo = prev.data, prev.info
+        curid = self.curver.id
+        replaced = {}
+
+        try:
+            names = { f.name for f, _ in deltas }
+            with self.openarchive() as (curtar, mapped), \
+                    self.opendata(curtar, prev.id, mapped) as oldzip, \
+                    taraddstream(tarobj, REWRITE_NAME.format(olddata, curid), members) as stream, \
+                    zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+                for info in oldzip.infolist():
+                    if not info.filename in names: ziptools.copy_member(oldzip, info, z)
+                with ziptools.ParallelZipWriter(z, threads) as writer:
+                    for f, data in deltas:
+                        zinfo = zipfile.ZipInfo(DELTA_NAME.format(f.name), 
+                            time.localtime(time.time())[:6])
+                        writer.add(zinfo, iter(lambda: data.read(delta.BLOCK_SIZE), b''))
+                        old = prev.files[f.name]
+                        replaced[f.name] = old
+                        prev.files[f.name] = BackupFile(f.name, old.size, old.mod, prev.id, 
+                            digest=old.digest, sample=old.sample, codec='deflate', 
+                            delta=curid)
+
+            prev.data, prev.info = REWRITE_NAME.format(olddata, curid), \
+                REWRITE_NAME.format(oldinfo, curid)
+            taraddstr(tarobj, prev.info, json.dumps(self.build_verinfo(prev), sort_keys=True, 
+                indent=4), members)
+            del members[olddata], members[oldinfo]
+            for v in versions:
+                if v.id == prev.id: v.data, v.info = prev.data, prev.info
+            yield
+        except BaseException:
+            # Index goes back to the old members, which were never written over
+            prev.files.update(replaced)
+            prev.data, prev.info = olddata, oldinfo
+            raise
+
+    def save_files(self, writer, savelist):
+        """Writes each file in SAVELIST whole to zip, while reading ahead the files
+           that follow
+        """
+        with ExitStack() as stack:
+            if self.readahead:
+                reader = stack.enter_context(
+                    ziptools.ReadAhead([ f.path for f in savelist ], self.readahead))
+                readfiles = ( blocks for path, blocks in reader )
+            else: readfiles = ( None for f in savelist )
+
+            for f, blocks in zip(tqdm(savelist, ncols=100, disable=not self.progress), readfiles): 
+                if blocks is None: codec = compression.choose_file(f.path, self.policy)
+                else:
+                    # Codec is chosen from start of the first block, as choose_file does
+                    first = next(blocks, b'')
+                    codec = compression.choose(first[:compression.SAMPLE_SIZE], self.policy)
+                    blocks = itertools.chain([first], blocks)
+                f.codec = codec.name
+                digest, stat = self.newdigest(f)
+                writer.write(f.path, f.name, codec.compress_type, digest, codec.level, blocks)
+                if digest: self.adddigest(f, digest, stat)
+
+    def save_chunks(self, writer, savelist):
+        """Splits files into chunks, writing chunks not already in archive to zip"""
+        known = {}          # Keys: chunk ids, Values: version chunk is located in
+        for version in self.versions.values():
+            for f in version.files.values():
+                if f.chunks: known.update(f.chunks)
+
+        curid = self.curver.id
+        for f in tqdm(savelist, ncols=100, disable=not self.progress):
+            f.chunks = []
+            digest, stat = self.newdigest(f)
+            with open(f.path, 'rb') as fileobj:
+                for chunk in chunking.chunks(fileobj):
+                    cid = chunking.chunk_id(chunk)
+                    if not cid in known: 
+                        codec = compression.choose(chunk, self.policy)
+                        writer.writestr('chunks/{}'.format(cid), chunk, codec.compress_type, 
+                            codec.level)
+                        known[cid] = curid
+                    f.chunks.append([cid, known[cid]])
+                    if digest: digest.update(chunk)
+            if digest: self.adddigest(f, digest, stat)
+
+    @metrics.timed('vbackup.restore')
+    def restore(self, dst, ver = None, to_zip = False, include = None, exclude = None, 
+            threads = None, incremental = None, delete = False):
+        """Restores version VER (or the latest) to directory DST, or to a zip file 
+           if TO_ZIP. With INCREMENTAL set to a check mode, files already in DST 
+           with the same modification time and size (CHECK_STAT) or contents 
+           (CHECK_HASH) aren't written again. With DELETE, files in DST the backup
+           would include but which aren't in the version are removed.
+        """
         if not ver: version = self.lastver
         elif ver not in self.versions: 
             logging.warning('Version {} does not exist. Restoring lastest version instead'.format(ver))
             version = self.lastver      
         else: version = self.versions[ver]
+
+        files = [ f for f in version.files.values() if matchpath(f.name, include, exclude) ]
+        if (include or exclude) and not files:
+            logging.warning("No files in '{}' match the given paths".format(self.filename))
+        for codec in { f.codec for f in files if f.codec }: compression.check(codec)
         
-        extractlist = {}    # Keys: version id, Values: file names to extract from version
-        for file in version.files.values():
-            if not file.location in extractlist: extractlist[file.location] = [file.name]
-            else: extractlist[file.location].append(file.name)
+        zips = {}           # Keys: version id, Values: open data zip of version
+        with self.openarchive() as (t, mapped):
+            def openzip(ver):
+                if not ver in zips: zips[ver] = self.opendata(t, ver, mapped)
+                return zips[ver]
+
+            try:
+                if delete and not to_zip: self.delete_extras(version, dst, include, exclude)
+                if incremental and not to_zip:
+                    unchanged = [ f for f in files if self.unchanged(f, dst, incremental, openzip) ]
+                    skipped = set(id(f) for f in unchanged)
+                    files = [ f for f in files if not id(f) in skipped ]
+                    avoided = sum(f.size for f in unchanged)
+                    logging.info('Skipped {} unchanged files ({} KB not written)'.format(
+                        len(unchanged), round(avoided/1000)))
+                    metrics.count('vbackup.files_skipped', len(unchanged))
+                    metrics.count('vbackup.bytes_skipped', avoided)
+                metrics.count('vbackup.files_restored', len(files))
+                metrics.count('vbackup.bytes_restored', sum(f.size for f in files))
+
+                extractlist = {}    # Keys: version id, Values: member names to extract from version
+                chunked = []        # Files stored as chunks, which may be spread across versions
+                rebuilt = []        # Files stored as deltas, rebuilt from the following versions
+                chunkmembers = set()    # (version id, member name) of chunks
+                for file in files:
+                    if file.delta: rebuilt.append(file)
+                    elif file.chunks is not None: 
+                        chunked.append(file)
+                        for cid, loc in file.chunks:
+                            extractlist.setdefault(loc, {})['chunks/{}'.format(cid)] = None
+                            chunkmembers.add((loc, 'chunks/{}'.format(cid)))
+                    else: extractlist.setdefault(file.location, {})[file.name] = None
         
-        if to_zip: zfileobj = zipfile.ZipFile(dst, 'w', compression=zipfile.ZIP_DEFLATED)
-        with tarfile.open(self.file) as t:
-            for ver, files in extractlist.items():
-                zfile = t.extractfile(self.versions[ver].data)      # Open version data zip
-                with zipfile.ZipFile(zfile) as z:
-                    for file in files: 
-                        if to_zip: 
-                            info = z.getinfo(file)
-                            if info.file_size > 50000000:   # Extract to disk if file > 50MB
-                                with tempfile.TemporaryDirectory() as tmpdir:
-                                   z.extract(file, tmpdir)
-                                   zfileobj.write(os.path.join(tmpdir, info.filename), info.filename)
-                            else: zfileobj.writestr(info, z.read(file))
-                        else: z.extract(file, dst)
+                # Read version data in the order it is stored, so archive is read front to back
+                order = sorted(extractlist, 
+                    key=lambda v: self.members.get(self.versions[v].data, [0])[0])
+                for ver in order: openzip(ver)
+                if to_zip: 
+                    zfileobj = zipfile.ZipFile(dst, 'w', compression=zipfile.ZIP_DEFLATED)
+                    for ver in order:
+                        self.copy_members(zips[ver], [ n for n in extractlist[ver]
+                            if not (ver, n) in chunkmembers ], zfileobj)
+                    for file in chunked:
+                        # Chunks are joined into the file, under its own name
+                        zinfo = zipfile.ZipInfo(file.name, time.localtime(file.mod)[:6])
+                        zinfo.compress_type = zipfile.ZIP_DEFLATED
+                        with zfileobj.open(zinfo, 'w',
+                                force_zip64=file.size > zipfile.ZIP64_LIMIT) as out:
+                            for cid, loc in file.chunks:
+                                out.write(openzip(loc).read('chunks/{}'.format(cid)))
+                    for file in rebuilt:
+                        with tempfile.TemporaryDirectory() as tmpdir:
+                            path = os.path.join(tmpdir, 'file')
+                            self.rebuild(openzip, file, path)
+                            zfileobj.write(path, file.name)
+                    zfileobj.close()
+                else:
+                    targets = self.chunk_targets(chunked, dst, zips)
+                    jobs = restore_jobs(zips, extractlist, order)
+                    for ver, names in jobs:
+                        for name in names:
+                            if not (ver, name) in targets: 
+                                os.makedirs(os.path.join(dst, *name.split('/')[:-1]), exist_ok=True)
+
+                    threads = threads or os.cpu_count() or 1
+                    if threads > 1 and len(jobs) > 1:
+                        # Each thread reads from its own view or handle on the archive
+                        with ThreadPoolExecutor(threads) as pool:
+                            running = [ pool.submit(self.extract_members, ver, names, dst, targets,
+                                mapped=mapped) for ver, names in jobs ]
+                            for job in running: job.result()
+                    else:
+                        for ver, names in jobs: 
+                            self.extract_members(ver, names, dst, targets, zips[ver])
+                    for file in rebuilt:
+                        path = os.path.join(dst, *file.name.split('/'))
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        self.rebuild(openzip, file, path)
+                    # Files get the modification time they were backed up with
+                    for file in files:
+                        os.utime(os.path.join(dst, *file.name.split('/')), (file.mod, file.mod))
+            finally:
+                for z in zips.values(): z.close()
 
         logging.info("Restored '{}' > '{}'".format(self.filename, dst))
 
+    def unchanged(self, file, dst, check, openzip):
+        """Checks whether backup FILE is already in DST, by modification time and 
+           size or by contents, depending on CHECK. OPENZIP returns data zip of a
+           version to compare contents with.
+        """
+        path = os.path.join(dst, *file.name.split('/'))
+        try: stat = os.stat(path)
+        except OSError: return False
+        if stat.st_size != file.size: return False
+        if check == CHECK_STAT: return stat.st_mtime == file.mod
+        if file.digest: return filedigest(path) == file.digest
+        if file.chunks is None and not file.delta:
+            # Compare with CRC stored in zip, no digest was kept for file
+            return filecrc(path) == openzip(file.location).getinfo(file.name).CRC
+        return False
+
+    def delete_extras(self, version, dst, include = None, exclude = None):
+        """Removes files from DST that backup includes but VERSION doesn't have"""
+        removed = 0
+        matcher = pathmatch.PathMatcher(self.include, self.exclude)
+        for rel, entry in pathmatch.scan(dst, matcher):
+            name = rel.replace('\\', '/')
+            if not name in version.files and matchpath(name, include, exclude):
+                os.remove(entry.path)
+                removed += 1
+        if removed: logging.info('Removed {} files not in version {}'.format(removed, version.id))
+        metrics.count('vbackup.files_deleted', removed)
+
+    def rebuild(self, openzip, file, path):
+        """Writes contents of FILE stored as a delta to PATH, by applying each delta 
+           in its chain to the copy stored whole. OPENZIP returns data zip of a version.
+        """
+        entries = self.chain(file)
+        whole = entries.pop()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            current = os.path.join(tmpdir, 'base')
+            with openzip(whole.location).open(whole.name) as src, open(current, 'wb') as out:
+                shutil.copyfileobj(src, out, COPY_BLOCKSIZE)
+            for entry in reversed(entries):
+                target = path if entry is file else os.path.join(tmpdir, 'target')
+                with open(current, 'rb') as base, open(target, 'wb') as out, \
+                        openzip(entry.location).open(DELTA_NAME.format(entry.name)) as data:
+                    delta.patch(base, data, out)
+                if target != path: os.replace(target, current)
+
+    def copy_members(self, zipobj, names, dstzip):
+        """Copies members NAMES from version data zip to DSTZIP, as they are stored"""
+        for info in sorted(map(zipobj.getinfo, names), key=lambda i: i.header_offset):
+            ziptools.copy_member(zipobj, info, dstzip)
+
+    def extract_members(self, ver, names, dst, targets, zipobj = None, mapped = None):
+        """Extracts members NAMES of version VER to DST, with chunks written to their
+           TARGETS. If ZIPOBJ isn't given, opens its own view on memory map MAPPED of
+           the archive, or its own handle on the archive.
+        """
+        with ExitStack() as stack:
+            if zipobj is None:
+                tarobj = None if mapped is not None else stack.enter_context(tarfile.open(self.file))
+                zipobj = stack.enter_context(self.opendata(tarobj, ver, mapped))
+            for file in names:
+                if (ver, file) in targets:
+                    data = zipobj.read(file)
+                    for path, offset in targets[ver, file]:
+                        with open(path, 'r+b') as out:
+                            out.seek(offset)
+                            out.write(data)
+                else: zipobj.extract(file, dst)
+
+    def chunk_targets(self, files, dst, zips):
+        """Creates chunked FILES in DST, returning where each chunk is written. Keys
+           are (version id, chunk member name), values lists of (path, offset).
+        """
+        targets = {}
+        for file in files:
+            path = os.path.join(dst, *file.name.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'wb').close()
+            offset = 0
+            for cid, loc in file.chunks:
+                name = 'chunks/{}'.format(cid)
+                targets.setdefault((loc, name), []).append((path, offset))
+                offset += zips[loc].getinfo(name).file_size
+        return targets
+
     
     def trim(self, ver = None, file = None):
+        """Removes versions older than VER (or all but the newest)"""
         if not ver: version = self.lastver      # Trim to newest version if none specified
         else: version = self.versions[ver]
+        self.prune([ v.id for v in self.versions.values() if v.time >= version.time ], file)
+        logging.info("Trimmed backup '{}' to version {}".format(
+                self.filename, version.id))
 
+    def retain(self, rules, file = None):
+        """Removes versions not kept under retention RULES (see retention module), 
+           returning the IDs of versions removed
+        """
+        keep = [ v.id for v in retention.select(self.versions.values(), rules) ]
+        removed = sorted(set(self.versions) - set(keep))
+        if removed: 
+            self.prune(keep, file)
+            logging.info("Removed {} versions from '{}' under retention policy".format(
+                len(removed), self.filename))
+        return removed
+
+    @metrics.timed('vbackup.prune')
+    def prune(self, keep, file = None):
+        """Rewrites archive with only versions KEEP (a list of version IDs), in one
+           pass. Data kept versions use from removed ones is moved into the oldest 
+           kept version using it, copied as stored. Files stored as deltas against 
+           a removed version are rebuilt and stored whole.
+        """
+        kept = sorted((self.versions[v] for v in keep), key=lambda v: v.time)
+        keepids = set(keep)
         if not file: file = self.file
         working = '{}.tempfile'.format(file)        # Temporary file in case something goes wrong
 
-        with tarfile.open(working, 'w') as newtar:
-            with tempfile.SpooledTemporaryFile(256000000) as temp:
-                # Use restore function to create new data.zip for version
-                self.restore(temp, version.id, to_zip=True)
-                temp.seek(0)
-                tinfo = newtar.gettarinfo(arcname=version.data, fileobj=temp)
-                newtar.addfile(tinfo, temp)
-
-            verinfo = version.build_info()              # Convert version info to JSON
-            verinfo['sizedelta'] = version.size         # Removing all versions older than specified
-                                                        # version, so delta size == size
-            for f in version.files.values(): 
-                verinfo['files'][f.name] = { 'mod': f.mod, 'size': f.size,
-                    'location': version.id }          # Change location to refer to specified version
-
-            taraddstr(newtar, version.info, json.dumps(verinfo,sort_keys=True,indent=4)) # Info JSON
- 
-            with tarfile.open(self.file) as curtar:
-                # Retrieve all newer versions from current backup
-                remaining = [ v for v in self.versions.values() if v.time > version.time ]
-                bakinfo = curtar.getmember('info.json')
-                newtar.addfile(bakinfo, curtar.extractfile(bakinfo))
-
-                for v in sorted(remaining, key=lambda v: v.time):
-                    data = curtar.getmember(v.data)
-                    newtar.addfile(data, curtar.extractfile(data))
-                    verinfo = v.build_info()
-                    # If file is located in version older than specified, change location
-                    for f in verinfo['files'].values():  
-                        if self.versions[f['location']].time < version.time: 
-                            f['location'] = version.id  
-                    taraddstr(newtar, v.info, json.dumps(verinfo,sort_keys=True,indent=4))
+        moved = {}      # Keys: (version id, name) of data in a removed version, values: 
+                        # version id moved to
+        merged = { v.id: [] for v in kept }     # Keys: version id, values: data moved into 
+                                                # version, as (version id, member) or files rebuilt
+        def move(ver, loc, name, item):
+            if not (loc, name) in moved:
+                moved[loc, name] = ver
+                merged[ver].append(item)
+            return moved[loc, name]
+
+        fullinfo = {}   # Keys: version id, values: version.json with full file list
+        for v in kept:
+            verinfo = fullinfo[v.id] = v.build_info()
+            for f in v.files.values():
+                info = verinfo['files'][f.name]
+                if f.delta and any(e.delta not in keepids for e in self.chain(f)[:-1]):
+                    # Chain passes through a removed version, so file is stored whole
+                    info.update(location=move(v.id, f.location, f.name, f), codec='deflate')
+                    del info['delta']
+                elif f.chunks is not None:
+                    for chunk in info['chunks']:
+                        if not chunk[1] in keepids: 
+                            member = 'chunks/{}'.format(chunk[0])
+                            chunk[1] = move(v.id, chunk[1], member, (chunk[1], member))
+                    if f.location in keepids: continue
+                    info['location'] = moved.setdefault((f.location, f.name), v.id)
+                elif not f.location in keepids:
+                    member = DELTA_NAME.format(f.name) if f.delta else f.name
+                    info['location'] = move(v.id, f.location, member, (f.location, member))
+                else: continue
+                if info['location'] == v.id: verinfo['sizedelta'] += f.size
+
+        zips = {}           # Keys: version id, Values: open data zip of version
+        members = {}
+        with tarfile.open(working, 'w') as newtar, self.openarchive() as (curtar, mapped):
+            def openzip(ver):
+                if not ver in zips: zips[ver] = self.opendata(curtar, ver, mapped)
+                return zips[ver]
+
+            try:
+                # Members that don't change are copied as they are stored
+                taraddrange(newtar, self.getmember(curtar, 'info.json'), curtar.fileobj, members)
+                bakinfo = json.loads(self.readmember(curtar, 'info.json').decode())
+                parent, depth = None, 0
+                for v in kept:
+                    # Members rewritten by a later save get back their usual names
+                    if not merged[v.id]:
+                        tinfo = self.getmember(curtar, v.data)
+                        tinfo.name = VERSION_DATA.format(v.id)
+                        taraddrange(newtar, tinfo, curtar.fileobj, members)
+                    else:
+                        with taraddstream(newtar, VERSION_DATA.format(v.id), members) as stream, \
+                                zipfile.ZipFile(stream, 'w') as zipobj:
+                            own = openzip(v.id)
+                            self.copy_members(own, own.namelist(), zipobj)
+                            self.merge_members(openzip, merged[v.id], zipobj)
+
+                    # Rebase list of changes on the rewritten versions before
+                    verinfo = fullinfo[v.id]
+                    if parent and depth:
+                        verinfo = dict(verinfo, parent=parent['id'], depth=depth, 
+                            count=len(verinfo['files']))
+                        verinfo['changes'], verinfo['removed'] = changedfiles(parent['files'], 
+                            verinfo.pop('files'))
+                    taraddstr(newtar, VERSION_INFO.format(v.id), 
+                        json.dumps(verinfo,sort_keys=True,indent=4), members)
+                    parent, depth = fullinfo[v.id], (depth + 1) % MANIFEST_CHECKPOINT
+            finally:
+                for z in zips.values(): z.close()
+
+            versions = [ BackupVersion.from_summary(dict(v.summary(), 
+                sizedelta=fullinfo[v.id]['sizedelta'], info=VERSION_INFO.format(v.id), 
+                data=VERSION_DATA.format(v.id))) for v in kept ]
+            taraddindex(newtar, self.build_index(bakinfo, members, versions))
 
         if os.path.isfile(file): os.remove(file)  
         os.rename(working, file)
+        if file == self.file:
+            # File lists not loaded yet have to come from the rewritten archive
+            self.versions = {}
+            self.load()
 
-        logging.info("Trimmed backup '{}' to version {}".format(
-                self.filename, version.id))
+    def merge_members(self, openzip, merged, zipobj):
+        """Writes MERGED to ZIPOBJ, members (version id, name) of other versions 
+           as they are stored and files stored as deltas rebuilt whole. OPENZIP 
+           returns data zip of a version.
+        """
+        # Read version data in the order it is stored, so archive is read front to back
+        order = lambda m: self.members.get(self.versions[m[0]].data, [0])[0]
+        for loc, member in sorted((m for m in merged if isinstance(m, tuple)), key=order):
+            ziptools.copy_member(openzip(loc), openzip(loc).getinfo(member), zipobj)
+        for file in (m for m in merged if not isinstance(m, tuple)):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, 'file')
+                self.rebuild(openzip, file, path)
+                zipobj.write(path, file.name, zipfile.ZIP_DEFLATED)
+
+    def verify(self, threads = None):
+        """Checks archive can be restored, without writing any files. Walks every tar
+           header, checks members in the index are where it says, that every member
+           each version refers to exists, and the CRC of every member in each 
+           version's data. Returns dict with keys 'errors' (problems with the archive
+           as a whole), 'versions' (keys: version id, values: dict with 'members',
+           'bytes' and 'errors' for the version's data), 'bytes' and 'time'.
+        """
+        start = time.perf_counter()
+        result = { 'errors': [], 'bytes': 0, 'time': 0,
+            'versions': { vid: {'members': 0, 'bytes': 0, 'errors': []} for vid in self.versions } }
+        with ExitStack() as stack:
+            try: t, mapped = stack.enter_context(self.openarchive())
+            except (tarfile.TarError, OSError) as e:
+                result['errors'].append("Archive can't be opened: {}".format(e))
+                t, mapped = None, None
+            try: scanned = scanmembers(t) if t else {}
+            except (tarfile.TarError, OSError) as e:
+                result['errors'].append('Archive is damaged: {}'.format(e))
+                scanned = {}
+            self.verify_versions(result, scanned, mapped, threads)
+
+        result['time'] = time.perf_counter() - start
+        logging.info("Verified '{}': {:.1f} MB in {:.2f} s".format(
+            self.filename, result['bytes']/1e6, result['time']))
+        return result
+
+    def verify_versions(self, result, scanned, mapped = None, threads = None):
+        """Adds problems with members SCANNED from archive and the data of each 
+           version to RESULT of verify, reading through memory map MAPPED if given.
+        """
+        def problem(name, message):
+            """Adds MESSAGE to results of version containing archive member NAME"""
+            parts = name.split('/')
+            if parts[0] == 'versions' and parts[1] in result['versions']: 
+                result['versions'][parts[1]]['errors'].append(message)
+            else: result['errors'].append(message)
+
+        for name, location in self.members.items():
+            if not name in scanned: problem(name, "Member '{}' is missing".format(name))
+            elif scanned[name] != location: 
+                problem(name, "Member '{}' isn't where the index says".format(name))
 
-    def restorenum(self, num, dst):
+        # Data members each version needs, keys: version id, values: names in data zip
+        needed = { vid: set() for vid in self.versions }
+        for vid, version in self.versions.items():
+            errors = result['versions'][vid]['errors']
+            try: files = list(version.files.values())
+            except (KeyError, ValueError, tarfile.TarError, OSError) as e:
+                errors.append("File list can't be read: {!r}".format(e))
+                continue
+            for file in files:
+                try: entries = self.chain(file)
+                except KeyError:
+                    errors.append("Delta chain of '{}' is broken".format(file.name))
+                    continue
+                for entry in entries:
+                    if entry.chunks is not None: 
+                        refs = [ ('chunks/{}'.format(cid), loc) for cid, loc in entry.chunks ]
+                    elif entry.delta: refs = [ (DELTA_NAME.format(entry.name), entry.location) ]
+                    else: refs = [ (entry.name, entry.location) ]
+                    for name, loc in refs:
+                        if loc in needed: needed[loc].add((vid, name))
+                        else: errors.append("'{}' is in version {}, which doesn't exist".format(
+                            name, loc))
+
+        threads = threads or os.cpu_count() or 1
+        with ThreadPoolExecutor(threads) as pool:
+            running = { vid: pool.submit(self.verify_data, vid, mapped) for vid in self.versions }
+            for vid, job in running.items():
+                verified = result['versions'][vid]
+                names, verified['members'], verified['bytes'], errors = job.result()
+                verified['errors'].extend(errors)
+                result['bytes'] += verified['bytes']
+                for user, name in sorted(needed[vid]):
+                    if names is not None and not name in names:
+                        result['versions'][user]['errors'].append(
+                            "'{}' is missing from version {}".format(name, vid))
+
+    def verify_data(self, ver, mapped = None):
+        """Reads every member in data of version VER, discarding the contents. Reads
+           from memory map MAPPED of the archive if given. Returns (member names or
+           None if unreadable, members read, bytes read, errors).
+        """
+        names, count, size, errors = None, 0, 0, []
+        try:
+            with ExitStack() as stack:
+                t = None if mapped is not None else stack.enter_context(tarfile.open(self.file))
+                z = stack.enter_context(self.opendata(t, ver, mapped))
+                infos = z.infolist()
+                names = { i.filename for i in infos }
+                for info in infos:
+                    try:
+                        with z.open(info) as src:
+                            # Reading to the end checks the CRC
+                            while True:
+                                data = src.read(VERIFY_BLOCKSIZE)
+                                if not data: break
+                                size += len(data)
+                        count += 1
+                    except Exception as e:      # Any failure to read means member is damaged
+                        errors.append("Member '{}' is damaged: {}".format(info.filename, e))
+        except Exception as e:
+            errors.append("Data can't be read: {}".format(e))
+        return names, count, size, errors
+
+    def restorenum(self, num, dst, include = None, exclude = None, threads = None, 
+            incremental = None, delete = False):
         for ver in self.versions.values():
             if ver.num == int(num):
                 version = ver
                 break
         else: version = None
-        if version: self.restore(dst, version.id)
+        if version: self.restore(dst, version.id, include=include, exclude=exclude, threads=threads,
+            incremental=incremental, delete=delete)
         else: logging.error('Cannot restore - there is no version with the number {}'.format(num))
 
     def vertrim(self, num = 1, file = None):
@@ -344,14 +1578,56 @@ def main():
     bak = Backup(args['<file>'])
 
     if args['build']:
+        if args['--chunked']: bak.storage = STORE_CHUNKS
+        if args['--deltas']: bak.storage = STORE_DELTAS
+        if args['--max-chain']: bak.maxchain = int(args['--max-chain'])
+        if args['--read-ahead']: bak.readahead = int(args['--read-ahead'])*1024*1024
+        if args['--policy']:
+            if not args['--policy'] in compression.POLICIES:
+                logging.error("Invalid compression policy '{}'".format(args['--policy']))
+                sys.exit(1)
+            bak.policy = args['--policy']
+        if args['--check']: 
+            if not args['--check'] in (CHECK_STAT, CHECK_HASH, CHECK_SAMPLED):
+                logging.error("Invalid check mode '{}'".format(args['--check']))
+                sys.exit(1)
+            bak.check = args['--check']
         bak.build(args['<directory>'])
-        bak.save(args['<file>'])
+        bak.save(args['<file>'], threads=int(args['--threads'] or 0) or None)
     if args['restore']: 
-        if args['--ver']: bak.restore(args['<directory>'], ver=args['--ver'])
-        elif args['--num']: bak.restorenum(args['--num'], args['<directory>'])
-        else: bak.restore(args['<directory>'])
+        if args['--check'] and not args['--check'] in (CHECK_STAT, CHECK_HASH, CHECK_SAMPLED):
+            logging.error("Invalid check mode '{}'".format(args['--check']))
+            sys.exit(1)
+        paths = { 'include': args['--include'], 'exclude': args['--exclude'],
+            'threads': int(args['--threads'] or 0) or None, 'delete': args['--delete'],
+            'incremental': (args['--check'] or CHECK_STAT) if args['--incremental'] else None }
+        if args['--ver']: bak.restore(args['<directory>'], ver=args['--ver'], **paths)
+        elif args['--num']: bak.restorenum(args['--num'], args['<directory>'], **paths)
+        else: bak.restore(args['<directory>'], **paths)
+
+    if args['trim']: 
+        if args['--keep']:
+            try: rules = retention.parse(args['--keep'])
+            except ValueError as e:
+                logging.error(e)
+                sys.exit(1)
+            bak.retain(rules, args['--output'])
+        else: bak.vertrim(int(args['<num>']), args['--output'])
 
-    if args['trim']: bak.vertrim(int(args['<num>']), args['--output'])
+    if args['verify']:
+        result = bak.verify(int(args['--threads'] or 0) or None)
+        for error in result['errors']: print('Archive:', error)
+        for vid, version in sorted(bak.versions.items()):
+            verified = result['versions'][vid]
+            print('{:>4}  {}  {:>6} members  {:>10.1f} MB  {}'.format(version.num, vid, 
+                verified['members'], verified['bytes']/1e6, 
+                'FAILED' if verified['errors'] else 'OK'))
+            for error in verified['errors']: print('      ', error)
+        elapsed = max(result['time'], 1e-9)
+        print('\nVerified {:.1f} MB in {:.2f} s ({:.1f} MB/s)'.format(result['bytes']/1e6, 
+            result['time'], result['bytes']/1e6/elapsed))
+        if result['errors'] or [ v for v in result['versions'].values() if v['errors'] ]:
+            sys.exit(1)
 
     if args['info']:
         print('Source:', bak.src, '\n')
@@ -362,7 +1638,7 @@ def main():
             table['No.'].append(str(version.num))
             date = time.localtime(version.time)
             table['Time'].append(time.strftime('%Y/%m/%d %H:%M:%S', date))
-            table['Files'].append(str(len(version.files)))
+            table['Files'].append(str(version.count()))
             table['Size'].append(str(round(version.size/1000)))
         for column, data in table.items():
             colwidth = max([len(entry) for entry in data])
@@ -0,0 +1,304 @@
+'''Tools for writing zip archives faster than zipfile does on its own.
+
+ParallelZipWriter compresses members on a pool of threads (zlib releases
+the GIL while compressing) and writes them to the zip in the order they
+were added. Large files are split into blocks that are compressed
+separately, each using the end of the previous block as its dictionary,
+so a single huge file is compressed by every thread at once. Bzip2 and 
+LZMA members are compressed a block at a time on the pool too, but in 
+order as their compressors keep state between blocks.
+
+ReadAhead reads the files to be written on a thread of its own, so reading
+source files, compressing them and writing the zip all overlap.
+'''
+import os
+import time
+import zlib
+import struct
+import zipfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try: import bz2
+except ImportError: bz2 = None
+try: import lzma
+except ImportError: lzma = None
+
+BLOCK_SIZE = 1024*1024      # Size of blocks compressed by each thread
+DICT_SIZE = 32*1024         # Size of deflate window, used to prime the next block
+READAHEAD = 64*1024*1024    # Most bytes read ahead of being written (by default)
+
+
+def deflate_block(data, level, zdict=None, last=True):
+    """Returns raw deflate data for block. Blocks other than the last end on
+       a byte boundary, so the compressed blocks can be joined together.
+    """
+    if zdict: compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+    else: compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def new_compressor(compress_type, level=None):
+    """Returns compressor object making member data of COMPRESS_TYPE as zipfile does"""
+    if compress_type == zipfile.ZIP_BZIP2:
+        if not bz2: raise RuntimeError('Compression requires the (missing) bz2 module')
+        return bz2.BZ2Compressor(level or 9)
+    if compress_type == zipfile.ZIP_LZMA:
+        if not lzma: raise RuntimeError('Compression requires the (missing) lzma module')
+        return zipfile.LZMACompressor()
+    raise NotImplementedError('Unsupported compression method {}'.format(compress_type))
+
+def compress_next(compressor, block, previous, last):
+    """Compresses block with COMPRESSOR once the job for the PREVIOUS block is done"""
+    if previous: previous.result()
+    data = compressor.compress(block)
+    return data + compressor.flush() if last else data
+
+
+class RawMemberWriter:
+    """Writes already compressed data as a member of a zip archive opened for
+       writing, in the same way zipfile's own write handles do.
+    """
+    def __init__(self, zipobj, zinfo, zip64=None):
+        self.zipobj = zipobj
+        self.zinfo = zinfo
+        self.compress_size = 0
+        if zip64 is None: zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        self.zip64 = zip64
+
+        if zipobj._writing:
+            raise ValueError("Can't write to zip archive while another write handle is open")
+        zinfo.compress_size = 0
+        zinfo.CRC = 0
+        zinfo.flag_bits = 0x00
+        if zinfo.compress_type == zipfile.ZIP_LZMA:
+            zinfo.flag_bits |= 0x02         # Compressed data includes end of stream marker
+        if not zipobj._seekable: zinfo.flag_bits |= 0x08     # Sizes written after data
+        if not zinfo.external_attr: zinfo.external_attr = 0o600 << 16
+
+        if zipobj._seekable: zipobj.fp.seek(zipobj.start_dir)
+        zinfo.header_offset = zipobj.fp.tell()
+        zipobj._writecheck(zinfo)
+        zipobj._didModify = True
+        zipobj.fp.write(zinfo.FileHeader(zip64))
+        zipobj._writing = True
+
+    def write(self, data):
+        self.zipobj.fp.write(data)
+        self.compress_size += len(data)
+
+    def close(self, crc, file_size):
+        """Finishes member with CRC and size of the uncompressed data"""
+        zipobj, zinfo = self.zipobj, self.zinfo
+        try:
+            zinfo.compress_size = self.compress_size
+            zinfo.CRC = crc
+            zinfo.file_size = file_size
+            if not self.zip64 and max(file_size, self.compress_size) > zipfile.ZIP64_LIMIT:
+                raise RuntimeError('File size too large for zip without zip64')
+
+            if zinfo.flag_bits & 0x08:
+                fmt = '<LLQQ' if self.zip64 else '<LLLL'
+                zipobj.fp.write(struct.pack(fmt, 0x08074b50, crc, self.compress_size, file_size))
+                zipobj.start_dir = zipobj.fp.tell()
+            else:
+                # Go back and fill in the header now that sizes are known
+                zipobj.start_dir = zipobj.fp.tell()
+                zipobj.fp.seek(zinfo.header_offset)
+                zipobj.fp.write(zinfo.FileHeader(self.zip64))
+                zipobj.fp.seek(zipobj.start_dir)
+
+            zipobj.filelist.append(zinfo)
+            zipobj.NameToInfo[zinfo.filename] = zinfo
+        finally:
+            zipobj._writing = False
+
+
+def copy_member(srczip, zinfo, dstzip):
+    """Copies member ZINFO of SRCZIP to DSTZIP as it is stored, without 
+       decompressing and compressing it again.
+    """
+    fp = srczip.fp
+    fp.seek(zinfo.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+    fp.seek(header[10] + header[11], os.SEEK_CUR)    # Skip file name and extra field
+
+    newinfo = zipfile.ZipInfo(zinfo.filename, zinfo.date_time)
+    newinfo.compress_type = zinfo.compress_type
+    newinfo.external_attr = zinfo.external_attr
+    newinfo.create_system = zinfo.create_system
+    newinfo.file_size = zinfo.file_size
+    writer = RawMemberWriter(dstzip, newinfo, 
+        max(zinfo.file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT)
+    remaining = zinfo.compress_size
+    while remaining:
+        data = fp.read(min(remaining, BLOCK_SIZE))
+        if not data: raise zipfile.BadZipFile('Truncated member {}'.format(zinfo.filename))
+        writer.write(data)
+        remaining -= len(data)
+    writer.close(zinfo.CRC, zinfo.file_size)
+
+
+class ReadAhead:
+    """Reads files at PATHS in order on a background thread, holding at most LIMIT 
+       bytes read but not yet taken. Iterating gives (path, iterator over blocks 
+       of file data) for each file, and each file's blocks must be taken before
+       the next file's. Errors reading a file are raised when its blocks are taken.
+       Use as a context manager, so reading stops if files aren't all taken.
+    """
+    def __init__(self, paths, limit=READAHEAD, blocksize=BLOCK_SIZE):
+        self.paths = list(paths)
+        self.limit = max(limit, blocksize)
+        self.blocksize = blocksize
+        self.blocks = deque()       # Blocks read, b'' ends each file, errors end reading
+        self.size = 0               # Bytes in blocks
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def read(self):
+        try:
+            for path in self.paths:
+                with open(path, 'rb') as f:
+                    while True:
+                        block = f.read(self.blocksize)
+                        if not self.put(block): return
+                        if not block: break
+        except Exception as e: self.put(e)
+
+    def put(self, block):
+        """Adds block once there is room for it, returns False if reading stopped"""
+        size = len(block) if isinstance(block, bytes) else 0
+        with self.cond:
+            while self.size and self.size + size > self.limit and not self.stopped:
+                self.cond.wait()
+            if self.stopped: return False
+            self.blocks.append(block)
+            self.size += size
+            self.cond.notify_all()
+            return True
+
+    def take(self):
+        with self.cond:
+            while not self.blocks: self.cond.wait()
+            block = self.blocks.popleft()
+            if isinstance(block, Exception): raise block
+            self.size -= len(block)
+            self.cond.notify_all()
+            return block
+
+    def __iter__(self):
+        for path in self.paths: yield path, iter(self.take, b'')
+
+    def close(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.thread.join()
+
+
+class ParallelZipWriter:
+    """Adds files to a zip archive, compressing them on multiple threads.
+       Members are written in the order they are added. Call close() (or use
+       as a context manager) to finish writing before closing the zip.
+    """
+    def __init__(self, zipobj, threads=None, level=None):
+        self.zipobj = zipobj
+        self.threads = threads or os.cpu_count() or 1
+        self.level = zlib.Z_DEFAULT_COMPRESSION if level is None else level
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.pending = deque()          # Queued (action, args) in order of writing
+        self.window = self.threads*4    # Maximum number of blocks waiting to be written
+        self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None: self.close()
+        else: self.pool.shutdown(cancel_futures=True)
+
+    def write(self, path, arcname, compress_type=None, digest=None, compresslevel=None, 
+            blocks=None):
+        """Queues file for writing, reading it straight away unless its data is 
+           given as iterable of BLOCKS (such as from ReadAhead). DIGEST is updated 
+           with the file contents if given.
+        """
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        if blocks is not None:
+            self.add(zinfo, iter(blocks), compress_type, digest, compresslevel)
+            return
+        with open(path, 'rb') as f:
+            self.add(zinfo, iter(lambda: f.read(BLOCK_SIZE), b''), compress_type, digest, 
+                compresslevel)
+
+    def writestr(self, arcname, data, compress_type=None, compresslevel=None):
+        """Queues bytes to be written as a file"""
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(time.time())[:6])
+        zinfo.file_size = len(data)
+        view = memoryview(data)
+        blocks = (view[i:i+BLOCK_SIZE] for i in range(0, len(data), BLOCK_SIZE))
+        self.add(zinfo, blocks, compress_type, compresslevel=compresslevel)
+
+    def add(self, zinfo, blocks, compress_type=None, digest=None, compresslevel=None):
+        """Queues member with data from iterable of BLOCKS"""
+        if compress_type is None: compress_type = self.zipobj.compression
+        level = self.level if compresslevel is None else compresslevel
+        compressor = None
+        if not compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            compressor = new_compressor(compress_type, compresslevel)
+        zinfo.compress_type = compress_type
+        self.queue(self.start, zinfo)
+
+        crc = size = 0
+        zdict = job = None
+        block = next(blocks, b'')
+        while True:
+            following = next(blocks, None)
+            last = following is None
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            if digest: digest.update(block)
+            if compress_type == zipfile.ZIP_DEFLATED:
+                job = self.pool.submit(deflate_block, bytes(block), level, zdict, last)
+                zdict = bytes(block[-DICT_SIZE:])
+            elif compressor:
+                job = self.pool.submit(compress_next, compressor, bytes(block), job, last)
+            else: job = bytes(block)
+            self.queue(self.writeblock, job)
+            if last: break
+            block = following
+        self.queue(self.finish, crc, size)
+
+    def queue(self, action, *args):
+        self.pending.append((action, args))
+        while len(self.pending) > self.window: self.run()
+
+    def run(self):
+        action, args = self.pending.popleft()
+        action(*args)
+
+    def start(self, zinfo):
+        self.writer = RawMemberWriter(self.zipobj, zinfo)
+
+    def writeblock(self, job):
+        self.writer.write(job if isinstance(job, bytes) else job.result())
+
+    def finish(self, crc, size):
+        self.writer.close(crc, size)
+        self.writer = None
+
+    def close(self):
+        """Writes all queued members"""
+        try:
+            while self.pending: self.run()
+        finally:
+            self.pool.shutdown()
@@ -0,0 +1,37 @@
+import io
+import random
+from savman import chunking
+
+
+def randbytes(size, seed=0):
+    rand = random.Random(seed)
+    return bytes(rand.getrandbits(8) for i in range(size))
+
+def test_chunks_join():
+    data = randbytes(1000000)
+    chunks = list(chunking.chunks(io.BytesIO(data)))
+    assert b''.join(chunks) == data
+    assert len(chunks) > 1
+    assert max(len(c) for c in chunks) <= chunking.MAX_SIZE
+    assert min(len(c) for c in chunks[:-1]) >= chunking.MIN_SIZE
+
+def test_chunks_insert():
+    data = randbytes(1000000)
+    changed = data[:500000] + b'inserted' + data[500000:]
+    before = set(chunking.chunks(io.BytesIO(data)))
+    after = list(chunking.chunks(io.BytesIO(changed)))
+    # Only the chunk containing the insertion should differ
+    assert len([c for c in after if c not in before]) == 1
+
+def test_chunks_insert_text():
+    # Text has none of the byte values random data is sure to have
+    rand = random.Random(0)
+    words = [b'"level": ', b'"player", ', b'true', b'{', b'}\n', b'12', b'  ']
+    data = b''.join(rand.choice(words) for i in range(200000))
+    before = list(chunking.chunks(io.BytesIO(data)))
+    assert len(before) > 5
+    after = list(chunking.chunks(io.BytesIO(b'x' + data)))
+    assert len([c for c in after if c not in set(before)]) == 1
+
+def test_chunks_empty():
+    assert list(chunking.chunks(io.BytesIO(b''))) == []
@@ -0,0 +1,21 @@
+import os
+import pytest
+from savman import compression
+
+
+def test_choose():
+    text = b'save data ' * 10000
+    assert compression.choose(text).name == 'deflate'
+    assert compression.choose(os.urandom(100000)) is compression.STORED
+    assert compression.choose(os.urandom(100)).name == 'deflate'   # Too small to sample
+
+@pytest.mark.parametrize('policy', sorted(compression.POLICIES))
+def test_policies(policy):
+    codec = compression.choose(b'save data ' * 10000, policy)
+    assert codec is compression.POLICIES[policy].codec
+    assert compression.available(codec)
+    assert compression.choose(os.urandom(100000), policy) is compression.STORED
+
+def test_check():
+    compression.check('deflate')
+    with pytest.raises(RuntimeError): compression.check('unknown')
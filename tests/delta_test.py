@@ -0,0 +1,31 @@
+import io
+import random
+import pytest
+from savman import delta
+
+
+def randbytes(size, seed=0):
+    rand = random.Random(seed)
+    return bytes(rand.getrandbits(8) for i in range(size))
+
+def rebuild(base, target):
+    diff = b''.join(delta.diff(io.BytesIO(base), io.BytesIO(target)))
+    out = io.BytesIO()
+    delta.patch(io.BytesIO(base), io.BytesIO(diff), out)
+    assert out.getvalue() == target
+    return diff
+
+def test_delta_small_change():
+    base = randbytes(500000)
+    target = base[:200000] + b'changed' + base[200100:]
+    diff = rebuild(base, target)
+    assert len(diff) < 50000
+
+def test_delta_unrelated():
+    rebuild(randbytes(100000), randbytes(80000, seed=1))
+    rebuild(b'', randbytes(1000))
+    rebuild(randbytes(1000), b'')
+
+def test_patch_corrupt():
+    with pytest.raises(ValueError):
+        delta.patch(io.BytesIO(b''), io.BytesIO(b'not a delta'), io.BytesIO())
@@ -1,5 +1,7 @@
+import os
 import pytest
 from savman import gameman
+from savman.vbackup import Backup
 
 @pytest.fixture
 def gamedir(tmpdir):
@@ -70,3 +72,87 @@ def test_find_games(tmpdir, gamedir):
 
     assert 'MyGame' in gman.games
     assert gman.games['MyGame'].locations[0].path == gamedir
+
+def test_backup_games(tmpdir, customfile, dir1, dir2, monkeypatch):
+    dir1.mkdir('folder1').join('save.dat').write('save1')
+    dir2.join('save.dat').write('save2')
+    gman = gameman.GameMan('DUMMY')
+    gman.load_custom(str(customfile))
+    original = Backup.build
+    def build(backup, src, include=None, exclude=None):
+        if src == str(dir1): raise OSError('Cannot read')
+        return original(backup, src, include, exclude)
+    monkeypatch.setattr(gameman.Backup, 'build', build)
+    dst = tmpdir.mkdir('backups')
+    errors = gman.backup_games(str(dst), jobs=2)
+    assert list(errors) == [('MyGame', str(dir1))]
+    # Other locations are still backed up
+    assert [ f.split('_')[0] for f in os.listdir(str(dst)) ] == ['MyGame2']
+
+def test_backup_unchanged(tmpdir, customfile, dir1, dir2, monkeypatch):
+    dir1.mkdir('folder1').join('save.dat').write('save1')
+    dir2.join('save.dat').write('save2')
+    opened = []
+    class CountedBackup(Backup):
+        def __init__(self, file='', id=None):
+            if id: opened.append(id)    # Opened to back up, not to read its catalog entry
+            super().__init__(file, id)
+    monkeypatch.setattr(gameman, 'Backup', CountedBackup)
+    gman = gameman.GameMan('DUMMY')
+    gman.load_custom(str(customfile))
+    dst = str(tmpdir.mkdir('backups'))
+    gman.backup_games(dst, jobs=1)
+    assert sorted(opened) == ['MyGame', 'MyGame2']
+
+    # Fingerprints are kept in the cache between runs
+    cache = str(tmpdir.join('cache'))
+    gman.save_cache(cache)
+    gman = gameman.GameMan('DUMMY')
+    gman.load_custom(str(customfile))
+    gman.load_cache(cache)
+    del opened[:]
+    gman.backup_games(dst, jobs=1)
+    assert opened == []
+    dir2.join('save.dat').write('save2 changed')
+    dir1.join('other.png').write('excluded')
+    gman.backup_games(dst, jobs=1)
+    assert opened == ['MyGame2']
+    gman.backup_games(dst, jobs=1, force=True)
+    assert sorted(opened) == ['MyGame', 'MyGame2', 'MyGame2']
+
+def test_catalog(tmpdir, customfile, dir1, dir2, monkeypatch):
+    dir1.mkdir('folder1').join('save.dat').write('save1')
+    dir2.join('save.dat').write('save2')
+    database = {'games': {'MyGame': {'name': 'My Game'}, 'MyGame2': {'name': 'My Game 2'}}}
+    gman = gameman.GameMan(database)
+    gman.load_custom(str(customfile))
+    loaded = tmpdir.mkdir('loaded')
+    gman.backup_games(str(loaded), jobs=1)
+    gman.load_backups(str(loaded))
+    loadedbackups = { game: list(paths) for game, paths in gman.backups.items() }
+    assert sorted(loadedbackups) == ['MyGame', 'MyGame2']
+    dst = tmpdir.mkdir('backups')
+    gman.backup_games(str(dst), jobs=1)
+    # Backups to restore from stay those loaded, new archives are only catalogued
+    assert gman.backups == loadedbackups
+    assert len(gman.catalog) == 4
+    link = tmpdir.join('link')
+    os.symlink(str(dst), str(link))
+    gman.backup_games(str(link), jobs=1, force=True)
+    assert len(gman.catalog) == 4       # Archives are found by their real paths
+    path = [ p for p in gman.catalog if p.startswith(os.path.realpath(str(dst))) and 
+        gman.catalog[p]['id'] == 'MyGame' ][0]
+    entry = gman.catalog[path]
+    assert entry['id'] == 'MyGame' and entry['versions'] == 1
+    assert entry['src'] == os.path.realpath(str(dir1))
+    assert entry['size'] == os.path.getsize(path)
+
+    # Archives that didn't change aren't opened again
+    cache = str(tmpdir.join('cache'))
+    gman.save_cache(cache)
+    gman = gameman.GameMan(database)
+    gman.load_cache(cache)
+    monkeypatch.setattr(gameman, 'Backup', None)
+    gman.load_backups(str(dst))
+    assert gman.backups == {'MyGame': [path], 'MyGame2': gman.backups['MyGame2']}
+    assert gman.catalog_entry(path) == entry
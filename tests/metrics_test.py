@@ -0,0 +1,49 @@
+import json
+import threading
+from savman.metrics import Metrics
+
+
+def test_spans_and_counters():
+    stats = Metrics()
+    with stats.span('scan'): pass
+    with stats.span('scan'): pass
+    stats.count('files', 3)
+    stats.count('files')
+    summary = stats.summary()
+    assert summary['spans']['scan']['count'] == 2
+    assert summary['spans']['scan']['seconds'] >= 0
+    assert summary['counters'] == {'files': 4}
+
+def test_timed():
+    stats = Metrics()
+    @stats.timed('work')
+    def work(value): return value * 2
+    assert work(2) == 4
+    assert stats.summary()['spans']['work']['count'] == 1
+
+def test_rates():
+    stats = Metrics()
+    stats.count('cache.hits', 3)
+    stats.count('cache.misses', 1)
+    stats.count('other.hits', 0)
+    assert stats.summary()['rates'] == {'cache': 0.75}
+    assert stats.report()[-1].split() == ['cache', 'hit', 'rate', '75.0%']
+
+def test_threads():
+    stats = Metrics()
+    def add():
+        for _ in range(1000): stats.count('n')
+    threads = [ threading.Thread(target=add) for _ in range(8) ]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert stats.counters['n'] == 8000
+
+def test_save(tmpdir):
+    stats = Metrics()
+    with stats.span('load'): stats.count('bytes', 10)
+    path = str(tmpdir.join('stats.json'))
+    stats.save(path)
+    with open(path) as f: saved = json.load(f)
+    assert saved['counters'] == {'bytes': 10} and 'load' in saved['spans']
+    stats.reset()
+    assert stats.summary() == {'spans': {}, 'counters': {}, 'rates': {}}
@@ -0,0 +1,54 @@
+import os
+import fnmatch
+import pytest
+from savman import pathmatch
+
+
+@pytest.fixture
+def tree(tmpdir):
+    for path in ['a.txt', 'b.sav', 'saves/1.sav', 'saves/2.txt', 'saves/old/3.sav', 
+            'cache/4.sav', 'x/y/z.txt', 'x/w/z.txt']:
+        f = tmpdir.join(*path.split('/'))
+        f.dirpath().ensure(dir=True)
+        f.write(path)
+    return tmpdir
+
+def scanned(root, include=None, exclude=None):
+    matcher = pathmatch.PathMatcher(include, exclude)
+    return sorted(rel.replace(os.sep, '/') for rel, entry in pathmatch.scan(str(root), matcher))
+
+def test_scan(tree):
+    assert len(scanned(tree)) == 8
+    assert scanned(tree, include=['*.sav']) == ['b.sav', 'cache/4.sav', 'saves/1.sav', 
+        'saves/old/3.sav']
+    assert scanned(tree, include=['*.sav'], exclude=['cache', os.path.join('saves', 'old')]) == [
+        'b.sav', 'saves/1.sav']
+    assert scanned(tree, include=[os.path.join('x', '*', 'z.txt')]) == ['x/w/z.txt', 'x/y/z.txt']
+
+def test_prune(tree, monkeypatch):
+    entered = []
+    enter = pathmatch.PathMatcher.enter
+    def record(self, state, path):
+        state = enter(self, state, path)
+        if state is not None: entered.append(path.replace(os.sep, '/'))
+        return state
+    monkeypatch.setattr(pathmatch.PathMatcher, 'enter', record)
+    assert scanned(tree, include=[os.path.join('saves', '[0-9].sav')]) == ['saves/1.sav']
+    # 'saves/old' could only match if pattern's '[0-9]' matched a separator
+    assert sorted(entered) == ['saves']
+
+@pytest.mark.parametrize('pattern', ['*', 'sa*', 'saves', 's?ves*', '[!x]*', 'x*z.txt', 
+    os.path.join('*', 'old', '*'), os.path.join('x', 'y*'), 'x[']) 
+def test_prune_exact(pattern):
+    # Directory is entered exactly when some path under it matches
+    matcher = pathmatch.PathMatcher([pattern])
+    paths = [os.path.join(*p.split('/')) for p in ['saves', 'saves/old', 'x', 'x/y', 'x/w']]
+    for path in paths:
+        state = matcher.root()
+        parts = path.split(os.sep)
+        for i in range(len(parts)): 
+            state = state and matcher.enter(state, os.path.join(*parts[:i+1]))
+        candidates = [ os.path.join(path, name) for name in ['a', 'old', os.path.join('y', 'b'),
+            os.path.join('old', 'c'), 'z.txt', 'w', os.path.join('y', 'z.txt')] ]
+        possible = any(fnmatch.fnmatch(c, pattern) for c in candidates)
+        if possible: assert state is not None
@@ -0,0 +1,38 @@
+import time
+import pytest
+from collections import namedtuple
+from savman import retention
+from savman.retention import Rule
+
+Version = namedtuple('Version', 'time')
+HOUR, DAY = 3600, 86400
+
+
+def test_parse():
+    assert retention.parse('weekly:30d, all:1d,daily:7d') == [Rule(0, DAY), Rule(DAY, 7*DAY), 
+        Rule(7*DAY, 30*DAY)]
+    assert retention.parse('12h:2w') == [Rule(12*HOUR, 14*DAY)]
+    for text in ('', 'daily', 'daily:', 'daily:7', 'sometimes:7d', ':7d'):
+        with pytest.raises(ValueError): retention.parse(text)
+
+def test_select():
+    newest = time.mktime((2020, 6, 15, 12, 0, 0, 0, 0, -1))     # A Monday
+    versions = [ Version(newest - h*HOUR) for h in range(0, 24*40, 6) ]
+    kept = retention.select(versions, retention.parse('all:1d,daily:7d,weekly:30d'))
+    assert kept == sorted(kept)
+    assert kept[-1] == Version(newest)
+    ages = [ (newest - v.time)/HOUR for v in kept ]
+    assert ages[-5:] == [24, 18, 12, 6, 0]
+    # Newest version of each day, then of each week
+    daily = [ a for a in ages if 24 < a <= 7*24 ]
+    assert daily == [162, 138, 114, 90, 66, 42]
+    weekly = [ a for a in ages if a > 7*24 ]
+    assert all(a <= 30*24 for a in weekly)
+    assert len(weekly) == len({ retention.period(newest - a*HOUR, 7*DAY) for a in weekly })
+    # The same versions are kept when the policy is applied again
+    assert retention.select(kept, retention.parse('all:1d,daily:7d,weekly:30d')) == kept
+
+def test_select_newest():
+    versions = [ Version(t) for t in (1000000000, 1000000100) ]
+    assert retention.select(versions, retention.parse('daily:1w')) == versions[-1:]
+    assert retention.select([], retention.parse('all:1d')) == []
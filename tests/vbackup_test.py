@@ -1,5 +1,12 @@
+import io
+import os
+import sys
+import json
 import pytest
-from savman.vbackup import Backup
+import tarfile
+import zipfile
+from savman import metrics, retention, vbackup, ziptools
+from savman.vbackup import Backup, readindex, INDEX_NAME, STORE_CHUNKS, CHECK_HASH, CHECK_SAMPLED
 
 
 @pytest.fixture 
@@ -83,10 +90,11 @@ def test_save_load(backup, saved_backup):
     assert 'file2.txt' in bak.lastver.files
     assert bak.src == backup.src
 
-def test_change(saved_backup, changed_backup, file1):
+def test_change(changed_backup, file1):
     bak = changed_backup
+    first = min(bak.versions.values(), key=lambda v: v.time)
     assert bak.lastver.files['file1.txt'].location == bak.lastver.id
-    assert bak.lastver.files['file2.txt'].location == saved_backup.lastver.id
+    assert bak.lastver.files['file2.txt'].location == first.id
     assert bak.lastver.sizedelta == 9
     assert bak.lastver.size == 14
 
@@ -96,6 +104,104 @@ def test_trim(trimmed_backup):
     assert bak.lastver.files['file2.txt'].location == bak.lastver.id
     assert bak.lastver.size == bak.lastver.sizedelta
 
+@pytest.mark.parametrize('kernel_copy', [True, False])
+def test_trim_copies_members(changed_backup, filedir, bakfile, tmpdir, monkeypatch, kernel_copy):
+    bak = changed_backup
+    filedir.join('file3.txt').write('test3')
+    bak.build(str(filedir))
+    bak.save()
+    if not kernel_copy:
+        monkeypatch.delattr(os, 'copy_file_range', raising=False)
+        monkeypatch.delattr(os, 'sendfile', raising=False)
+        monkeypatch.setattr(vbackup, 'COPY_BLOCKSIZE', 3)
+    bak = Backup(bakfile)
+    newest = bak.lastver
+    with tarfile.open(bakfile) as t: before = bak.readmember(t, newest.data)
+    bak.vertrim(2)
+    bak = Backup(bakfile)
+    assert len(bak.versions) == 2
+    with tarfile.open(bakfile) as t: assert bak.readmember(t, newest.data) == before
+    restored = tmpdir.mkdir('restored')
+    bak.restore(str(restored))
+    assert restored.join('file1.txt').read() == 'test1plus'
+    assert restored.join('file3.txt').read() == 'test3'
+
+@pytest.mark.parametrize('mapped', [True, False])
+def test_mapped_reads(changed_backup, tmpdir, monkeypatch, mapped):
+    bak = changed_backup
+    if not mapped: monkeypatch.setattr(vbackup, 'mmap', None)
+    views = []
+    memoryfile = vbackup.MemoryFile
+    monkeypatch.setattr(vbackup, 'MemoryFile', lambda view: views.append(view) or memoryfile(view))
+    restored = tmpdir.mkdir('restored')
+    bak.restore(str(restored), threads=2)
+    assert restored.join('file1.txt').read() == 'test1plus'
+    assert restored.join('file2.txt').read() == 'test2'
+    result = bak.verify()
+    assert result['bytes'] == 19 and not result['errors']
+    assert bool(views) == mapped
+    for view in views:      # Each view is released when its zip is closed
+        with pytest.raises(ValueError): view.nbytes
+
+def test_memoryfile():
+    f = vbackup.MemoryFile(memoryview(b'0123456789'))
+    assert f.read(3) == b'012' and f.tell() == 3
+    f.seek(-2, os.SEEK_END)
+    assert f.read() == b'89' and f.read(5) == b''
+    f.seek(1)
+    buf = bytearray(4)
+    assert f.readinto(buf) == 4 and buf == b'1234'
+    with pytest.raises(OSError): f.seek(-1)
+    f.close()
+    assert f.closed
+
+def test_mapped_empty_data(filedir, file1, bakfile, tmpdir):
+    bak = Backup()
+    bak.storage = STORE_CHUNKS
+    bak.build(str(filedir))
+    bak.save(bakfile)
+    # Touched file has every chunk stored already, so version data is an empty zip
+    os.utime(str(file1), (1000000000, 1000000000))
+    bak = Backup(bakfile)
+    bak.build(str(filedir))
+    bak.save()
+    filedir.join('file3.txt').write('test3')
+    bak = Backup(bakfile)
+    bak.build(str(filedir))
+    bak.save()
+
+    bak = Backup(bakfile)
+    result = bak.verify()
+    assert not result['errors']
+    assert not any(v['errors'] for v in result['versions'].values())
+    bak.vertrim(2)
+    bak = Backup(bakfile)
+    assert len(bak.versions) == 2
+    restored = tmpdir.mkdir('restored')
+    bak.restore(str(restored))
+    assert restored.join('file1.txt').read() == 'test1'
+    assert restored.join('file3.txt').read() == 'test3'
+
+def test_restore_to_zip_raw(filedir, file1, bakfile, tmpdir, monkeypatch):
+    filedir.join('big.txt').write('save data ' * 100000)
+    bak = Backup()
+    bak.build(str(filedir))
+    bak.save(bakfile)
+    bak = Backup(bakfile)
+    out = str(tmpdir.join('out.zip'))
+    def fail(*args, **kwargs): raise AssertionError('Member decompressed')
+    with monkeypatch.context() as m:
+        m.setattr(zipfile.ZipFile, 'open', fail)
+        bak.restore(out, to_zip=True)
+    with tarfile.open(bakfile) as t:
+        stored = zipfile.ZipFile(bak.extractmember(t, bak.lastver.data)).getinfo('big.txt')
+    with zipfile.ZipFile(out) as z:
+        assert z.testzip() is None
+        assert z.read('big.txt') == b'save data ' * 100000
+        assert z.read('file1.txt') == b'test1'
+        info = z.getinfo('big.txt')
+        assert (info.compress_size, info.CRC) == (stored.compress_size, stored.CRC)
+
 def test_restore(changed_backup, tmpdir):
     bak = changed_backup
     f1 = tmpdir.join('file1.txt')
@@ -111,3 +217,600 @@ def test_restorenum(changed_backup, tmpdir):
 
 
 
+def test_index(changed_backup, bakfile):
+    with open(bakfile, 'rb') as f:
+        index, end = readindex(f)
+    assert [v['id'] for v in index['versions']] == sorted(changed_backup.versions)
+    assert index['versions'][-1]['files'] == 2
+    assert changed_backup.lastver.data in index['members']
+    assert changed_backup.src == index['info']['src']
+
+def test_load_unindexed(saved_backup, tmpdir, filedir, file1):
+    # Copy archive without its index, as written by older versions
+    old = str(tmpdir.join('old.vbak'))
+    with tarfile.open(saved_backup.file) as src, tarfile.open(old, 'w') as dst:
+        for member in src.getmembers():
+            if member.name != INDEX_NAME: dst.addfile(member, src.extractfile(member))
+    bak = Backup(old)
+    assert bak.lastver.id == saved_backup.lastver.id
+    assert 'file1.txt' in bak.lastver.files
+
+    file1.write('test1plus')
+    bak.build(str(filedir))
+    bak.save()
+    with open(old, 'rb') as f: index, end = readindex(f)
+    assert len(index['versions']) == 2
+    bak = Backup(old)
+    assert len(bak.versions) == 2
+    assert bak.lastver.files['file1.txt'].size == 9
+
+def test_chunked(filedir, file1, file2, bakfile, tmpdir):
+    bak = Backup()
+    bak.storage = STORE_CHUNKS
+    bak.build(str(filedir))
+    bak.save(bakfile)
+    file1.write('test1plus')
+    bak = Backup(bakfile)
+    assert bak.storage == STORE_CHUNKS
+    bak.build(str(filedir))
+    bak.save()
+    bak = Backup(bakfile)
+    first, last = sorted(bak.versions)
+    assert bak.lastver.files['file1.txt'].chunks[0][1] == last
+    assert bak.lastver.files['file2.txt'].chunks[0][1] == first
+
+    restored = tmpdir.mkdir('restored')
+    bak.restore(str(restored))
+    assert restored.join('file1.txt').read() == 'test1plus'
+    assert restored.join('file2.txt').read() == 'test2'
+
+    bak.vertrim(1)
+    bak = Backup(bakfile)
+    assert bak.lastver.files['file2.txt'].chunks[0][1] == last
+    bak.restore(str(restored))
+    assert restored.join('file2.txt').read() == 'test2'
+
+def test_chunked_to_zip(filedir, file1, bakfile, tmpdir):
+    data = bytearray(os.urandom(1024*1024))
+    save = filedir.join('save.bin')
+    save.write_binary(data)
+    bak = Backup()
+    bak.storage = STORE_CHUNKS
+    bak.build(str(filedir))
+    bak.save(bakfile)
+    data[500000:500100] = os.urandom(100)
+    save.write_binary(data)
+    bak = Backup(bakfile)
+    bak.build(str(filedir))
+    bak.save()
+    bak = Backup(bakfile)
+    assert len({ loc for cid, loc in bak.lastver.files['save.bin'].chunks }) == 2
+
+    out = str(tmpdir.join('out.zip'))
+    bak.restore(out, to_zip=True)
+    with zipfile.ZipFile(out) as z:
+        assert sorted(z.namelist()) == ['file1.txt', 'save.bin']
+        assert z.read('save.bin') == data
+        assert z.read('file1.txt') == b'test1'
+
+def test_chunked_dedup(filedir, bakfile):
+    data = bytes(range(256)) * 4096
+    filedir.join('big1.bin').write_binary(data)
+    filedir.join('big2.bin').write_binary(data)
+    bak = Backup()
+    bak.storage = STORE_CHUNKS
+    bak.build(str(filedir))
+    bak.save(bakfile)
+    bak = Backup(bakfile)
+    files = bak.lastver.files
+    assert files['big1.bin'].chunks == files['big2.bin'].chunks
+
+def test_hashcheck(filedir, file1, file2, bakfile, monkeypatch):
+    bak = Backup(bakfile)
+    bak.check = CHECK_HASH
+    bak.build(str(filedir))
+    bak.save()
+    bak = Backup(bakfile)
+    first = bak.lastver.id
+    assert bak.lastver.files['file1.txt'].digest
+
+    # Touched but unchanged file is not stored again
+    os.utime(str(file1), (0, 1000))
+    bak.build(str(filedir))
+    assert bak.curver.newfiles == 0
+    assert bak.curver.files['file1.txt'].location == first
+    assert bak.curver.files['file1.txt'].mod == 1000
+
+    # Digest is cached, so the file isn't read again for the same stat
+    hashed = []
+    monkeypatch.setattr(vbackup, 'filedigest', lambda path: hashed.append(path))
+    bak = Backup(bakfile)
+    bak.build(str(filedir))
+    assert not hashed
+
+    file1.write('test3')
+    os.utime(str(file1), (0, 2000))
+    monkeypatch.undo()
+    bak = Backup(bakfile)
+    bak.build(str(filedir))
+    assert bak.curver.newfiles == 1
+
+def test_hashcheck_sampled(filedir, bakfile, monkeypatch):
+    monkeypatch.setattr(vbackup, 'SAMPLE_MIN', 100)
+    monkeypatch.setattr(vbackup, 'SAMPLE_BLOCKSIZE', 10)
+    big = filedir.join('big.bin')
+    big.write_binary(bytes(1000))
+    bak = Backup(bakfile)
+    bak.check = CHECK_SAMPLED
+    bak.build(str(filedir))
+    bak.save()
+    assert bak.curver.files['big.bin'].sample
+
+    # Change in a sampled block is found without reading the whole file
+    big.write_binary(b'x' + bytes(999))
+    os.utime(str(big), (0, 1000))
+    monkeypatch.setattr(vbackup, 'filedigest', lambda path: pytest.fail('file was hashed'))
+    bak = Backup(bakfile)
+    bak.build(str(filedir))
+    assert bak.curver.newfiles == 1
+
+def test_save_failed(saved_backup, filedir, file1, file2, bakfile):
+    bak = saved_backup
+    file1.write('test1plus')
+    bak.build(str(filedir))
+    file1.remove()
+    with pytest.raises(FileNotFoundError): bak.save()
+    # Archive is left as it was before saving
+    with open(bakfile, 'rb') as f: assert readindex(f)
+    with tarfile.open(bakfile) as t: assert len(t.getnames()) == 4
+    bak = Backup(bakfile)
+    assert len(bak.versions) == 1
+
+def test_streamed_member(changed_backup, bakfile):
+    with tarfile.open(bakfile) as t:
+        data = t.getmember(changed_backup.lastver.data)
+        assert data.size == len(t.extractfile(data).read())
+        assert zipfile.is_zipfile(t.extractfile(data))
+
+def test_restore_paths(changed_backup, tmpdir, monkeypatch):
+    bak = changed_backup
+    bak.lastver.files
+    opened = []
+    opendata = Backup.opendata
+    monkeypatch.setattr(Backup, 'opendata', 
+        lambda self, t, ver, mapped=None: opened.append(ver) or opendata(self, t, ver, mapped))
+    restored = tmpdir.mkdir('restored')
+    bak.restore(str(restored), include=['file1.txt'])
+    assert restored.join('file1.txt').read() == 'test1plus'
+    assert not restored.join('file2.txt').exists()
+    assert opened == [bak.lastver.id]     # Only version containing file is read
+
+    restored = tmpdir.mkdir('restored2')
+    bak.restore(str(restored), exclude=['*1.txt'])
+    assert not restored.join('file1.txt').exists()
+    assert restored.join('file2.txt').isfile()
+
+def test_restore_directory(filedir, file1, bakfile, tmpdir):
+    sub = filedir.mkdir('sub')
+    sub.join('file3.txt').write('test3')
+    bak = Backup()
+    bak.build(str(filedir))
+    bak.save(bakfile)
+    bak = Backup(bakfile)
+    restored = tmpdir.mkdir('restored')
+    bak.restore(str(restored), include=['sub'])
+    assert restored.join('sub', 'file3.txt').read() == 'test3'
+    assert not restored.join('file1.txt').exists()
+
+@pytest.mark.parametrize('storage', [vbackup.STORE_FILES, STORE_CHUNKS])
+def test_restore_threaded(filedir, bakfile, tmpdir, monkeypatch, storage):
+    monkeypatch.setattr(vbackup, 'RESTORE_JOBSIZE', 1)     # One job per member
+    sub = filedir.mkdir('sub')
+    for i in range(4): sub.join('file{}.bin'.format(i)).write_binary(os.urandom(100000))
+    bak = Backup()
+    bak.storage = storage
+    bak.build(str(filedir))
+    bak.save(bakfile)
+    sub.join('file0.bin').write_binary(os.urandom(50000))
+    sub.mkdir('more').join('file4.bin').write_binary(os.urandom(1000))
+    bak = Backup(bakfile)
+    bak.build(str(filedir))
+    bak.save()
+
+    bak = Backup(bakfile)
+    serial, threaded = tmpdir.mkdir('serial'), tmpdir.mkdir('threaded')
+    bak.restore(str(serial), threads=1)
+    bak.restore(str(threaded), threads=4)
+    files = [ os.path.relpath(os.path.join(d, f), str(serial)) 
+        for d, _, fs in os.walk(str(serial)) for f in fs ]
+    assert len(files) == 5
+    for f in files: 
+        assert serial.join(f).read_binary() == threaded.join(f).read_binary()
+
+def test_policy(filedir, file1, bakfile, tmpdir):
+    filedir.join('random.bin').write_binary(os.urandom(100000))
+    filedir.join('text.txt').write('save data ' * 10000)
+    bak = Backup()
+    bak.policy = 'smallest'
+    bak.build(str(filedir))
+    bak.save(bakfile)
+    bak = Backup(bakfile)
+    assert bak.policy == 'smallest'
+    files = bak.lastver.files
+    assert files['random.bin'].codec == 'stored'
+    assert files['text.txt'].codec == vbackup.compression.POLICIES['smallest'].codec.name
+
+    restored = tmpdir.mkdir('restored')
+    bak.restore(str(restored))
+    assert restored.join('text.txt').read() == 'save data ' * 10000
+    assert restored.join('random.bin').read_binary() == filedir.join('random.bin').read_binary()
+
+def deltabackup(filedir, bakfile, versions, maxchain=vbackup.DELTA_MAXCHAIN):
+    """Saves VERSIONS of a large file to a backup using delta storage"""
+    save = filedir.join('save.db')
+    for num, data in enumerate(versions):
+        save.write_binary(data)
+        os.utime(str(save), (1000000000 + num, 1000000000 + num))
+        bak = Backup(bakfile)
+        bak.storage = vbackup.STORE_DELTAS
+        bak.maxchain = maxchain
+        bak.build(str(filedir))
+        bak.save(bakfile)
+    return Backup(bakfile)
+
+@pytest.fixture
+def saves():
+    data = bytearray(os.urandom(2*1024*1024))
+    versions = []
+    for i in range(4):
+        data[i*300000:i*300000+100] = os.urandom(100)
+        versions.append(bytes(data))
+    return versions
+
+def test_deltas(filedir, file1, bakfile, tmpdir, saves):
+    bak = deltabackup(filedir, bakfile, saves)
+    versions = sorted(bak.versions.values(), key=lambda v: v.time)
+    assert [v.files['save.db'].delta for v in versions] == [v.id for v in versions[1:]] + [None]
+    assert not bak.verify()['errors']
+    # Replaced copies are left in the archive until it is pruned
+    assert os.path.getsize(bakfile) > 8*1024*1024
+    bak.prune(list(bak.versions))
+    assert os.path.getsize(bakfile) < 3*1024*1024
+    assert all(v.data == vbackup.VERSION_DATA.format(v.id) for v in bak.versions.values())
+
+    for num, data in enumerate(saves):
+        restored = tmpdir.mkdir('restored{}'.format(num))
+        bak.restorenum(num + 1, str(restored))
+        assert restored.join('save.db').read_binary() == data
+        assert restored.join('file1.txt').read() == 'test1'
+
+    bak.vertrim(2)
+    bak = Backup(bakfile)
+    first, last = sorted(bak.versions.values(), key=lambda v: v.time)
+    assert first.files['save.db'].delta == last.id     # Chain is still whole
+    restored = tmpdir.mkdir('trimmed')
+    bak.restorenum(1, str(restored))
+    assert restored.join('save.db').read_binary() == saves[2]
+
+def test_deltas_maxchain(filedir, bakfile, saves):
+    bak = deltabackup(filedir, bakfile, saves, maxchain=2)
+    versions = sorted(bak.versions.values(), key=lambda v: v.time)
+    assert max(len(bak.chain(v.files['save.db'])) - 1 for v in versions) <= 2
+    assert versions[2].files['save.db'].delta is None     # Would make first chain too long
+
+def test_deltas_same_backup(filedir, bakfile, tmpdir, saves):
+    save = filedir.join('save.db')
+    bak = Backup(bakfile)
+    bak.storage = vbackup.STORE_DELTAS
+    for num, data in enumerate(saves[:3]):
+        save.write_binary(data)
+        os.utime(str(save), (1000000000 + num, 1000000000 + num))
+        bak.build(str(filedir))
+        bak.save()
+        # Saved version becomes the last, without loading the archive again
+        assert bak.lastver.num == num + 1 and len(bak.versions) == num + 1
+        restored = tmpdir.mkdir('restored{}'.format(num))
+        bak.restore(str(restored), ver=bak.lastver.id)
+        assert restored.join('save.db').read_binary() == data
+
+    bak = Backup(bakfile)
+    first, second, last = sorted(bak.versions.values(), key=lambda v: v.time)
+    assert (first.files['save.db'].delta, second.files['save.db'].delta) == (second.id, last.id)
+
+def test_deltas_cli_path(filedir, tmpdir, monkeypatch, saves):
+    monkeypatch.chdir(str(tmpdir))
+    save = filedir.join('save.db')
+    for num, data in enumerate(saves[:2]):
+        save.write_binary(data)
+        os.utime(str(save), (1000000000 + num, 1000000000 + num))
+        # Archive is given as a path that isn't normalised
+        monkeypatch.setattr(sys, 'argv', ['vbackup', 'build', '--deltas', str(filedir), 
+            os.path.join('.', 'test.vbak')])
+        vbackup.main()
+    bak = Backup('test.vbak')
+    first, last = sorted(bak.versions.values(), key=lambda v: v.time)
+    assert first.files['save.db'].delta == last.id
+
+def test_deltas_too_large(filedir, bakfile, tmpdir, saves):
+    versions = saves[:2] + [os.urandom(len(saves[0]))]
+    bak = deltabackup(filedir, bakfile, versions)
+    first, second, last = sorted(bak.versions.values(), key=lambda v: v.time)
+    assert first.files['save.db'].delta == second.id
+    # Delta against unrelated data would be as large as the copy itself
+    assert second.files['save.db'].delta is None
+    for num, data in enumerate(versions):
+        restored = tmpdir.mkdir('restored{}'.format(num))
+        bak.restorenum(num + 1, str(restored))
+        assert restored.join('save.db').read_binary() == data
+
+def test_deltas_failed(filedir, bakfile, tmpdir, saves):
+    bak = deltabackup(filedir, bakfile, saves[:2])
+    filedir.join('save.db').write_binary(saves[2])
+    other = filedir.join('other.txt')
+    other.write('other')
+    bak.build(str(filedir))
+    other.remove()
+    with open(bakfile, 'rb') as f: 
+        index, end = readindex(f)
+        f.seek(0)
+        before = f.read(end)
+    with pytest.raises(FileNotFoundError): bak.save()
+    # Last version is rewritten after the end of the archive, leaving its members whole
+    with open(bakfile, 'rb') as f: 
+        assert f.read(end) == before
+        assert readindex(f) == (index, end)
+    assert bak.lastver.files['save.db'].delta is None
+    bak = Backup(bakfile)
+    assert len(bak.versions) == 2
+    assert bak.lastver.files['save.db'].delta is None
+    for num, data in enumerate(saves[:2]):
+        restored = tmpdir.mkdir('restored{}'.format(num))
+        bak.restorenum(num + 1, str(restored))
+        assert restored.join('save.db').read_binary() == data
+
+def test_filetable():
+    base = vbackup.FileTable()
+    for name in 'abc': base[name] = vbackup.BackupFile(name)
+    table = vbackup.FileTable(base)
+    table['d'] = vbackup.BackupFile('d')
+    table['a'] = vbackup.BackupFile('a', 1)
+    del table['b']
+    assert len(table) == 3 and len(base) == 3
+    assert sorted(table) == ['a', 'c', 'd']
+    assert table['a'].size == 1 and base['a'].size == 0
+    assert table['c'] is base['c']
+    assert 'b' not in table and 'b' in base
+    with pytest.raises(KeyError): del table['b']
+
+def test_shared_entries(changed_backup):
+    first, last = sorted(changed_backup.versions.values(), key=lambda v: v.time)
+    assert first.files['file2.txt'] is last.files['file2.txt']
+    assert first.files['file1.txt'] is not last.files['file1.txt']
+    assert last.files['file1.txt'].location is last.id
+
+def test_lazy_load(changed_backup, bakfile, monkeypatch):
+    bak = Backup(bakfile)
+    assert not any(v.loaded for v in bak.versions.values())
+    first, last = sorted(bak.versions.values(), key=lambda v: v.time)
+    assert (first.count(), last.count()) == (2, 2)
+    assert not first.loaded
+    assert first.files['file2.txt'].location == first.id
+    assert first.loaded and not last.loaded
+    # Last version lists changes from the first, which is shared with it
+    assert last.files['file1.txt'].location == last.id
+    assert last.parent == first.id
+    assert first.files['file2.txt'] is last.files['file2.txt']
+
+def test_manifest_changes(tmpdir, monkeypatch):
+    monkeypatch.setattr(vbackup, 'MANIFEST_CHECKPOINT', 3)
+    src = tmpdir.mkdir('src')
+    bakfile = str(tmpdir.join('test.vbak'))
+    for name in 'abcd': src.join(name).write(name)
+    expected = []
+    for num in range(5):
+        src.join('a').write('a' * (num + 2))
+        if num == 2: src.join('b').remove()
+        if num == 3: src.join('e').write('e')
+        os.utime(str(src.join('a')), (1000000000 + num,) * 2)
+        bak = Backup(bakfile)
+        bak.build(str(src))
+        bak.save(bakfile)
+        expected.append(sorted(os.listdir(str(src))))
+
+    bak = Backup(bakfile)
+    versions = sorted(bak.versions.values(), key=lambda v: v.time)
+    with tarfile.open(bakfile) as t:
+        infos = [ json.loads(bak.readmember(t, v.info).decode()) for v in versions ]
+    assert [ 'files' in i for i in infos ] == [True, False, False, True, False]
+    assert sorted(infos[1]['changes']) == ['a']
+    assert infos[2]['removed'] == ['b'] and infos[2]['count'] == 3
+    assert [ v.count() for v in versions ] == [ len(e) for e in expected ]
+    assert [ sorted(v.files) for v in versions ] == expected
+    assert versions[2].files['c'] is versions[0].files['c']
+
+    for num in (2, 5):
+        dst = str(tmpdir.mkdir('restore{}'.format(num)))
+        bak.restorenum(num, dst)
+        assert sorted(os.listdir(dst)) == expected[num - 1]
+        assert open(os.path.join(dst, 'a')).read() == 'a' * (num + 1)
+
+    # Trimming rebases the remaining versions on a new full list
+    bak.trim(versions[1].id, bakfile)
+    bak = Backup(bakfile)
+    versions = sorted(bak.versions.values(), key=lambda v: v.time)
+    with tarfile.open(bakfile) as t:
+        infos = [ json.loads(bak.readmember(t, v.info).decode()) for v in versions ]
+    assert [ 'files' in i for i in infos ] == [True, False, False, True]
+    assert [ sorted(v.files) for v in versions ] == expected[1:]
+    dst = str(tmpdir.mkdir('trimmed'))
+    bak.restorenum(2, dst)
+    assert sorted(os.listdir(dst)) == expected[2]
+
+def test_manifest_changes_path(changed_backup, filedir, file1, bakfile):
+    # Archive given as a path that isn't normalised is still the backup's own
+    file1.write('test1plusmore')
+    bak = Backup(bakfile)
+    bak.build(str(filedir))
+    bak.save(os.path.join(os.path.dirname(bakfile), '.', os.path.basename(bakfile)))
+    bak = Backup(bakfile)
+    with tarfile.open(bakfile) as t:
+        verinfo = json.loads(bak.readmember(t, bak.lastver.info).decode())
+    assert not 'files' in verinfo and sorted(verinfo['changes']) == ['file1.txt']
+
+def test_verify(changed_backup, bakfile):
+    bak = changed_backup
+    result = bak.verify()
+    assert not result['errors']
+    assert result['bytes'] == len('test1test2test1plus')
+    first, last = sorted(bak.versions.values(), key=lambda v: v.time)
+    assert result['versions'][first.id] == {'members': 2, 'bytes': 10, 'errors': []}
+    assert result['versions'][last.id] == {'members': 1, 'bytes': 9, 'errors': []}
+
+    # File list referring to a member that isn't there
+    last.files['file2.txt'] = vbackup.BackupFile('file2.txt', 5, location=last.id)
+    result = bak.verify(threads=1)
+    assert not result['versions'][first.id]['errors']
+    assert result['versions'][last.id]['errors'] == [
+        "'file2.txt' is missing from version {}".format(last.id)]
+
+def test_verify_damaged(changed_backup, bakfile):
+    bak = changed_backup
+    first = min(bak.versions.values(), key=lambda v: v.time)
+    offset, size = bak.members[first.data][1:]
+    with open(bakfile, 'r+b') as f:
+        f.seek(offset)
+        with zipfile.ZipFile(io.BytesIO(f.read(size))) as z: 
+            info = z.getinfo('file2.txt')
+        # Flip first byte of member data, after its local header
+        pos = offset + info.header_offset + 30 + len(info.filename) + len(info.extra)
+        f.seek(pos)
+        byte = f.read(1)
+        f.seek(pos)
+        f.write(bytes([byte[0] ^ 0xff]))
+    result = Backup(bakfile).verify()
+    assert not result['errors']
+    errors = result['versions'][first.id]['errors']
+    assert len(errors) == 1 and 'file2.txt' in errors[0]
+    assert not result['versions'][bak.lastver.id]['errors']
+
+    # Truncated archive loses members listed in index
+    with open(bakfile, 'r+b') as f: f.truncate(offset + 100)
+    result = bak.verify()
+    assert result['versions'][bak.lastver.id]['errors']
+
+def test_metrics(filedir, file1, file2, bakfile, tmpdir):
+    metrics.collector.reset()
+    bak = Backup(bakfile)
+    bak.build(str(filedir))
+    bak.save(bakfile)
+    Backup(bakfile).restore(str(tmpdir.mkdir('restored')))
+    summary = metrics.collector.summary()
+    assert set(summary['spans']) == {'vbackup.build', 'vbackup.save', 'vbackup.restore'}
+    counters = summary['counters']
+    assert counters['vbackup.files_stated'] == 2
+    assert counters['vbackup.bytes_read'] == counters['vbackup.bytes_restored'] == 10
+    assert counters['vbackup.archive_bytes'] == os.path.getsize(bakfile)
+
+@pytest.mark.parametrize('check', [vbackup.CHECK_STAT, CHECK_HASH])
+def test_restore_incremental(changed_backup, tmpdir, monkeypatch, check):
+    bak = changed_backup
+    first = min(bak.versions.values(), key=lambda v: v.time)
+    restored = tmpdir.mkdir('restored')
+    bak.restore(str(restored))
+    assert os.stat(str(restored.join('file2.txt'))).st_mtime == bak.lastver.files['file2.txt'].mod
+
+    # Only file that differs in older version is written
+    extracted = []
+    extract = zipfile.ZipFile.extract
+    monkeypatch.setattr(zipfile.ZipFile, 'extract', 
+        lambda self, name, path: extracted.append(name) or extract(self, name, path))
+    restored.join('extra.txt').write('extra')
+    metrics.collector.reset()
+    bak.restore(str(restored), first.id, incremental=check, delete=True)
+    assert extracted == ['file1.txt']
+    assert restored.join('file1.txt').read() == 'test1'
+    assert restored.join('file2.txt').read() == 'test2'
+    assert not restored.join('extra.txt').exists()
+    counters = metrics.collector.summary()['counters']
+    assert counters['vbackup.bytes_skipped'] == 5 and counters['vbackup.files_deleted'] == 1
+
+    # Contents are compared when checking by hash, not only time and size
+    restored.join('file2.txt').write('TEST2')
+    os.utime(str(restored.join('file2.txt')), (first.files['file2.txt'].mod,)*2)
+    extracted.clear()
+    bak.restore(str(restored), first.id, incremental=check)
+    assert extracted == ([] if check == vbackup.CHECK_STAT else ['file2.txt'])
+
+@pytest.mark.parametrize('readahead', [0, 1, ziptools.READAHEAD])
+def test_save_read_ahead(filedir, file1, bakfile, tmpdir, readahead):
+    filedir.join('big.bin').write_binary(b'save data ' * 300000)
+    filedir.join('empty.txt').write('')
+    bak = Backup()
+    bak.readahead = readahead
+    bak.build(str(filedir))
+    bak.save(bakfile)
+    bak = Backup(bakfile)
+    assert bak.lastver.files['big.bin'].codec == 'deflate'
+    restored = tmpdir.mkdir('restored')
+    bak.restore(str(restored))
+    for name in ('file1.txt', 'big.bin', 'empty.txt'):
+        assert restored.join(name).read_binary() == filedir.join(name).read_binary()
+
+@pytest.mark.parametrize('storage', [vbackup.STORE_FILES, STORE_CHUNKS])
+def test_prune(filedir, bakfile, tmpdir, storage):
+    contents = [ {'a': 'a1', 'b': 'b1'}, {'a': 'a2', 'b': 'b1'}, {'a': 'a2', 'b': 'b1', 'c': 'c3'}, 
+        {'a': 'a2', 'b': 'b4', 'c': 'c3'} ]
+    for num, files in enumerate(contents):
+        for name, data in files.items(): 
+            if num and contents[num - 1].get(name) == data: continue
+            filedir.join(name).write(data)
+            os.utime(str(filedir.join(name)), (1000000000 + num,) * 2)
+        bak = Backup(bakfile)
+        bak.storage = storage
+        bak.build(str(filedir))
+        bak.save(bakfile)
+
+    bak = Backup(bakfile)
+    versions = sorted(bak.versions.values(), key=lambda v: v.time)
+    with tarfile.open(bakfile) as t: before = bak.readmember(t, versions[3].data)
+    bak.prune([ versions[n].id for n in (0, 2, 3) ])
+    bak = Backup(bakfile)
+    kept = sorted(bak.versions.values(), key=lambda v: v.time)
+    assert [ v.id for v in kept ] == [ versions[n].id for n in (0, 2, 3) ]
+    assert not bak.verify()['errors']
+    if storage == vbackup.STORE_FILES:
+        # File from removed version moves to the next version using it
+        assert kept[1].files['a'].location == kept[1].id
+        assert kept[2].files['a'].location == kept[1].id
+        assert kept[1].sizedelta == 4
+    with tarfile.open(bakfile) as t: assert bak.readmember(t, kept[2].data) == before
+    for num, version in enumerate(kept):
+        dst = tmpdir.mkdir('restored{}'.format(num))
+        bak.restore(str(dst), version.id)
+        expected = contents[(0, 2, 3)[num]]
+        assert sorted(os.listdir(str(dst))) == sorted(expected)
+        for name, data in expected.items(): assert dst.join(name).read() == data
+
+def test_prune_deltas(filedir, file1, bakfile, tmpdir, saves):
+    bak = deltabackup(filedir, bakfile, saves)
+    versions = sorted(bak.versions.values(), key=lambda v: v.time)
+    bak.prune([versions[0].id, versions[3].id])
+    bak = Backup(bakfile)
+    first, last = sorted(bak.versions.values(), key=lambda v: v.time)
+    assert not first.files['save.db'].delta    # Chain went through removed versions
+    assert not bak.verify()['errors']
+    for num, version in ((0, first), (3, last)):
+        restored = tmpdir.mkdir('restored{}'.format(num))
+        bak.restore(str(restored), version.id)
+        assert restored.join('save.db').read_binary() == saves[num]
+
+def test_retain(changed_backup, bakfile):
+    bak = changed_backup
+    first, last = sorted(bak.versions.values(), key=lambda v: v.time)
+    assert bak.retain(retention.parse('all:1d')) == []
+    assert len(Backup(bakfile).versions) == 2
+    # Both versions were made on the same day, only the newest is kept
+    assert bak.retain(retention.parse('daily:7d')) == [first.id]
+    bak = Backup(bakfile)
+    assert list(bak.versions) == [last.id]
+    assert bak.lastver.files['file2.txt'].location == last.id
@@ -0,0 +1,93 @@
+import os
+import zipfile
+import pytest
+from savman import ziptools
+
+
+@pytest.fixture
+def files(tmpdir):
+    small = tmpdir.join('small.txt')
+    small.write('small file')
+    big = tmpdir.join('big.bin')
+    big.write_binary(os.urandom(1000) * 3000 + bytes(500000))
+    empty = tmpdir.join('empty.txt')
+    empty.write('')
+    return [small, big, empty]
+
+def test_parallel_write(tmpdir, files):
+    zpath = str(tmpdir.join('test.zip'))
+    with zipfile.ZipFile(zpath, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+        with ziptools.ParallelZipWriter(z, threads=4) as writer:
+            for f in files: writer.write(str(f), f.basename)
+            writer.writestr('stored.txt', b'stored', zipfile.ZIP_STORED)
+
+    with zipfile.ZipFile(zpath) as z:
+        assert z.testzip() is None
+        assert z.namelist() == ['small.txt', 'big.bin', 'empty.txt', 'stored.txt']
+        for f in files: assert z.read(f.basename) == f.read_binary()
+        assert z.getinfo('stored.txt').compress_type == zipfile.ZIP_STORED
+        assert z.getinfo('big.bin').compress_size < z.getinfo('big.bin').file_size
+
+def test_parallel_deterministic(tmpdir, files):
+    output = []
+    for threads in (1, 3):
+        zpath = str(tmpdir.join('test{}.zip'.format(threads)))
+        with zipfile.ZipFile(zpath, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+            with ziptools.ParallelZipWriter(z, threads=threads) as writer:
+                for f in files: writer.write(str(f), f.basename)
+        with zipfile.ZipFile(zpath) as z:
+            output.append([(i.filename, i.CRC, i.compress_size) for i in z.infolist()])
+    assert output[0] == output[1]
+
+@pytest.mark.parametrize('compress_type', [zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA])
+def test_parallel_codecs(tmpdir, files, monkeypatch, compress_type):
+    monkeypatch.setattr(ziptools, 'BLOCK_SIZE', 64*1024)    # Compress big file in many blocks
+    zpath = str(tmpdir.join('test.zip'))
+    with zipfile.ZipFile(zpath, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+        with ziptools.ParallelZipWriter(z, threads=4) as writer:
+            for f in files: writer.write(str(f), f.basename, compress_type)
+
+    with zipfile.ZipFile(zpath) as z:
+        assert z.testzip() is None
+        for f in files: 
+            assert z.getinfo(f.basename).compress_type == compress_type
+            assert z.read(f.basename) == f.read_binary()
+
+def test_copy_member(tmpdir, files):
+    src, dst = str(tmpdir.join('src.zip')), str(tmpdir.join('dst.zip'))
+    with zipfile.ZipFile(src, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+        for f in files: z.write(str(f), f.basename)
+    with zipfile.ZipFile(src) as z, zipfile.ZipFile(dst, 'w') as out:
+        for info in z.infolist(): ziptools.copy_member(z, info, out)
+
+    with zipfile.ZipFile(src) as z, zipfile.ZipFile(dst) as out:
+        assert out.testzip() is None
+        for info in z.infolist(): 
+            copied = out.getinfo(info.filename)
+            assert (copied.CRC, copied.compress_size) == (info.CRC, info.compress_size)
+            assert out.read(info.filename) == z.read(info.filename)
+
+def test_read_ahead(tmpdir, files):
+    paths = [ str(f) for f in files ]
+    with ziptools.ReadAhead(paths, limit=0, blocksize=1000) as reader:
+        for (path, blocks), f in zip(reader, files):
+            assert path == str(f)
+            data = b''.join(blocks)
+            assert data == f.read_binary()
+            assert reader.size <= 1000      # Never more than one block ahead
+
+def test_read_ahead_error(tmpdir, files):
+    paths = [ str(files[0]), str(tmpdir.join('missing')), str(files[1]) ]
+    with ziptools.ReadAhead(paths) as reader:
+        files = iter(reader)
+        path, blocks = next(files)
+        assert b''.join(blocks) == b'small file'
+        path, blocks = next(files)
+        with pytest.raises(FileNotFoundError): next(blocks)
+
+def test_read_ahead_stopped(tmpdir, files):
+    # Closing before every file is taken stops reading
+    with ziptools.ReadAhead([ str(files[1]) ] * 10, limit=0, blocksize=1000) as reader:
+        path, blocks = next(iter(reader))
+        next(blocks)
+    assert not reader.thread.is_alive()